@@ -3,12 +3,11 @@ from fastapi import APIRouter, Depends, HTTPException, Request, status
 
 from app.core.audit import log_security_event
 from app.core.brute_force import BruteForceProtector, get_brute_force_protector
+from app.core.password_pool import password_pool
 from app.core.rate_limiter import limiter
 from app.core.security import (
     create_access_token,
     get_current_user,
-    hash_password,
-    verify_password,
 )
 from app.db.session import AsyncSessionLocal
 from app.models import users
@@ -30,7 +29,7 @@ async def register(payload: UserCreate, request: Request):
             raise HTTPException(status_code=400,
                               detail="This username is already taken. Try another one.")
 
-        pwd_hash = hash_password(payload.password)
+        pwd_hash = await password_pool.hash(payload.password)
         ins = users.insert().values(username=payload.username, password_hash=pwd_hash)
         res = await session.execute(ins)
         await session.commit()
@@ -46,8 +45,10 @@ async def register(payload: UserCreate, request: Request):
              dependencies=[Depends(limiter(limit=5, window=900, by="ip"))])
 async def login(payload: UserCreate, request: Request,
                 bf: BruteForceProtector | None = Depends(get_brute_force_protector)):
+    ip = request.client.host
     if bf:
-        await bf.check(payload.username)
+        # counts this attempt up front, reset below if it succeeds
+        await bf.attempt(payload.username, ip)
 
     async with AsyncSessionLocal() as session:
         q = sa.select(users).where(users.c.username == payload.username)
@@ -55,8 +56,6 @@ async def login(payload: UserCreate, request: Request,
         row = r.first()
 
         if not row:
-            if bf:
-                await bf.register_failure(payload.username)
             await log_security_event("login", payload.username, "failure",
                                      request.client.host, {"reason": "user_not_found"})
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
@@ -64,16 +63,21 @@ async def login(payload: UserCreate, request: Request,
 
         user = row._mapping
 
-        if not verify_password(payload.password, user["password_hash"]):
+        try:
+            verified = await password_pool.verify(payload.password, user["password_hash"])
+        except HTTPException:
+            # shed with a 503, the password was never checked
             if bf:
-                await bf.register_failure(payload.username)
+                await bf.refund(payload.username, ip)
+            raise
+        if not verified:
             await log_security_event("login", payload.username, "failure",
                                      request.client.host, {"reason": "bad_password"})
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                               detail="Incorrect username or password.")
 
         if bf:
-            await bf.reset(payload.username)
+            await bf.reset(payload.username, ip)
         await log_security_event("login", payload.username, "success", request.client.host)
 
         token = create_access_token(user["id"])
@@ -1,13 +1,17 @@
 import sqlalchemy as sa
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 
 from app.core.audit import log_security_event
+from app.core.audit_writer import audit_writer
+from app.core.config import settings
 from app.core.encryption import encryptor
+from app.core.key_cache import KeySet, key_cache
 from app.core.rate_limiter import limiter
+from app.core.responses import fast_json
 from app.core.security import auth_and_set_state
 from app.db.session import AsyncSessionLocal
-from app.models import audit_logs, devices, users
-from app.schemas import PublishKey
+from app.models import devices, users
+from app.schemas import KeyLookup, PublishKey
 
 router = APIRouter(prefix="/keys", tags=["keys"])
 
@@ -16,8 +20,14 @@ router = APIRouter(prefix="/keys", tags=["keys"])
              dependencies=[Depends(limiter(limit=20, window=60, by="user"))])
 async def publish_key(payload: PublishKey, user_id: int = Depends(auth_and_set_state)):
     async with AsyncSessionLocal() as session:
-        q = sa.select(users.c.id).where(users.c.id == user_id)
-        r = await session.execute(q)
+        # bumping the version also checks the account exists
+        upd = (
+            users.update()
+            .where(users.c.id == user_id)
+            .values(keys_version=users.c.keys_version + 1)
+            .returning(users.c.id)
+        )
+        r = await session.execute(upd)
         if not r.first():
             raise HTTPException(status_code=404, detail="User account not found.")
 
@@ -30,30 +40,79 @@ async def publish_key(payload: PublishKey, user_id: int = Depends(auth_and_set_s
         )
         await session.execute(ins)
 
-        await session.execute(
-            audit_logs.insert().values(
-                user_id=user_id,
-                action="publish_key",
-                details={"device_name": payload.device_name}
-            )
-        )
         await log_security_event("publish_key", str(user_id), "success",
                                  details={"device": payload.device_name})
         await session.commit()
 
+    await key_cache.invalidate(user_id)
+    await audit_writer.record(user_id, "publish_key", {"device_name": payload.device_name})
+
     return {"status": "public key stored"}
 
 
+def _etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
 @router.get("/{user_id}", dependencies=[Depends(limiter(limit=30, window=30, by="ip"))])
-async def get_public_keys(user_id: int):
+async def get_public_keys(user_id: int, request: Request, response: Response):
+    """
+    Devices for one user. Send the ETag back as If-None-Match to get a
+    304 when nothing was published since.
+    """
+    cache_headers = {"Cache-Control": f"public, max-age={settings.KEYS_HTTP_MAX_AGE}"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        etag = _etag(await key_cache.version(user_id, _load_versions))
+        if _etag_matches(if_none_match, etag):
+            # a fresh response: keep the headers dependencies set (rate limits)
+            response.headers.update({"ETag": etag, **cache_headers})
+            not_modified = Response(status_code=status.HTTP_304_NOT_MODIFIED)
+            not_modified.headers.raw.extend(response.headers.raw)
+            return not_modified
+
+    keys = await key_cache.get(user_id, _load_devices)
+    response.headers.update({"ETag": _etag(keys.version), **cache_headers})
+    # cached device lists are plain json types, skip jsonable_encoder
+    return fast_json({"devices": keys.devices}, response)
+
+
+@router.post("/lookup", dependencies=[Depends(limiter(limit=10, window=30, by="ip"))])
+async def lookup_public_keys(payload: KeyLookup, response: Response):
+    """
+    Devices for up to 500 users at once, e.g. everyone in a group.
+
+    Returns `{"users": {"<user_id>": [devices]}}`, users without any keys
+    (or that don't exist) map to an empty list.
+    """
+    found = await key_cache.get_many(payload.user_ids, _load_devices)
+    return fast_json({"users": {user_id: keys.devices for user_id, keys in found.items()}},
+                     response)
+
+
+async def _load_versions(user_ids: list[int]) -> dict[int, int]:
     async with AsyncSessionLocal() as session:
-        q = sa.select(devices).where(devices.c.user_id == user_id)
+        q = sa.select(users.c.id, users.c.keys_version).where(users.c.id.in_(user_ids))
         r = await session.execute(q)
+        return {row.id: row.keys_version for row in r.fetchall()}
 
-        rows = []
-        for row in r.fetchall():
-            d = dict(row._mapping)
-            d["device_name"] = encryptor.decrypt(d["device_name"])
-            rows.append(d)
 
-        return {"devices": rows}
+async def _load_devices(user_ids: list[int]) -> dict[int, KeySet]:
+    """device rows as stored (device_name still encrypted), for key_cache"""
+    # version first: if a publish lands in between we return a newer
+    # device list under the older version, never the other way round
+    versions = await _load_versions(user_ids)
+    async with AsyncSessionLocal() as session:
+        q = sa.select(devices).where(devices.c.user_id.in_(user_ids)).order_by(devices.c.id)
+        r = await session.execute(q)
+
+        rows: dict[int, list[dict]] = {}
+        for row in r.fetchall():
+            rows.setdefault(row.user_id, []).append(dict(row._mapping))
+    return {u: KeySet(versions.get(u, 0), rows.get(u, [])) for u in user_ids}
@@ -1,108 +1,434 @@
+import asyncio
 import base64
+import datetime
 import json
+import uuid
 
 import sqlalchemy as sa
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, WebSocket, status
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 
 from app.core.audit import log_security_event
+from app.core.audit_writer import audit_writer
 from app.core.encryption import encryptor
+from app.core.envelopes import message_out, messages_out
+from app.core.framing import (
+    FRAMES_MEDIA_TYPE,
+    accepts_frames,
+    decode_frames,
+    encode_frame,
+    sends_frames,
+)
+from app.core.inbox_cache import inbox_cache
+from app.core.ingest import message_ingest
+from app.core.metrics import metrics
+from app.core.pagination import decode_cursor, encode_cursor
 from app.core.rate_limiter import limiter
-from app.core.security import auth_and_set_state
+from app.core.realtime import hub
+from app.core.responses import fast_json
+from app.core.security import auth_and_set_state, websocket_user
 from app.db.session import AsyncSessionLocal
-from app.models import audit_logs, messages, users
-from app.schemas import MessageIn, MessageOut
+from app.models import messages, users
+from app.schemas import EnvelopeHeader, MessageAck, MessageBatchIn, MessageIn, MessageOut
 
 router = APIRouter(prefix="/messages", tags=["messages"])
 
 
+def _decode_ciphertext(ciphertext: str) -> bytes | None:
+    try:
+        return base64.b64decode(ciphertext)
+    except Exception:
+        return None
+
+
+def _encrypt_metadata(metadata) -> str | None:
+    if not metadata:
+        return None
+    return encryptor.encrypt(json.dumps(metadata))
+
+
+async def _read_envelopes(request: Request, many: bool) -> list[tuple[EnvelopeHeader, bytes | None]]:
+    """
+    (header, ciphertext bytes) pairs from a JSON or frames body. ciphertext
+    is None if the JSON base64 didn't decode.
+    """
+    body = await request.body()
+    try:
+        if sends_frames(request):
+            frames = decode_frames(body, max_frames=100 if many else 1)
+            if not frames:
+                raise HTTPException(status_code=400, detail="Empty frame body.")
+            return [(EnvelopeHeader.model_validate(h), ct) for h, ct in frames]
+        if many:
+            envelopes = MessageBatchIn.model_validate_json(body).envelopes
+        else:
+            envelopes = [MessageIn.model_validate_json(body)]
+    except ValidationError as e:
+        raise RequestValidationError(e.errors()) from e
+    return [(env, _decode_ciphertext(env.ciphertext)) for env in envelopes]
+
+
+def _body_docs(json_schema: dict) -> dict:
+    # the body is parsed by hand (JSON or frames), describe both for /docs
+    return {"requestBody": {"required": True, "content": {
+        "application/json": {"schema": json_schema},
+        FRAMES_MEDIA_TYPE: {"schema": {"type": "string", "format": "binary"}},
+    }}}
+
+
 @router.post("/", status_code=status.HTTP_201_CREATED,
-             dependencies=[Depends(limiter(limit=30, window=60, by="user"))])
-async def send_message(payload: MessageIn, sender_id: int = Depends(auth_and_set_state)):
+             dependencies=[Depends(limiter(limit=30, window=60, by="user"))],
+             openapi_extra=_body_docs(MessageIn.model_json_schema()))
+async def send_message(request: Request, response: Response,
+                       sender_id: int = Depends(auth_and_set_state)):
+    """
+    Send one message. JSON with base64 ciphertext, or one binary frame
+    with `Content-Type: application/x-kavro-frames`.
+
+    With write-behind ingestion on, answers 202 `{"status": "queued",
+    "id": "<ingest id>"}` and the message shows up in the inbox once a
+    worker has stored it.
+    """
+    [(payload, ciphertext_bytes)] = await _read_envelopes(request, many=False)
+
     async with AsyncSessionLocal() as session:
         q = sa.select(users.c.id).where(users.c.id == payload.recipient_id)
         r = await session.execute(q)
         if not r.first():
             raise HTTPException(status_code=404, detail="Recipient user not found.")
 
-        try:
-            ciphertext_bytes = base64.b64decode(payload.ciphertext)
-        except Exception as err:
-            raise HTTPException(status_code=400,
-                              detail="Invalid ciphertext. Must be valid base64 encoded.") from err
-
-        enc_metadata = None
-        if payload.metadata:
-            enc_metadata = encryptor.encrypt(json.dumps(payload.metadata))
-
-        ins = messages.insert().values(
-            sender_id=sender_id,
-            recipient_id=payload.recipient_id,
-            ciphertext=ciphertext_bytes,
-            ephemeral_pubkey=payload.ephemeral_pubkey,
-            metadata=enc_metadata
-        )
-        await session.execute(ins)
-
-        await session.execute(
-            audit_logs.insert().values(
-                user_id=sender_id,
-                action="send_message",
-                details={"to": payload.recipient_id}
-            )
-        )
-        await log_security_event("send_message", str(sender_id), "success",
-                                details={"to": payload.recipient_id})
-        await session.commit()
+    if ciphertext_bytes is None:
+        raise HTTPException(status_code=400,
+                          detail="Invalid ciphertext. Must be valid base64 encoded.")
+
+    row = {
+        "sender_id": sender_id,
+        "recipient_id": payload.recipient_id,
+        "ciphertext": ciphertext_bytes,
+        "ephemeral_pubkey": payload.ephemeral_pubkey,
+        "metadata": _encrypt_metadata(payload.metadata),
+        "created_at": datetime.datetime.utcnow(),
+    }
+    # the enqueue runs without a pooled connection held, only a direct
+    # (or fallback) write opens a session
+    queued = False
+    if message_ingest.enabled:
+        row["ingest_id"] = uuid.uuid4().hex
+        queued = await message_ingest.enqueue(row)
+    if not queued:
+        async with AsyncSessionLocal() as session:
+            res = await session.execute(messages.insert().values(**row))
+            row["id"] = res.inserted_primary_key[0]
+            await session.commit()
+
+    await log_security_event("send_message", str(sender_id), "success",
+                            details={"to": payload.recipient_id})
+
+    await audit_writer.record(sender_id, "send_message", {"to": payload.recipient_id})
+
+    if queued:
+        return fast_json({"status": "queued", "id": row["ingest_id"]}, response,
+                         status_code=status.HTTP_202_ACCEPTED)
+
+    await inbox_cache.push([row])
+    await hub.publish(payload.recipient_id, message_out(row, decrypt=False))
 
     return {"status": "stored"}
 
 
-@router.get("/inbox", response_model=dict,
-            dependencies=[Depends(limiter(limit=20, window=30, by="user"))])
-async def fetch_inbox(limit: int = 50, user_id: int = Depends(auth_and_set_state)):
-    async with AsyncSessionLocal() as session:
-        q = sa.select(messages).where(
-            messages.c.recipient_id == user_id
-        ).order_by(messages.c.created_at.desc()).limit(limit)
+@router.post("/batch", status_code=status.HTTP_200_OK,
+             dependencies=[Depends(limiter(limit=30, window=60, by="user"))],
+             openapi_extra=_body_docs(
+                 {"type": "object", "required": ["envelopes"], "properties": {
+                     "envelopes": {"type": "array", "maxItems": 100,
+                                   "items": MessageIn.model_json_schema()}}}
+             ))
+async def send_message_batch(request: Request, sender_id: int = Depends(auth_and_set_state)):
+    """
+    Send up to 100 envelopes (e.g. one per group member or device) at once,
+    as JSON or as back-to-back binary frames.
+
+    Recipients are checked with one query and all valid envelopes go in
+    with one multi-row insert and one commit. Each envelope gets its own
+    status: stored, recipient_not_found or invalid_ciphertext.
+    """
+    envelopes = await _read_envelopes(request, many=True)
+    recipient_ids = {env.recipient_id for env, _ in envelopes}
 
+    async with AsyncSessionLocal() as session:
+        q = sa.select(users.c.id).where(users.c.id.in_(recipient_ids))
         r = await session.execute(q)
-        rows = [dict(row._mapping) for row in r.fetchall()]
-
-        out: list[MessageOut] = []
-        for row in rows:
-            ct = row["ciphertext"]
-            ct_b64 = base64.b64encode(ct).decode()
-
-            msg = {
-                "id": row["id"],
-                "sender_id": row["sender_id"],
-                "recipient_id": row["recipient_id"],
-                "ciphertext": ct_b64,
-                "ephemeral_pubkey": row["ephemeral_pubkey"],
-                "metadata": None,
-            }
-
-            if row.get("metadata"):
+        known = {row[0] for row in r.fetchall()}
+
+        results = []
+        rows = []
+        for i, (env, ciphertext_bytes) in enumerate(envelopes):
+            result = {"index": i, "recipient_id": env.recipient_id, "id": None}
+            results.append(result)
+
+            if env.recipient_id not in known:
+                result["status"] = "recipient_not_found"
+                continue
+
+            if ciphertext_bytes is None:
+                result["status"] = "invalid_ciphertext"
+                continue
+
+            result["status"] = "stored"
+            rows.append({
+                "sender_id": sender_id,
+                "recipient_id": env.recipient_id,
+                "ciphertext": ciphertext_bytes,
+                "ephemeral_pubkey": env.ephemeral_pubkey,
+                "metadata": _encrypt_metadata(env.metadata),
+                "created_at": datetime.datetime.utcnow(),
+            })
+
+        if rows:
+            ins = messages.insert().returning(messages.c.id, sort_by_parameter_order=True)
+            r = await session.execute(ins, rows)
+            stored = [res for res in results if res["status"] == "stored"]
+            for res, row, inserted in zip(stored, rows, r.fetchall(), strict=True):
+                res["id"] = row["id"] = inserted[0]
+
+            delivered_to = sorted({row["recipient_id"] for row in rows})
+            await log_security_event("send_message_batch", str(sender_id), "success",
+                                    details={"to": delivered_to, "count": len(rows)})
+            await session.commit()
+
+            await audit_writer.record(sender_id, "send_message_batch",
+                                      {"to": delivered_to, "count": len(rows)})
+
+    await inbox_cache.push(rows)
+    for row in rows:
+        await hub.publish(row["recipient_id"], message_out(row, decrypt=False))
+
+    return {"stored": len(rows), "results": results}
+
+
+@router.websocket("/ws")
+async def inbox_socket(websocket: WebSocket):
+    """
+    Push new messages as soon as they are stored.
+
+    Authenticate with `Authorization: Bearer <token>` or `?token=<token>`.
+    Only new messages are pushed, fetch the inbox once on connect to catch up.
+    """
+    user_id = websocket_user(websocket)
+    if user_id is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    await hub.serve(websocket, user_id)
+
+
+async def _inbox_rows(session, q) -> list[dict]:
+    r = await session.execute(q)
+    return [dict(row._mapping) for row in r.fetchall()]
+
+
+async def _page_rows(user_id: int, q, limit: int, before: str | None,
+                     after_key: tuple | None) -> list[dict]:
+    """
+    limit + 1 rows in query order. first pages and `after` polls come from
+    the redis inbox cache when it has them, a first page from the db refills it.
+    """
+    gen = None
+    if not before:
+        rows, gen = await inbox_cache.page(user_id, limit + 1, after_key)
+        if rows is not None:
+            return rows
+
+    async with AsyncSessionLocal() as session:
+        rows = await _inbox_rows(session, q)
+    if not before and not after_key:
+        await inbox_cache.fill(user_id, rows, gen, complete=len(rows) <= limit)
+    return rows
+
+
+@router.get("/inbox", dependencies=[Depends(limiter(limit=20, window=30, by="user"))])
+async def fetch_inbox(request: Request,
+                      response: Response,
+                      limit: int = Query(50, ge=1, le=200),
+                      before: str | None = None,
+                      after: str | None = None,
+                      wait: float = Query(0, ge=0, le=30),
+                      include_metadata: bool = True,
+                      user_id: int = Depends(auth_and_set_state)):
+    """
+    Newest messages first, paged with opaque cursors.
+
+    `before` walks towards older messages (use `next_cursor`), `after`
+    fetches messages newer than a cursor (use `prev_cursor`).
+
+    `wait` (seconds, max 30) turns this into a long poll: if there is
+    nothing to return yet, the request waits for a new message or the
+    timeout. Ignored together with `before`.
+
+    `include_metadata=false` returns `metadata: null` and skips decrypting it.
+
+    With `Accept: application/x-kavro-frames` the messages come back as
+    binary frames (raw ciphertext) and the cursors in the X-Next-Cursor /
+    X-Prev-Cursor headers.
+    """
+    if before and after:
+        raise HTTPException(status_code=400,
+                          detail="Use either 'before' or 'after', not both.")
+
+    key = sa.tuple_(messages.c.created_at, messages.c.id)
+    q = sa.select(messages).where(messages.c.recipient_id == user_id)
+    after_key = decode_cursor(after) if after else None
+
+    if after:
+        q = q.where(key > sa.tuple_(*after_key))
+        q = q.order_by(messages.c.created_at.asc(), messages.c.id.asc())
+    else:
+        if before:
+            q = q.where(key < sa.tuple_(*decode_cursor(before)))
+        q = q.order_by(messages.c.created_at.desc(), messages.c.id.desc())
+
+    # one extra row tells us whether there is another page
+    q = q.limit(limit + 1)
+
+    rows = None
+    if wait and not before:
+        # subscribe before the first query so a send in between isn't missed
+        async with hub.waiter(user_id) as arrived:
+            rows = await _page_rows(user_id, q, limit, before, after_key)
+
+            if not rows:
+                # parked with no db session held
+                metrics.incr("inbox.longpoll_parked")
                 try:
-                    dec = encryptor.decrypt(row["metadata"])
-                    msg["metadata"] = json.loads(dec)
-                except json.JSONDecodeError:
-                    msg["metadata"] = {"error": "invalid_json"}
-                except (ValueError, TypeError):
-                    msg["metadata"] = {"error": "decryption_failed"}
-
-            out.append(msg)
-
-        await session.execute(
-            audit_logs.insert().values(
-                user_id=user_id,
-                action="fetch_inbox",
-                details={"count": len(out)}
-            )
+                    await asyncio.wait_for(arrived.wait(), timeout=wait)
+                    metrics.incr("inbox.longpoll_woken")
+                except TimeoutError:
+                    metrics.incr("inbox.longpoll_timeouts")
+                rows = None
+
+    if rows is None:
+        rows = await _page_rows(user_id, q, limit, before, after_key)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after:
+        rows.reverse()
+
+    binary = accepts_frames(request)
+    out: list[MessageOut] = await messages_out(rows, include_metadata, raw_ciphertext=binary)
+    await audit_writer.record(user_id, "fetch_inbox", {"count": len(out)})
+
+    next_cursor = None
+    prev_cursor = None
+    if rows:
+        newest, oldest = rows[0], rows[-1]
+        prev_cursor = encode_cursor(newest["created_at"], newest["id"])
+        if has_more or after:
+            next_cursor = encode_cursor(oldest["created_at"], oldest["id"])
+
+    if binary:
+        body = b"".join(
+            encode_frame({k: v for k, v in env.items() if k != "ciphertext"}, env["ciphertext"])
+            for env in out
+        )
+        headers = {}
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        if prev_cursor:
+            headers["X-Prev-Cursor"] = prev_cursor
+        out_response = Response(body, media_type=FRAMES_MEDIA_TYPE, headers=headers)
+        out_response.headers.raw.extend(response.headers.raw)
+        return out_response
+
+    # plain json types already, no need for jsonable_encoder
+    return fast_json({"messages": out, "next_cursor": next_cursor, "prev_cursor": prev_cursor},
+                     response)
+
+
+EXPORT_BATCH_SIZE = 500
+
+
+async def _export_lines(user_id: int, after: tuple | None, include_metadata: bool):
+    q = (
+        sa.select(messages)
+        .where(messages.c.recipient_id == user_id)
+        .order_by(messages.c.created_at.asc(), messages.c.id.asc())
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    if after:
+        q = q.where(sa.tuple_(messages.c.created_at, messages.c.id) > sa.tuple_(*after))
+
+    exported = 0
+    async with AsyncSessionLocal() as session:
+        # server-side cursor: at most one batch of rows is held at a time,
+        # and the next batch isn't fetched until the client took this one
+        result = await session.stream(q)
+        async for batch in result.mappings().partitions():
+            rows = [dict(row) for row in batch]
+            out = await messages_out(rows, include_metadata)
+            lines = []
+            for row, env in zip(rows, out, strict=True):
+                env["cursor"] = encode_cursor(row["created_at"], row["id"])
+                lines.append(json.dumps(env))
+            exported += len(lines)
+            yield "\n".join(lines) + "\n"
+
+    metrics.incr("inbox.export_rows", exported)
+
+
+@router.get("/export", dependencies=[Depends(limiter(limit=5, window=60, by="user"))])
+async def export_inbox(after: str | None = None,
+                       include_metadata: bool = True,
+                       user_id: int = Depends(auth_and_set_state)):
+    """
+    Every message in the mailbox, oldest first, as NDJSON (one envelope
+    per line). Streamed, so a whole mailbox can be synced or backed up.
+
+    Each line carries a `cursor`; if the download breaks, pass the last
+    one as `after` to continue from there.
+    """
+    # decoded here so a bad cursor is a 400, not a broken stream
+    after_key = decode_cursor(after) if after else None
+
+    await audit_writer.record(user_id, "export_inbox", {"after": after})
+    return StreamingResponse(_export_lines(user_id, after_key, include_metadata),
+                             media_type="application/x-ndjson")
+
+
+@router.post("/ack", status_code=status.HTTP_200_OK,
+             dependencies=[Depends(limiter(limit=60, window=60, by="user"))])
+async def ack_messages(payload: MessageAck, user_id: int = Depends(auth_and_set_state)):
+    """
+    Acknowledge many messages in one round trip.
+
+    IDs that don't exist or belong to someone else come back in `rejected`.
+    """
+    ids = list(dict.fromkeys(payload.message_ids))
+
+    async with AsyncSessionLocal() as session:
+        upd = (
+            messages.update()
+            .where(messages.c.id.in_(ids), messages.c.recipient_id == user_id)
+            .values(delivered=True)
+            .returning(messages.c.id, messages.c.created_at)
         )
+        r = await session.execute(upd)
+        acked = {row.id: row.created_at for row in r.fetchall()}
+
+        acknowledged = [i for i in ids if i in acked]
+        rejected = [i for i in ids if i not in acked]
+
         await session.commit()
 
-    return {"messages": out}
+    if acked:
+        await inbox_cache.trim_acked(user_id, max(acked.values()))
+    await audit_writer.record(user_id, "ack_messages",
+                              {"message_ids": acknowledged, "rejected": len(rejected)})
+
+    return {"acknowledged": acknowledged, "rejected": rejected}
 
 
 @router.post("/{message_id}/ack", status_code=status.HTTP_200_OK,
@@ -124,13 +450,9 @@ async def ack_message(message_id: int, user_id: int = Depends(auth_and_set_state
         upd = messages.update().where(messages.c.id == message_id).values(delivered=True)
         await session.execute(upd)
 
-        await session.execute(
-            audit_logs.insert().values(
-                user_id=user_id,
-                action="ack_message",
-                details={"message_id": message_id}
-            )
-        )
         await session.commit()
 
+    await inbox_cache.trim_acked(user_id, record["created_at"])
+    await audit_writer.record(user_id, "ack_message", {"message_id": message_id})
+
     return {"status": "acknowledged"}
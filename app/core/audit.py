@@ -1,19 +1,164 @@
 """
 audit.py - security event logging
 logs important security stuff like logins, key changes etc
+
+the request only puts the event on a queue. a listener thread does the
+json encoding and the actual writes (stderr, plus an optional rotating
+file), so a slow log pipe never stalls the event loop. the listener also
+wakes up while the queue is idle, so the file is fsynced within
+AUDIT_LOG_FSYNC_INTERVAL even if no further event arrives.
 """
 
-import logging
+import atexit
 import json
+import logging
+import os
+import queue
+import time
 from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+try:
+    import orjson
+except ImportError:  # optional, stdlib json is the fallback
+    orjson = None
+
+
+def dumps(entry: dict) -> str:
+    if orjson is not None:
+        return orjson.dumps(entry, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(entry, default=str)
+
+
+class JsonFormatter(logging.Formatter):
+    """record.msg is the event dict, encoded here on the listener thread"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        if isinstance(record.msg, dict):
+            return dumps(record.msg)
+        return super().format(record)
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # the default prepare() formats on the caller's thread, skip that
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.incr("security_log.dropped")
+
+
+class BatchedFsyncRotatingFileHandler(RotatingFileHandler):
+    """
+    size-rotated file that fsyncs every `fsync_every` records or
+    `fsync_interval` seconds instead of on every write. the interval is
+    driven by sync_if_due(), called from the listener when it's idle.
+    flush() and close() fsync whatever is pending.
+    """
+
+    def __init__(self, filename: str, max_bytes: int, backup_count: int,
+                 fsync_every: int = 100, fsync_interval: float = 1.0):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._emitting = False
+
+    def emit(self, record):
+        # StreamHandler.emit flushes after every record, that one mustn't fsync
+        self._emitting = True
+        try:
+            super().emit(record)
+        finally:
+            self._emitting = False
+        self._unsynced += 1
+        if (self._unsynced >= self.fsync_every
+                or time.monotonic() - self._last_sync >= self.fsync_interval):
+            self.sync()
+
+    def sync(self) -> None:
+        if self.stream and self._unsynced:
+            self.stream.flush()
+            os.fsync(self.stream.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def sync_if_due(self) -> None:
+        with self.lock:
+            if self._unsynced and time.monotonic() - self._last_sync >= self.fsync_interval:
+                self.sync()
+
+    def flush(self):
+        super().flush()
+        if not self._emitting:
+            self.sync()
+
+    def doRollover(self):
+        self.sync()
+        super().doRollover()
+
+    def close(self):
+        self.sync()
+        super().close()
+
+
+class _SyncingQueueListener(QueueListener):
+    """wakes up every `tick` seconds while idle to run interval fsyncs"""
+
+    def __init__(self, log_queue, *handlers, tick: float = 1.0, **kwargs):
+        super().__init__(log_queue, *handlers, **kwargs)
+        self.tick = tick
+
+    def dequeue(self, block):
+        if not block:
+            return super().dequeue(block)
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.tick)
+            except queue.Empty:
+                for handler in self.handlers:
+                    if isinstance(handler, BatchedFsyncRotatingFileHandler):
+                        handler.sync_if_due()
+
+
+def _build_handlers() -> list[logging.Handler]:
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter())
+    handlers: list[logging.Handler] = [stream]
+
+    if settings.AUDIT_LOG_FILE:
+        file_handler = BatchedFsyncRotatingFileHandler(
+            settings.AUDIT_LOG_FILE,
+            max_bytes=settings.AUDIT_LOG_MAX_BYTES,
+            backup_count=settings.AUDIT_LOG_BACKUPS,
+            fsync_every=settings.AUDIT_LOG_FSYNC_EVERY,
+            fsync_interval=settings.AUDIT_LOG_FSYNC_INTERVAL,
+        )
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+    return handlers
+
 
 # setup logger
 audit_logger = logging.getLogger("security_audit")
 audit_logger.setLevel(logging.INFO)
+audit_logger.propagate = False
+
+_log_queue: queue.Queue = queue.Queue(maxsize=settings.AUDIT_LOG_QUEUE_SIZE)
+audit_logger.addHandler(_NonBlockingQueueHandler(_log_queue))
 
-handler = logging.StreamHandler()
-handler.setFormatter(logging.Formatter('%(message)s'))
-audit_logger.addHandler(handler)
+audit_listener = _SyncingQueueListener(_log_queue, *_build_handlers(), respect_handler_level=True,
+                                       tick=settings.AUDIT_LOG_FSYNC_INTERVAL / 2)
+audit_listener.start()
+# drains the queue and closes (fsyncs) the file on exit
+atexit.register(audit_listener.stop)
 
 # TODO: in prod, send logs to cloudwatch or splunk
 
@@ -34,4 +179,4 @@ async def log_security_event(event: str, identifier: str, status: str,
         "ip_address": ip,
         "details": details or {}
     }
-    audit_logger.info(json.dumps(entry))
+    audit_logger.info(entry)
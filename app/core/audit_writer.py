@@ -0,0 +1,122 @@
+"""
+audit_writer.py - writes audit_logs rows in the background
+requests drop rows on a bounded queue and a single task bulk-inserts them,
+flushing every AUDIT_BATCH_SIZE rows or AUDIT_FLUSH_INTERVAL seconds.
+when the queue is full we either wait ("block") or drop the row ("drop").
+"""
+
+import asyncio
+import datetime
+import logging
+import time
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.db.session import AsyncSessionLocal
+from app.models import audit_logs
+
+logger = logging.getLogger("audit_writer")
+
+
+class AuditWriter:
+    def __init__(self, max_queue: int = 10000, batch_size: int = 200,
+                 flush_interval: float = 1.0, policy: str = "block"):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self._queue: asyncio.Queue | None = None
+        self._batch_ready: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._closing = False
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._batch_ready = asyncio.Event()
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """flush whatever is still queued and stop the background task"""
+        if self._task is None:
+            return
+        self._closing = True
+        self._batch_ready.set()
+        await self._task
+        self._task = None
+
+    async def record(self, user_id: int | None, action: str, details: dict | None = None) -> None:
+        row = {
+            "user_id": user_id,
+            "action": action,
+            "details": details,
+            "timestamp": datetime.datetime.utcnow(),
+        }
+
+        if self._task is None:
+            # not started (tests, scripts) - just write it
+            await self._write([row])
+            return
+
+        if self.policy == "drop":
+            try:
+                self._queue.put_nowait(row)
+            except asyncio.QueueFull:
+                metrics.incr("audit.dropped")
+                return
+        else:
+            await self._queue.put(row)
+
+        depth = self._queue.qsize()
+        metrics.set_gauge("audit.queue_depth", depth)
+        if depth >= self.batch_size:
+            self._batch_ready.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+            except TimeoutError:
+                pass
+            self._batch_ready.clear()
+
+            try:
+                while not self._queue.empty():
+                    await self._flush()
+            except Exception as e:
+                logger.error(f"audit flush failed: {e}")
+
+            if self._closing:
+                return
+
+    async def _flush(self) -> None:
+        batch = []
+        while len(batch) < self.batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        metrics.set_gauge("audit.queue_depth", self._queue.qsize())
+        if batch:
+            await self._write(batch)
+
+    async def _write(self, rows: list[dict]) -> None:
+        started = time.monotonic()
+        try:
+            async with AsyncSessionLocal() as session:
+                await session.execute(audit_logs.insert(), rows)
+                await session.commit()
+        except Exception as e:
+            metrics.incr("audit.write_errors")
+            metrics.incr("audit.dropped", len(rows))
+            logger.error(f"audit write of {len(rows)} rows failed: {e}")
+            return
+
+        metrics.incr("audit.written", len(rows))
+        metrics.observe("audit.batch_rows", len(rows))
+        metrics.observe("audit.flush_ms", (time.monotonic() - started) * 1000)
+
+
+audit_writer = AuditWriter(
+    max_queue=settings.AUDIT_QUEUE_SIZE,
+    batch_size=settings.AUDIT_BATCH_SIZE,
+    flush_interval=settings.AUDIT_FLUSH_INTERVAL,
+    policy=settings.AUDIT_QUEUE_POLICY,
+)
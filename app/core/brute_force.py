@@ -1,46 +1,200 @@
 """
 brute_force.py - protection against login brute force attacks
 locks out users after too many failed attempts
+
+each login does one atomic script call before the password is checked:
+it refuses if the key is locked, otherwise reserves an attempt. the
+reservation is dropped again on a successful login, so failures cost no
+extra round trip and concurrent guesses can't race past max_attempts.
+a login that never got its password checked (the hashing pool answered
+503) is refunded, so shed load doesn't lock anyone out.
+
+besides the per user key every address has its own counter
+(BRUTE_FORCE_IP_MAX_ATTEMPTS), checked in the same call, so one ip can't
+spray a few guesses at many usernames. successful logins are refunded
+from it instead of clearing it.
+
+lockouts grow exponentially (lockout, 2x, 4x ... up to max_lockout) for
+keys that keep getting locked. the level is forgotten after a quiet
+max_lockout period or a successful login.
+
+redis calls go through redis_guard. while redis is unavailable attempts
+are counted in this worker's memory instead, so lockouts still apply
+(per worker, without backoff) during an outage.
 """
 
-from fastapi import HTTPException, status, Request
-import redis.asyncio as redis
+import time
+import weakref
 from typing import Optional
 
+import redis.asyncio as redis
+from fastapi import HTTPException, Request, status
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.core.redis_guard import RedisUnavailable, redis_guard
+
+# KEYS: attempts, lock, level for each counter (user, then ip)
+# ARGV: window ms, base lockout ms, max lockout ms, then max_attempts per counter
+ATTEMPT_LUA = """
+local counters = #KEYS / 3
+for i = 0, counters - 1 do
+    local locked = redis.call('PTTL', KEYS[i * 3 + 2])
+    if locked > 0 then
+        return {0, locked}
+    end
+end
+
+local retry, counted = 0, {}
+for i = 0, counters - 1 do
+    local attempts, lock, level = KEYS[i * 3 + 1], KEYS[i * 3 + 2], KEYS[i * 3 + 3]
+    local n = redis.call('INCR', attempts)
+    if n == 1 then
+        redis.call('PEXPIRE', attempts, ARGV[1])
+    end
+    if n <= tonumber(ARGV[4 + i]) then
+        table.insert(counted, attempts)
+    else
+        -- one past the limit: lock, doubling the lockout each time
+        local lv = redis.call('INCR', level)
+        redis.call('PEXPIRE', level, ARGV[3])
+        local lockout = math.min(tonumber(ARGV[2]) * 2 ^ (lv - 1), tonumber(ARGV[3]))
+        redis.call('SET', lock, lv, 'PX', lockout)
+        redis.call('DEL', attempts)
+        retry = math.max(retry, lockout)
+    end
+end
+if retry == 0 then
+    return {1, 0}
+end
+
+-- refused: the other counters don't keep this attempt
+for _, attempts in ipairs(counted) do
+    redis.call('DECR', attempts)
+end
+return {0, retry}
+"""
+
+# KEYS: attempt counters to give one attempt back to
+REFUND_LUA = """
+for _, key in ipairs(KEYS) do
+    if tonumber(redis.call('GET', key) or '0') > 0 then
+        redis.call('DECR', key)
+    end
+end
+"""
+
+_scripts: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+_FALLBACK_MAX_KEYS = 10_000
+
+# key -> (window ends at, attempts), only used while redis is unavailable
+_local_attempts: dict[str, tuple[float, int]] = {}
+
+
+def _local_attempt(key: str, max_attempts: int, window: int) -> int:
+    """fallback reservation, returns ms until retry (0 = allowed)"""
+    metrics.incr("brute_force.fallback_decisions")
+    now = time.monotonic()
+    ends, count = _local_attempts.get(key, (0.0, 0))
+    if ends <= now:
+        ends, count = now + window, 0
+    if count >= max_attempts:
+        return int((ends - now) * 1000)
+    if key not in _local_attempts and len(_local_attempts) >= _FALLBACK_MAX_KEYS:
+        del _local_attempts[next(iter(_local_attempts))]
+    _local_attempts[key] = (ends, count + 1)
+    return 0
+
+
+def _local_refund(key: str) -> None:
+    ends, count = _local_attempts.get(key, (0.0, 0))
+    if count > 0:
+        _local_attempts[key] = (ends, count - 1)
+
 
 class BruteForceProtector:
     def __init__(self, redis_client: redis.Redis):
         self.redis = redis_client
-        self.max_attempts = 5   # lockout after 5 fails
-        self.window = 300       # 5 min window
-
-    def _get_key(self, identifier: str) -> str:
-        return f"bf_login:{identifier}"
-
-    async def check(self, identifier: str) -> None:
-        """check if user is locked out"""
-        key = self._get_key(identifier)
-        count = await self.redis.get(key)
-        
-        if count and int(count) >= self.max_attempts:
+        self.max_attempts = settings.BRUTE_FORCE_MAX_ATTEMPTS  # lockout after 5 fails
+        self.window = settings.BRUTE_FORCE_WINDOW              # 5 min window
+        self.lockout = settings.BRUTE_FORCE_LOCKOUT            # first lockout, then doubles
+        self.max_lockout = settings.BRUTE_FORCE_MAX_LOCKOUT
+        self.key_by = settings.BRUTE_FORCE_KEY                 # "username" or "ip_username"
+        self.ip_max_attempts = settings.BRUTE_FORCE_IP_MAX_ATTEMPTS  # any username, 0 = off
+
+    def _get_key(self, username: str, ip: str | None = None) -> str:
+        if self.key_by == "ip_username" and ip:
+            return f"bf_login:{ip}:{username}"
+        return f"bf_login:{username}"
+
+    def _counters(self, username: str, ip: str | None) -> list[tuple[str, int]]:
+        """(key, max attempts) for every counter this login is charged to"""
+        counters = [(self._get_key(username, ip), self.max_attempts)]
+        if ip and self.ip_max_attempts > 0:
+            counters.append((f"bf_login_ip:{ip}", self.ip_max_attempts))
+        return counters
+
+    def _script(self, source: str = ATTEMPT_LUA):
+        scripts = _scripts.setdefault(self.redis, {})
+        if source not in scripts:
+            scripts[source] = self.redis.register_script(source)
+        return scripts[source]
+
+    async def attempt(self, username: str, ip: str | None = None) -> None:
+        """refuse if locked out, otherwise count this attempt (one redis call)"""
+        counters = self._counters(username, ip)
+        try:
+            allowed, retry_ms = await redis_guard.run(
+                self._script(),
+                keys=[k for key, _ in counters for k in (key, f"{key}:lock", f"{key}:level")],
+                args=[self.window * 1000, self.lockout * 1000, self.max_lockout * 1000,
+                      *(limit for _, limit in counters)],
+            )
+        except RedisUnavailable:
+            retry_ms, counted = 0, []
+            for key, limit in counters:
+                retry_ms = _local_attempt(key, limit, self.window)
+                if retry_ms:
+                    for key in counted:
+                        _local_refund(key)
+                    break
+                counted.append(key)
+            allowed = not retry_ms
+
+        if not allowed:
+            metrics.incr("brute_force.lockouts")
+            retry_after = max(1, -(-int(retry_ms) // 1000))
             raise HTTPException(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail=f"Too many login attempts. Try again in {self.window//60} minutes."
+                detail=f"Too many login attempts. Try again in {retry_after} seconds.",
+                headers={"Retry-After": str(retry_after)},
             )
 
-    async def register_failure(self, identifier: str) -> int:
-        """increment fail count"""
-        key = self._get_key(identifier)
-        pipe = self.redis.pipeline()
-        pipe.incr(key)
-        pipe.expire(key, self.window)
-        results = await pipe.execute()
-        return results[0]
-
-    async def reset(self, identifier: str) -> None:
-        """reset on successful login"""
-        key = self._get_key(identifier)
-        await self.redis.delete(key)
+    async def refund(self, username: str, ip: str | None = None) -> None:
+        """give back an attempt whose password was never checked"""
+        keys = [key for key, _ in self._counters(username, ip)]
+        for key in keys:
+            _local_refund(key)
+        try:
+            await redis_guard.run(self._script(REFUND_LUA), keys=keys)
+        except RedisUnavailable:
+            pass
+
+    async def reset(self, username: str, ip: str | None = None) -> None:
+        """reset on successful login. the ip counter only gets this attempt back"""
+        key, *ip_keys = [key for key, _ in self._counters(username, ip)]
+        _local_attempts.pop(key, None)
+        for ip_key in ip_keys:
+            _local_refund(ip_key)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(key, f"{key}:level")
+        if ip_keys:
+            await self._script(REFUND_LUA)(keys=ip_keys, client=pipe)
+        try:
+            await redis_guard.run(pipe.execute)
+        except RedisUnavailable:
+            pass
 
 
 async def get_brute_force_protector(request: Request) -> Optional[BruteForceProtector]:
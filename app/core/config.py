@@ -9,6 +9,89 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 1440
     REDIS_URL: str
     ENCRYPTION_KEY: str | None = None
+    # field encryption for metadata / device names: "aesgcm" or "fernet".
+    # both formats are always decrypted, this only picks what gets written
+    FIELD_ENCRYPTION_BACKEND: str = "fernet"  # "aesgcm" once every instance reads it
+    FIELD_ENCRYPTION_KEYS: str | None = None  # "k1:<b64 key>,k2:<b64 key>"
+    FIELD_ENCRYPTION_KEY_ID: str | None = None  # defaults to the last key listed
+    JWT_CACHE_SIZE: int = 10000  # verified tokens cached per worker, 0 disables
+
+    # schema is managed by `python -m app.db.migrate upgrade`; only turn this
+    # on for single-process dev setups
+    RUN_MIGRATIONS_ON_STARTUP: bool = False
+
+    # response rendering: "orjson" (falls back to json if not installed) or "json"
+    JSON_RESPONSE: str = "orjson"
+
+    # redis calls on the request path (rate limits, brute force)
+    REDIS_CALL_TIMEOUT: float = 0.1  # seconds per call
+    REDIS_BREAKER_FAILURES: int = 5  # consecutive failures before opening
+    REDIS_BREAKER_RESET_TIMEOUT: float = 5.0  # seconds open before a probe
+
+    # login brute force protection
+    BRUTE_FORCE_MAX_ATTEMPTS: int = 5
+    BRUTE_FORCE_WINDOW: int = 300  # seconds the attempt count lives
+    BRUTE_FORCE_LOCKOUT: int = 300  # first lockout (s), doubles each time
+    BRUTE_FORCE_MAX_LOCKOUT: int = 86400
+    BRUTE_FORCE_KEY: str = "username"  # or "ip_username"
+    BRUTE_FORCE_IP_MAX_ATTEMPTS: int = 20  # per address across usernames, 0 = off
+
+    # public key directory cache
+    KEY_CACHE_SIZE: int = 10000  # users kept in each worker's LRU, 0 disables it
+    KEY_CACHE_LOCAL_TTL: float = 30.0  # seconds
+    KEY_CACHE_REDIS_TTL: int = 300  # seconds
+    KEYS_HTTP_MAX_AGE: int = 10  # Cache-Control max-age on GET /keys/{id}
+
+    # rate limiting
+    RATE_LIMIT_ALGORITHM: str = "sliding_window"  # or "token_bucket", "hybrid"
+    # hybrid only: decide locally below this fraction of the limit, and push
+    # local counts to redis this often (seconds)
+    RATE_LIMIT_LOCAL_THRESHOLD: float = 0.5
+    RATE_LIMIT_SYNC_INTERVAL: float = 0.5
+
+    # bcrypt worker pool
+    PASSWORD_HASH_EXECUTOR: str = "thread"  # "thread" or "process"
+    PASSWORD_HASH_WORKERS: int = 4
+    PASSWORD_HASH_QUEUE_SIZE: int = 64
+
+    # inbox metadata decryption: pages with more encrypted metadata than
+    # this go to a worker pool instead of running on the event loop
+    INBOX_DECRYPT_EXECUTOR: str = "thread"  # "thread" or "process"
+    INBOX_DECRYPT_WORKERS: int = 2
+    INBOX_DECRYPT_OFFLOAD_BYTES: int = 65536
+
+    # redis cache of each user's newest envelopes (write-through on send)
+    INBOX_CACHE_SIZE: int = 100  # envelopes per user, 0 disables the cache
+    INBOX_CACHE_TTL: int = 600  # seconds after the last refill from the db
+    INBOX_CACHE_MAX_ENVELOPE_BYTES: int = 16384  # bigger ones are never cached
+
+    # message ingestion: "direct" commits every send, "stream" queues it on
+    # a redis stream that `python -m app.core.ingest` flushes in batches
+    MESSAGE_INGEST: str = "direct"
+    INGEST_STREAM: str = "ingest:messages"
+    INGEST_GROUP: str = "ingest-writers"
+    INGEST_BATCH_SIZE: int = 500
+    INGEST_BLOCK_MS: int = 1000  # how long a worker waits for new entries
+    INGEST_CLAIM_IDLE_MS: int = 30000  # pending this long = its worker died, reclaim
+    INGEST_MAX_BACKLOG: int = 100000  # sends answer 503 past this many queued
+    INGEST_MAX_DELIVERIES: int = 5  # a row still failing after this many is dead-lettered
+
+    # background audit_logs writer
+    AUDIT_QUEUE_SIZE: int = 10000
+    AUDIT_BATCH_SIZE: int = 200
+    AUDIT_FLUSH_INTERVAL: float = 1.0  # seconds
+    AUDIT_QUEUE_POLICY: str = "block"  # "block" (backpressure) or "drop"
+
+    # security event log (stderr always, file optional)
+    AUDIT_LOG_QUEUE_SIZE: int = 10000
+    AUDIT_LOG_FILE: str | None = None
+    AUDIT_LOG_MAX_BYTES: int = 50 * 1024 * 1024
+    AUDIT_LOG_BACKUPS: int = 5
+    AUDIT_LOG_FSYNC_EVERY: int = 100  # records
+    AUDIT_LOG_FSYNC_INTERVAL: float = 1.0  # seconds
+
+    # websocket push
+    WS_SEND_BUFFER: int = 64  # queued envelopes per socket before we drop it
 
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8")
 
@@ -1,6 +1,9 @@
 import base64
+import binascii
 import hashlib
+import os
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 from app.core.config import settings
 
@@ -14,33 +17,120 @@ def get_encryption_key():
     return base64.urlsafe_b64encode(k)
 
 
-class FieldEncryptor:
-    def __init__(self):
-        key = get_encryption_key()
+def get_aead_keys() -> tuple[dict[str, bytes], str]:
+    """
+    AES-GCM keys by id and the id new values are written with.
+    FIELD_ENCRYPTION_KEYS="k1:<base64 32 bytes>,k2:<...>" for rotation,
+    otherwise a single key "k0" derived from ENCRYPTION_KEY / SECRET_KEY.
+    """
+    if settings.FIELD_ENCRYPTION_KEYS:
+        keys = {}
+        for item in settings.FIELD_ENCRYPTION_KEYS.split(","):
+            kid, _, key = item.strip().partition(":")
+            try:
+                keys[kid] = base64.urlsafe_b64decode(key)
+            except binascii.Error as err:
+                raise ValueError(f"FIELD_ENCRYPTION_KEYS: key {kid!r} is not valid base64") from err
+        return keys, settings.FIELD_ENCRYPTION_KEY_ID or kid
+
+    secret = settings.ENCRYPTION_KEY or settings.SECRET_KEY
+    return {"k0": hashlib.sha256(b"kavro-field-aesgcm:" + secret.encode()).digest()}, "k0"
+
+
+class FernetBackend:
+    """the original format, AES-128-CBC + HMAC-SHA256 in a base64 token"""
+
+    name = "fernet"
+
+    def __init__(self, key: bytes):
         self.fernet = Fernet(key)
 
+    def encrypt(self, data: bytes) -> str:
+        return self.fernet.encrypt(data).decode()
+
+    def decrypt(self, token: str) -> bytes:
+        return self.fernet.decrypt(token.encode())
+
+
+class AesGcmBackend:
+    """
+    AES-256-GCM stored as "<key id>.<base64url(nonce + ciphertext + tag)>".
+    One AEAD pass instead of CBC + HMAC, 28 bytes of overhead instead of
+    fernet's 57 plus padding. The key id lets old keys keep decrypting
+    after a rotation. Fernet tokens never contain a ".", so the two
+    formats can share a column.
+    """
+
+    name = "aesgcm"
+
+    def __init__(self, keys: dict[str, bytes], active: str):
+        # checked here so a bad config fails at startup, not on the first value
+        for kid, key in keys.items():
+            if not kid or "." in kid:
+                raise ValueError(f"AES-GCM key id {kid!r} must be non-empty and contain no '.'")
+            if len(key) != 32:
+                raise ValueError(f"AES-GCM key {kid!r} must be 32 bytes, got {len(key)}")
+        if active not in keys:
+            raise ValueError(f"Active AES-GCM key id {active!r} is not configured")
+        self.ciphers = {kid: AESGCM(key) for kid, key in keys.items()}
+        self.active = active
+        self._prefix = f"{active}."
+        self._cipher = self.ciphers[active]
+
+    @staticmethod
+    def owns(token: str) -> bool:
+        return "." in token
+
+    def encrypt(self, data: bytes) -> str:
+        nonce = os.urandom(12)
+        sealed = self._cipher.encrypt(nonce, data, None)
+        return self._prefix + base64.urlsafe_b64encode(nonce + sealed).decode()
+
+    def decrypt(self, token: str) -> bytes:
+        kid, _, body = token.partition(".")
+        raw = base64.urlsafe_b64decode(body)
+        return self.ciphers[kid].decrypt(raw[:12], raw[12:], None)
+
+
+class FieldEncryptor:
+    def __init__(self, backend: str | None = None):
+        self.legacy = FernetBackend(get_encryption_key())
+        self.aead = AesGcmBackend(*get_aead_keys())
+
+        backend = backend or settings.FIELD_ENCRYPTION_BACKEND
+        if backend not in ("fernet", "aesgcm"):
+            raise ValueError(f"Unknown field encryption backend: {backend}")
+        # new values are written with this one, both are always readable
+        self.backend = self.aead if backend == "aesgcm" else self.legacy
+
     def encrypt(self, plaintext: str) -> str:
         if not plaintext:
             return plaintext
-        return self.fernet.encrypt(plaintext.encode()).decode()
+        return self.backend.encrypt(plaintext.encode())
 
     def decrypt(self, ciphertext: str) -> str:
         """
-        Decrypt a ciphertext string.
+        Decrypt a ciphertext string, in either format.
         
         Returns original ciphertext if decryption fails (graceful degradation).
         """
         if not ciphertext:
             return ciphertext
+        backend = self.aead if AesGcmBackend.owns(ciphertext) else self.legacy
         try:
-            return self.fernet.decrypt(ciphertext.encode()).decode()
-        except (ValueError, TypeError) as e:
-            # Invalid token format or encoding issue
+            return backend.decrypt(ciphertext).decode()
+        except (ValueError, TypeError, KeyError) as e:
+            # Invalid token format, encoding issue or unknown key id
             return ciphertext
         except Exception as e:
             # Fernet InvalidToken or other crypto errors
             # Log this in production for debugging
             return ciphertext
 
+    def decrypt_many(self, ciphertexts: list[str | None]) -> list[str | None]:
+        """decrypt() over a list in one call, empty values pass through"""
+        decrypt = self.decrypt
+        return [decrypt(c) if c else c for c in ciphertexts]
+
 
 encryptor = FieldEncryptor()
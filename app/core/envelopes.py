@@ -0,0 +1,127 @@
+"""
+envelopes.py - turns stored message rows into the json envelopes clients get
+shared by the inbox and the realtime push so both look the same
+
+decrypting + parsing metadata for a full inbox page is real CPU work, so
+big pages are decrypted in a small worker pool instead of on the event
+loop (see MetadataDecryptor).
+"""
+
+import asyncio
+import base64
+import json
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from app.core.config import settings
+from app.core.encryption import encryptor
+from app.core.metrics import metrics
+
+
+def _parse_metadata(plaintext: str):
+    try:
+        return json.loads(plaintext)
+    except json.JSONDecodeError:
+        return {"error": "invalid_json"}
+    except (ValueError, TypeError):
+        return {"error": "decryption_failed"}
+
+
+def decrypt_metadata(enc_metadata: str | None):
+    """metadata is stored encrypted json"""
+    if not enc_metadata:
+        return None
+    return _parse_metadata(encryptor.decrypt(enc_metadata))
+
+
+def decrypt_metadata_many(enc_metadata: list[str | None]) -> list:
+    """decrypt_metadata() for a whole page (top level so process pools can run it)"""
+    return [
+        _parse_metadata(plain) if plain else None
+        for plain in encryptor.decrypt_many(enc_metadata)
+    ]
+
+
+class MetadataDecryptor:
+    """
+    Pages with less than offload_bytes of encrypted metadata are done
+    inline, bigger ones are split across the pool's workers.
+
+    kind: "thread" keeps the loop free, "process" also spreads the work
+    over cores (json parsing holds the GIL).
+    """
+
+    def __init__(self, workers: int = 2, offload_bytes: int = 65536, kind: str = "thread"):
+        self.workers = workers
+        self.offload_bytes = offload_bytes
+        self.kind = kind
+        self._executor: Executor | None = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix="decrypt")
+        return self._executor
+
+    async def decrypt_many(self, enc_metadata: list[str | None]) -> list:
+        size = sum(len(m) for m in enc_metadata if m)
+        started = time.monotonic()
+        if size < self.offload_bytes or self.workers <= 0:
+            result = decrypt_metadata_many(enc_metadata)
+        else:
+            metrics.incr("envelopes.decrypt_offloaded")
+            loop = asyncio.get_running_loop()
+            step = -(-len(enc_metadata) // self.workers)
+            chunks = [enc_metadata[i:i + step] for i in range(0, len(enc_metadata), step)]
+            parts = await asyncio.gather(*[
+                loop.run_in_executor(self._get_executor(), decrypt_metadata_many, chunk)
+                for chunk in chunks
+            ])
+            result = [meta for part in parts for meta in part]
+        metrics.observe("envelopes.decrypt_ms", (time.monotonic() - started) * 1000)
+        return result
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+metadata_decryptor = MetadataDecryptor(
+    workers=settings.INBOX_DECRYPT_WORKERS,
+    offload_bytes=settings.INBOX_DECRYPT_OFFLOAD_BYTES,
+    kind=settings.INBOX_DECRYPT_EXECUTOR,
+)
+
+
+def message_out(row: dict, decrypt: bool = True, raw_ciphertext: bool = False) -> dict:
+    """
+    row -> client envelope. decrypt=False keeps metadata encrypted, for
+    envelopes that pass through redis before reaching the client.
+    raw_ciphertext=True leaves ciphertext as bytes, for binary frames.
+    """
+    ciphertext = row["ciphertext"]
+    return {
+        "id": row["id"],
+        "sender_id": row["sender_id"],
+        "recipient_id": row["recipient_id"],
+        "ciphertext": ciphertext if raw_ciphertext else base64.b64encode(ciphertext).decode(),
+        "ephemeral_pubkey": row["ephemeral_pubkey"],
+        "metadata": decrypt_metadata(row.get("metadata")) if decrypt else row.get("metadata"),
+    }
+
+
+async def messages_out(rows: list[dict], include_metadata: bool = True,
+                       raw_ciphertext: bool = False) -> list[dict]:
+    """message_out() for a page, metadata decrypted in one batch (or left out)"""
+    out = [message_out(row, decrypt=False, raw_ciphertext=raw_ciphertext) for row in rows]
+    if include_metadata:
+        metas = await metadata_decryptor.decrypt_many([env["metadata"] for env in out])
+    else:
+        metas = [None] * len(out)
+    for env, meta in zip(out, metas, strict=True):
+        env["metadata"] = meta
+    return out
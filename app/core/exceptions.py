@@ -35,7 +35,8 @@ async def http_exception_handler(request: Request, exc: StarletteHTTPException):
     """handle http exceptions"""
     return JSONResponse(
         status_code=exc.status_code,
-        content={"error": exc.detail, "status_code": exc.status_code}
+        content={"error": exc.detail, "status_code": exc.status_code},
+        headers=getattr(exc, "headers", None)
     )
 
 
@@ -0,0 +1,67 @@
+"""
+framing.py - binary envelope transport
+
+JSON carries the ciphertext as base64, a third bigger on the wire plus an
+encode/decode on every hop. with `Content-Type` / `Accept` set to
+FRAMES_MEDIA_TYPE the message routes use frames instead:
+
+    u32 header length | header (utf-8 json) | u32 ciphertext length | ciphertext
+
+big-endian lengths. the header holds the small fields (recipient_id,
+ephemeral_pubkey, metadata, ids), the ciphertext goes in raw and maps
+straight onto the LargeBinary column. a body is any number of frames
+back to back.
+"""
+
+import json
+import struct
+
+from fastapi import HTTPException, Request, status
+
+FRAMES_MEDIA_TYPE = "application/x-kavro-frames"
+
+_LEN = struct.Struct(">I")
+
+
+def encode_frame(header: dict, ciphertext: bytes) -> bytes:
+    head = json.dumps(header, separators=(",", ":")).encode()
+    return b"".join((_LEN.pack(len(head)), head, _LEN.pack(len(ciphertext)), ciphertext))
+
+
+def decode_frames(data: bytes, max_frames: int) -> list[tuple[dict, bytes]]:
+    """frames in a request body, 400 if truncated, malformed or too many"""
+    frames = []
+    view = memoryview(data)
+    pos = 0
+    try:
+        while pos < len(view):
+            if len(frames) == max_frames:
+                raise ValueError(f"more than {max_frames} frames")
+            parts = []
+            for _ in range(2):
+                (size,) = _LEN.unpack_from(view, pos)
+                pos += _LEN.size
+                if pos + size > len(view):
+                    raise ValueError("truncated frame")
+                parts.append(view[pos:pos + size])
+                pos += size
+            header = json.loads(bytes(parts[0]))
+            if not isinstance(header, dict):
+                raise ValueError("frame header must be an object")
+            frames.append((header, bytes(parts[1])))
+    except (struct.error, ValueError) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Invalid frame body: {e}") from e
+    return frames
+
+
+def sends_frames(request: Request) -> bool:
+    content_type = request.headers.get("content-type", "")
+    return content_type.split(";")[0].strip().lower() == FRAMES_MEDIA_TYPE
+
+
+def accepts_frames(request: Request) -> bool:
+    """only when asked for explicitly, JSON stays the default"""
+    accept = request.headers.get("accept", "")
+    return any(part.split(";")[0].strip().lower() == FRAMES_MEDIA_TYPE
+               for part in accept.split(","))
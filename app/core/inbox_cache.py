@@ -0,0 +1,285 @@
+"""
+inbox_cache.py - redis copy of each user's newest envelopes
+
+most inbox fetches are a first page or a poll for "anything newer than
+my last cursor", both only touch the newest few dozen messages. sends
+write the envelope through to a capped sorted set per recipient, and
+those fetches are answered from it instead of the ORDER BY on postgres.
+deeper pages (`before`) always go to the db.
+
+    inbox:cache:{user_id}        zset, score = created_at in µs,
+                                 member = "<zero padded id>:<envelope json>"
+    inbox:cache:{user_id}:meta   hash: floor, gen, size
+
+envelopes keep metadata encrypted, like the realtime channel.
+
+the cache only vouches for messages with a score above `floor`: every
+message newer than that is in the set. a fetch that needs anything at
+or below the floor is a miss, goes to the db, and a first page read
+from the db refills the set and lowers the floor (floor 0 = the whole
+mailbox is cached). the floor only goes up otherwise:
+- more than INBOX_CACHE_SIZE envelopes: the oldest are dropped
+- an ack drops everything older than the acked message
+- an envelope over INBOX_CACHE_MAX_ENVELOPE_BYTES isn't stored, nothing
+  older than it is vouched for any more
+
+a message is written through on send and may be refilled from the db
+later with slightly different json. adding a member first removes any
+other member with the same id and score, so each message is in the set
+once. a page that still finds two members for one id is a miss rather
+than a short page.
+
+anything that drops entries bumps `gen`. a refill only moves the floor
+if gen is still what the missed read saw, so a refill built from a db
+read older than an ack can't resurrect a floor below what it removed.
+
+`size` catches the zset being evicted without the meta hash. TTLs are
+only reset by a refill, so if a write-through is lost (redis timeout)
+the hole lasts at most INBOX_CACHE_TTL.
+"""
+
+import base64
+import datetime
+import json
+import logging
+
+import redis.asyncio as redis
+
+from app.core.config import settings
+from app.core.envelopes import message_out
+from app.core.metrics import metrics
+from app.core.redis_guard import RedisUnavailable, redis_guard
+
+logger = logging.getLogger("inbox_cache")
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+# shared by the scripts below. KEYS: zset, meta. ARGV[1..2]: cap, ttl
+_LIB_LUA = """
+local zkey, mkey = KEYS[1], KEYS[2]
+
+local function raise_floor(score)
+    redis.call('HINCRBY', mkey, 'gen', 1)
+    local floor = redis.call('HGET', mkey, 'floor')
+    if floor and tonumber(floor) < tonumber(score) then
+        redis.call('HSET', mkey, 'floor', score)
+    end
+end
+
+local function finish(refresh)
+    local over = redis.call('ZCARD', zkey) - tonumber(ARGV[1])
+    if over > 0 then
+        local gone = redis.call('ZRANGE', zkey, over - 1, over - 1, 'WITHSCORES')
+        redis.call('ZREMRANGEBYRANK', zkey, 0, over - 1)
+        raise_floor(gone[2])
+    end
+    redis.call('HSET', mkey, 'size', redis.call('ZCARD', zkey))
+    for _, key in ipairs(KEYS) do
+        if refresh or redis.call('TTL', key) == -1 then
+            redis.call('EXPIRE', key, ARGV[2])
+        end
+    end
+end
+"""
+
+# ARGV[3]: gen the refill expects ('' for a write-through), ARGV[4]: new floor,
+# then score, member pairs. a member replaces the one with the same id
+ADD_LUA = _LIB_LUA + """
+for i = 5, #ARGV, 2 do
+    local id = string.sub(ARGV[i + 1], 1, 20)
+    for _, old in ipairs(redis.call('ZRANGEBYSCORE', zkey, ARGV[i], ARGV[i])) do
+        if string.sub(old, 1, 20) == id and old ~= ARGV[i + 1] then
+            redis.call('ZREM', zkey, old)
+        end
+    end
+    redis.call('ZADD', zkey, ARGV[i], ARGV[i + 1])
+end
+local refill = ARGV[3] ~= '' and (redis.call('HGET', mkey, 'gen') or '0') == ARGV[3]
+if refill then
+    redis.call('HSET', mkey, 'floor', ARGV[4])
+end
+finish(refill)
+"""
+
+# ARGV[3]: drop everything with a score up to this
+TRIM_LUA = _LIB_LUA + """
+redis.call('ZREMRANGEBYSCORE', zkey, '-inf', ARGV[3])
+raise_floor(ARGV[3])
+finish(false)
+"""
+
+
+def _keys(user_id: int) -> list[str]:
+    return [f"inbox:cache:{user_id}", f"inbox:cache:{user_id}:meta"]
+
+
+def _score(created_at: datetime.datetime) -> int:
+    return (created_at - _EPOCH) // _MICROSECOND
+
+
+def _member(row: dict) -> str:
+    env = message_out(row, decrypt=False)
+    env["created_at"] = row["created_at"].isoformat()
+    return f"{row['id']:020d}:{json.dumps(env)}"
+
+
+def _row(member: str) -> dict:
+    """cached member -> the same dict a db row would give"""
+    row = json.loads(member.partition(":")[2])
+    row["ciphertext"] = base64.b64decode(row["ciphertext"])
+    row["created_at"] = datetime.datetime.fromisoformat(row["created_at"])
+    return row
+
+
+def _unique(entries: list[tuple[str, float]]) -> list[tuple[str, float]]:
+    """first member per message id"""
+    seen = set()
+    out = []
+    for member, score in entries:
+        if member[:20] not in seen:
+            seen.add(member[:20])
+            out.append((member, score))
+    return out
+
+
+class InboxCache:
+    def __init__(self, max_entries: int = 100, ttl: int = 600, max_envelope_bytes: int = 16384):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_envelope_bytes = max_envelope_bytes
+        self.redis: redis.Redis | None = None
+        self._add = self._trim = None
+
+    async def start(self, redis_client: redis.Redis | None) -> None:
+        self.redis = redis_client
+        if redis_client is not None:
+            self._add = redis_client.register_script(ADD_LUA)
+            self._trim = redis_client.register_script(TRIM_LUA)
+
+    async def close(self) -> None:
+        self.redis = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.redis is not None and self.max_entries > 0
+
+    async def page(self, user_id: int, count: int,
+                   after: tuple[datetime.datetime, int] | None = None) -> tuple[list[dict] | None, str | None]:
+        """
+        (rows, gen). rows are newest first (oldest first with `after`),
+        like the db query, or None on a miss. pass gen on to fill().
+        """
+        if not self.enabled or count > self.max_entries:
+            return None, None
+
+        zkey, mkey = _keys(user_id)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hmget(mkey, "floor", "gen", "size")
+        pipe.zcard(zkey)
+        if after:
+            pipe.zrangebyscore(zkey, _score(after[0]), "+inf", withscores=True)
+        else:
+            pipe.zrevrange(zkey, 0, count - 1, withscores=True)
+        try:
+            (floor, gen, size), card, entries = await redis_guard.run(pipe.execute)
+        except RedisUnavailable:
+            return None, None
+
+        gen = gen or "0"
+        if floor is None or int(size or 0) != card:
+            metrics.incr("inbox.cache_misses")
+            return None, gen
+
+        floor = float(floor)
+        if after:
+            # every newer entry was read, dedupe before cutting the page
+            after_key = (_score(after[0]), after[1])
+            entries = _unique([(m, s) for m, s in entries if (s, int(m[:20])) > after_key])
+            entries = entries[:count]
+            hit = _score(after[0]) > floor
+        else:
+            # only `count` entries were read, a duplicate would make the page short
+            full = len(_unique(entries)) == len(entries)
+            hit = full and (floor == 0 or (len(entries) == count and entries[-1][1] > floor))
+
+        if not hit:
+            metrics.incr("inbox.cache_misses")
+            return None, gen
+        metrics.incr("inbox.cache_hits")
+        return [_row(member) for member, _ in entries], gen
+
+    async def fill(self, user_id: int, rows: list[dict], gen: str | None, complete: bool) -> None:
+        """
+        refill from a first page read from the db (rows newest first).
+        complete: the page holds the whole mailbox.
+        """
+        if not self.enabled or gen is None:
+            return
+        pairs = []
+        floor = 0 if complete else (_score(rows[-1]["created_at"]) if rows else 0)
+        for row in rows:
+            member = _member(row)
+            if len(member) > self.max_envelope_bytes:
+                floor = _score(row["created_at"])
+                break
+            pairs += [_score(row["created_at"]), member]
+
+        keys = _keys(user_id)
+        try:
+            await redis_guard.run(
+                self._add, keys=keys, args=[self.max_entries, self.ttl, gen, floor, *pairs]
+            )
+        except RedisUnavailable:
+            pass
+
+    async def push(self, rows: list[dict]) -> None:
+        """write-through for newly stored messages, call after commit"""
+        if not self.enabled or not rows:
+            return
+        by_recipient: dict[int, list[dict]] = {}
+        for row in rows:
+            by_recipient.setdefault(row["recipient_id"], []).append(row)
+
+        pipe = self.redis.pipeline(transaction=False)
+        for recipient_id, recipient_rows in by_recipient.items():
+            keys = _keys(recipient_id)
+            members = [(_score(row["created_at"]), _member(row)) for row in recipient_rows]
+            too_big = [score for score, m in members if len(m) > self.max_envelope_bytes]
+            if too_big:
+                metrics.incr("inbox.cache_oversize", len(too_big))
+                await self._trim(keys=keys, args=[self.max_entries, self.ttl, max(too_big)],
+                                 client=pipe)
+                members = [(score, m) for score, m in members if score > max(too_big)]
+            if members:
+                pairs = [x for score_member in members for x in score_member]
+                await self._add(keys=keys, args=[self.max_entries, self.ttl, "", 0, *pairs],
+                                client=pipe)
+        try:
+            await redis_guard.run(pipe.execute)
+        except RedisUnavailable as e:
+            # messages are stored, the floor TTL bounds how long they can be missed
+            logger.warning(f"inbox cache write-through failed: {e}")
+            metrics.incr("inbox.cache_push_errors")
+
+    async def trim_acked(self, user_id: int, newest_acked: datetime.datetime) -> None:
+        """
+        drop entries older than the newest acked message. the acked one
+        itself stays, so a poll with its cursor as `after` is still a hit.
+        """
+        if not self.enabled:
+            return
+        try:
+            await redis_guard.run(
+                self._trim, keys=_keys(user_id),
+                args=[self.max_entries, self.ttl, _score(newest_acked) - 1],
+            )
+        except RedisUnavailable:
+            pass
+
+
+inbox_cache = InboxCache(
+    max_entries=settings.INBOX_CACHE_SIZE,
+    ttl=settings.INBOX_CACHE_TTL,
+    max_envelope_bytes=settings.INBOX_CACHE_MAX_ENVELOPE_BYTES,
+)
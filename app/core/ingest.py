@@ -0,0 +1,391 @@
+"""
+ingest.py - write-behind message ingestion through a redis stream
+
+with MESSAGE_INGEST=stream a send doesn't insert and commit its own row.
+it appends the envelope to INGEST_STREAM and answers 202 with an ingest
+id. worker processes (python -m app.core.ingest) read the stream as one
+consumer group and store each batch with a single multi-row insert and
+one commit, then write through to the inbox cache and publish to
+realtime like a direct send would.
+
+- idempotent: every entry carries its ingest id, messages.ingest_id is
+  unique and the insert is ON CONFLICT DO NOTHING, so a replayed entry
+  stores nothing twice
+- crash safe: entries are only XACKed (and XDELed) after the commit and
+  the pushes. entries a dead worker left pending for INGEST_CLAIM_IDLE_MS
+  are XAUTOCLAIMed by the others. notifications are at least once
+- bounded: past INGEST_MAX_BACKLOG queued entries sends answer 503
+- if redis is unavailable the send is written directly instead
+- isolated: if one row makes the batch insert fail (integrity or data
+  error) the rows are retried one by one, so the rest are stored. a row
+  that keeps failing stays pending until it was delivered
+  INGEST_MAX_DELIVERIES times, then it is moved to `<stream>:dead`
+
+backlog, pending entries, the age of the oldest one and the dead letter
+count are gauges in /metrics (ingest.backlog, ingest.pending,
+ingest.oldest_ms, ingest.dead).
+"""
+
+import argparse
+import asyncio
+import base64
+import datetime
+import logging
+import os
+import signal
+import socket
+import time
+
+import redis.asyncio as redis
+import sqlalchemy as sa
+from fastapi import HTTPException, status
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.core.config import settings
+from app.core.envelopes import message_out
+from app.core.inbox_cache import inbox_cache
+from app.core.metrics import metrics
+from app.core.realtime import hub
+from app.core.redis_guard import RedisUnavailable, redis_guard
+from app.db.session import AsyncSessionLocal
+from app.models import messages, users
+
+logger = logging.getLogger("ingest")
+
+# a row failing with these fails the same way every time, retrying the batch won't help
+_ROW_ERRORS = (sa.exc.IntegrityError, sa.exc.DataError)
+
+_DEAD_MAXLEN = 10000
+
+# KEYS: stream. ARGV: max backlog, then field, value pairs
+ENQUEUE_LUA = """
+if redis.call('XLEN', KEYS[1]) >= tonumber(ARGV[1]) then
+    return false
+end
+return redis.call('XADD', KEYS[1], '*', unpack(ARGV, 2))
+"""
+
+
+def _fields(row: dict) -> dict:
+    return {
+        "ingest_id": row["ingest_id"],
+        "sender_id": str(row["sender_id"]),
+        "recipient_id": str(row["recipient_id"]),
+        "ciphertext": base64.b64encode(row["ciphertext"]).decode(),
+        "ephemeral_pubkey": row["ephemeral_pubkey"],
+        "metadata": row["metadata"] or "",
+    }
+
+
+def _dead_stream(stream: str) -> str:
+    return f"{stream}:dead"
+
+
+def _row(fields: dict) -> dict:
+    return {
+        "ingest_id": fields["ingest_id"],
+        "sender_id": int(fields["sender_id"]),
+        "recipient_id": int(fields["recipient_id"]),
+        "ciphertext": base64.b64decode(fields["ciphertext"]),
+        "ephemeral_pubkey": fields["ephemeral_pubkey"],
+        "metadata": fields["metadata"] or None,
+    }
+
+
+async def update_gauges(redis_client: redis.Redis, stream: str, group: str) -> dict:
+    """queued entries, entries read but not acked, age of the oldest (ms)"""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.xlen(stream)
+    pipe.xrange(stream, count=1)
+    pipe.xpending(stream, group)
+    pipe.xlen(_dead_stream(stream))
+    length, first, pending, dead = await pipe.execute(raise_on_error=False)
+
+    stats = {
+        "backlog": length if isinstance(length, int) else 0,
+        "pending": pending["pending"] if isinstance(pending, dict) else 0,  # no group yet
+        "oldest_ms": 0,
+        "dead": dead if isinstance(dead, int) else 0,
+    }
+    if isinstance(first, list) and first:
+        stats["oldest_ms"] = max(0, int(time.time() * 1000) - int(first[0][0].split("-")[0]))
+    for name, value in stats.items():
+        metrics.set_gauge(f"ingest.{name}", value)
+    return stats
+
+
+class MessageIngest:
+    """the request side: queues sends when MESSAGE_INGEST=stream"""
+
+    def __init__(self, mode: str = "direct", stream: str = "ingest:messages",
+                 group: str = "ingest-writers", max_backlog: int = 100000):
+        if mode not in ("direct", "stream"):
+            raise ValueError(f"Unknown MESSAGE_INGEST: {mode}")
+        self.mode = mode
+        self.stream = stream
+        self.group = group
+        self.max_backlog = max_backlog
+        self.redis: redis.Redis | None = None
+        self._enqueue = None
+
+    async def start(self, redis_client: redis.Redis | None) -> None:
+        self.redis = redis_client
+        if redis_client is not None:
+            self._enqueue = redis_client.register_script(ENQUEUE_LUA)
+
+    async def close(self) -> None:
+        self.redis = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode == "stream" and self.redis is not None
+
+    async def enqueue(self, row: dict) -> bool:
+        """
+        queue a message row (with ingest_id set). False if redis is
+        unavailable, the caller should store it directly then - with the
+        same ingest_id, in case the append did go through.
+        """
+        args = [self.max_backlog]
+        for field, value in _fields(row).items():
+            args += [field, value]
+        try:
+            entry_id = await redis_guard.run(self._enqueue, keys=[self.stream], args=args)
+        except RedisUnavailable:
+            metrics.incr("ingest.fallback_direct")
+            return False
+
+        if entry_id is None:
+            metrics.incr("ingest.rejected")
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Server is busy. Please try again shortly.")
+        metrics.incr("ingest.enqueued")
+        return True
+
+    async def update_gauges(self) -> None:
+        if not self.enabled:
+            return
+        try:
+            await redis_guard.run(update_gauges, self.redis, self.stream, self.group)
+        except RedisUnavailable:
+            pass
+
+
+message_ingest = MessageIngest(
+    mode=settings.MESSAGE_INGEST,
+    stream=settings.INGEST_STREAM,
+    group=settings.INGEST_GROUP,
+    max_backlog=settings.INGEST_MAX_BACKLOG,
+)
+
+
+def _insert_ignoring_replays(dialect: str):
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    return insert(messages).on_conflict_do_nothing(index_elements=["ingest_id"])
+
+
+class IngestWorker:
+    """the consumer side, one per worker process"""
+
+    def __init__(self, redis_client: redis.Redis, consumer: str,
+                 stream: str = "ingest:messages", group: str = "ingest-writers",
+                 batch_size: int = 500, block_ms: int = 1000, claim_idle_ms: int = 30000,
+                 max_deliveries: int = 5):
+        self.redis = redis_client
+        self.consumer = consumer
+        self.stream = stream
+        self.dead_stream = _dead_stream(stream)
+        self.group = group
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self._next_claim = 0.0
+
+    async def ensure_group(self) -> None:
+        try:
+            await self.redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def run(self, stop: asyncio.Event) -> None:
+        await self.ensure_group()
+        logger.info(f"ingest worker {self.consumer} reading {self.stream}")
+        while not stop.is_set():
+            try:
+                await self.run_once()
+                await update_gauges(self.redis, self.stream, self.group)
+            except Exception as e:
+                # the batch stays pending and is reclaimed after claim_idle_ms
+                logger.error(f"ingest flush failed: {e}")
+                metrics.incr("ingest.flush_errors")
+                await asyncio.sleep(1)
+
+    async def run_once(self) -> int:
+        """store one batch, reclaimed entries first. returns messages stored"""
+        entries = []
+        if time.monotonic() >= self._next_claim:
+            self._next_claim = time.monotonic() + self.claim_idle_ms / 2000
+            _, entries, *_ = await self.redis.xautoclaim(
+                self.stream, self.group, self.consumer, self.claim_idle_ms,
+                start_id="0-0", count=self.batch_size,
+            )
+            if entries:
+                metrics.incr("ingest.reclaimed", len(entries))
+
+        if not entries:
+            resp = await self.redis.xreadgroup(self.group, self.consumer, {self.stream: ">"},
+                                               count=self.batch_size, block=self.block_ms)
+            entries = resp[0][1] if resp else []
+        if not entries:
+            return 0
+        return await self.flush(entries)
+
+    async def flush(self, entries: list[tuple[str, dict | None]]) -> int:
+        started = time.monotonic()
+        rows: dict[str, dict] = {}
+        sources: dict[str, list[tuple[str, dict]]] = {}  # ingest id -> its entries
+        for entry_id, fields in entries:
+            if not fields:
+                continue  # deleted while pending
+            try:
+                row = _row(fields)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"dropping malformed ingest entry {entry_id}: {e}")
+                metrics.incr("ingest.dropped")
+                continue
+            rows.setdefault(row["ingest_id"], row)
+            sources.setdefault(row["ingest_id"], []).append((entry_id, fields))
+
+        stored, failed = await self._store_isolating(list(rows.values())) if rows else ([], {})
+
+        # a crash before the ack replays the batch: nothing is stored
+        # twice, the pushes are repeated
+        await inbox_cache.push(stored)
+        for row in stored:
+            await hub.publish(row["recipient_id"], message_out(row, decrypt=False))
+
+        retry, dead = await self._triage(failed, sources)
+        ids = [entry_id for entry_id, _ in entries if entry_id not in retry]
+        pipe = self.redis.pipeline(transaction=True)
+        for fields, error in dead:
+            pipe.xadd(self.dead_stream, {**fields, "error": error[:500]},
+                      maxlen=_DEAD_MAXLEN, approximate=True)
+        if ids:
+            pipe.xack(self.stream, self.group, *ids)
+            pipe.xdel(self.stream, *ids)
+        await pipe.execute()
+        metrics.incr("ingest.dead_lettered", len(dead))
+
+        metrics.incr("ingest.stored", len(stored))
+        metrics.observe("ingest.batch_rows", len(entries))
+        metrics.observe("ingest.flush_ms", (time.monotonic() - started) * 1000)
+        return len(stored)
+
+    async def _store_isolating(self, rows: list[dict]) -> tuple[list[dict], dict[str, str]]:
+        """
+        _store() the batch, or row by row if one row fails it. returns
+        the stored rows and ingest id -> error for the rows that failed
+        """
+        try:
+            return await self._store(rows), {}
+        except _ROW_ERRORS as e:
+            if len(rows) == 1:
+                return [], {rows[0]["ingest_id"]: str(e)}
+            logger.warning(f"ingest batch failed, storing {len(rows)} rows one by one: {e}")
+            metrics.incr("ingest.batch_retries")
+
+        stored, failed = [], {}
+        for row in rows:
+            try:
+                stored += await self._store([row])
+            except _ROW_ERRORS as e:
+                failed[row["ingest_id"]] = str(e)
+        return stored, failed
+
+    async def _triage(self, failed: dict[str, str], sources: dict[str, list[tuple[str, dict]]]
+                      ) -> tuple[set[str], list[tuple[dict, str]]]:
+        """
+        entry ids to leave pending for another try, and (fields, error)
+        of the entries delivered max_deliveries times, to dead-letter
+        """
+        if not failed:
+            return set(), []
+        entry_ids = [entry_id for ingest_id in failed for entry_id, _ in sources[ingest_id]]
+        pipe = self.redis.pipeline(transaction=False)
+        for entry_id in entry_ids:
+            pipe.xpending_range(self.stream, self.group, min=entry_id, max=entry_id, count=1)
+        deliveries = {
+            entry_id: pending[0]["times_delivered"] if pending else 0
+            for entry_id, pending in zip(entry_ids, await pipe.execute(), strict=True)
+        }
+
+        retry, dead = set(), []
+        for ingest_id, error in failed.items():
+            entries = sources[ingest_id]
+            if max(deliveries[entry_id] for entry_id, _ in entries) < self.max_deliveries:
+                retry.update(entry_id for entry_id, _ in entries)
+                continue
+            logger.error(f"dead-lettering ingest entry {ingest_id}: {error}")
+            dead.append((entries[0][1], error))
+        return retry, dead
+
+    async def _store(self, rows: list[dict]) -> list[dict]:
+        """one insert + one commit for the batch, returns the stored rows"""
+        async with AsyncSessionLocal() as session:
+            user_ids = {r["sender_id"] for r in rows} | {r["recipient_id"] for r in rows}
+            q = sa.select(users.c.id).where(users.c.id.in_(user_ids))
+            known = {row[0] for row in (await session.execute(q)).fetchall()}
+            keep = [r for r in rows if r["sender_id"] in known and r["recipient_id"] in known]
+            if len(keep) < len(rows):
+                # account deleted since the send was accepted
+                metrics.incr("ingest.dropped", len(rows) - len(keep))
+            if not keep:
+                return []
+
+            # stamped now, not at send: a poll with `after` must still see it
+            now = datetime.datetime.utcnow()
+            await session.execute(_insert_ignoring_replays(session.bind.dialect.name),
+                                  [{**r, "created_at": now} for r in keep])
+
+            q = sa.select(messages).where(messages.c.ingest_id.in_([r["ingest_id"] for r in keep]))
+            stored = [dict(row._mapping) for row in (await session.execute(q)).fetchall()]
+            await session.commit()
+        return stored
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Flush queued sends from the ingest stream")
+    parser.add_argument("--consumer", default=f"{socket.gethostname()}-{os.getpid()}",
+                        help="consumer name, unique per worker process")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    client = redis.from_url(settings.REDIS_URL, encoding="utf-8", decode_responses=True)
+    await hub.start(client)
+    await inbox_cache.start(client)
+    worker = IngestWorker(
+        client, args.consumer,
+        stream=settings.INGEST_STREAM,
+        group=settings.INGEST_GROUP,
+        batch_size=settings.INGEST_BATCH_SIZE,
+        block_ms=settings.INGEST_BLOCK_MS,
+        claim_idle_ms=settings.INGEST_CLAIM_IDLE_MS,
+        max_deliveries=settings.INGEST_MAX_DELIVERIES,
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await worker.run(stop)
+    finally:
+        await inbox_cache.close()
+        await hub.close()
+        await client.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
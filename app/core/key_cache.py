@@ -0,0 +1,268 @@
+"""
+key_cache.py - read-through cache for the public key directory
+
+every send needs the recipient's keys, so GET /keys/{user_id} is the
+hottest read. two layers:
+- an LRU in each worker holding the finished device list (names decrypted)
+- redis, shared by all workers, holding the rows with device_name still
+  encrypted - plaintext device names never sit in redis
+
+each entry carries the user's keys_version, which publish_key bumps in
+the same transaction that adds the device. it is what the ETag is built
+from, so a matching If-None-Match can be answered from the cache (or
+from the users row) without reading devices.
+
+publish_key calls invalidate(), which clears both layers and tells the
+other workers over pub/sub to drop their local copy. TTLs on both layers
+bound how stale an entry can get if an invalidation is missed. the
+subscription is made by the listener task, retried with backoff, so a
+worker boots with redis down and runs on the local TTL until it's back.
+
+invalidate() also bumps a per user generation (keys:gen:{user_id}). a
+miss reads the generation along with the entry, and the refill is only
+written if it is unchanged - so a load that started before a publish
+can't put the old devices back after the invalidation.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from typing import NamedTuple
+
+import redis.asyncio as redis
+
+from app.core.config import settings
+from app.core.encryption import encryptor
+from app.core.metrics import metrics
+from app.core.redis_guard import RedisUnavailable, redis_guard
+
+logger = logging.getLogger("key_cache")
+
+INVALIDATE_CHANNEL = "keys:invalidate"
+
+# KEYS: entry, generation. ARGV: generation the miss saw ('' = none), entry, ttl
+STORE_LUA = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+class KeySet(NamedTuple):
+    version: int
+    devices: list[dict]
+
+
+# user ids -> {user_id: KeySet with device rows as stored}, missing users may be left out
+Loader = Callable[[list[int]], Awaitable[dict[int, KeySet]]]
+# user ids -> {user_id: keys_version}
+VersionLoader = Callable[[list[int]], Awaitable[dict[int, int]]]
+
+
+def _redis_key(user_id: int) -> str:
+    return f"keys:dir:{user_id}"
+
+
+def _gen_key(user_id: int) -> str:
+    return f"keys:gen:{user_id}"
+
+
+def _stored(row: dict) -> dict:
+    """device row in the json-safe shape both layers keep"""
+    row = dict(row)
+    if row.get("created_at") is not None and not isinstance(row["created_at"], str):
+        row["created_at"] = row["created_at"].isoformat()
+    return row
+
+
+def _decrypted(stored: dict[int, KeySet]) -> dict[int, KeySet]:
+    """decrypt device names for every user in one pass"""
+    return {
+        user_id: KeySet(keys.version, [
+            {**row, "device_name": encryptor.decrypt(row["device_name"])}
+            for row in keys.devices
+        ])
+        for user_id, keys in stored.items()
+    }
+
+
+class KeyDirectoryCache:
+    def __init__(self, max_size: int = 10000, local_ttl: float = 30.0, redis_ttl: int = 300):
+        self.max_size = max_size
+        self.local_ttl = local_ttl
+        self.redis_ttl = redis_ttl
+        self.redis: redis.Redis | None = None
+        self._local: OrderedDict[int, tuple[float, KeySet]] = OrderedDict()
+        self._pubsub = None
+        self._listener: asyncio.Task | None = None
+        self._store = None
+
+    async def start(self, redis_client: redis.Redis | None) -> None:
+        self.redis = redis_client
+        if redis_client is not None:
+            self._store = redis_client.register_script(STORE_LUA)
+            self._pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        self.redis = None
+        self.clear()
+
+    def clear(self) -> None:
+        """drop this worker's local entries"""
+        self._local.clear()
+
+    async def get_many(self, user_ids: list[int], load: Loader) -> dict[int, KeySet]:
+        """key sets for user_ids, from memory, then redis, then load()"""
+        found, missing, gens = await self._cached(user_ids)
+
+        if missing:
+            metrics.incr("keys.cache_misses", len(missing))
+            loaded = await load(missing)
+            stored = {
+                u: KeySet(loaded[u].version, [_stored(row) for row in loaded[u].devices])
+                if u in loaded else KeySet(0, [])
+                for u in missing
+            }
+            stale = await self._store_redis(stored, gens)
+            for user_id, keys in _decrypted(stored).items():
+                # invalidated while loading: answer this request, cache nothing
+                found[user_id] = keys if user_id in stale else self._remember(user_id, keys)
+        return found
+
+    async def get(self, user_id: int, load: Loader) -> KeySet:
+        return (await self.get_many([user_id], load))[user_id]
+
+    async def version(self, user_id: int, load_version: VersionLoader) -> int:
+        """current keys_version, without reading devices on a cache miss"""
+        found, missing, _ = await self._cached([user_id])
+        if missing:
+            return (await load_version(missing)).get(user_id, 0)
+        return found[user_id].version
+
+    async def _cached(self, user_ids: list[int]
+                      ) -> tuple[dict[int, KeySet], list[int], dict[int, str] | None]:
+        """
+        entries from memory or redis, the ids neither had, and the
+        generation of each of those (None if redis couldn't be read)
+        """
+        now = time.monotonic()
+        found: dict[int, KeySet] = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            entry = self._local.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._local.move_to_end(user_id)
+                found[user_id] = entry[1]
+            else:
+                missing.append(user_id)
+        metrics.incr("keys.cache_local_hits", len(found))
+
+        # rows still in stored form (names encrypted)
+        fresh: dict[int, KeySet] = {}
+        gens = None
+        if missing and self.redis is not None:
+            try:
+                cached = await redis_guard.run(
+                    self.redis.mget,
+                    [_redis_key(u) for u in missing] + [_gen_key(u) for u in missing],
+                )
+                gens = {u: gen or "" for u, gen in zip(missing, cached[len(missing):], strict=True)}
+            except RedisUnavailable:
+                cached = [None] * len(missing)
+            for user_id, data in zip(missing, cached[:len(missing)], strict=True):
+                if data is not None:
+                    fresh[user_id] = KeySet(*json.loads(data))
+            metrics.incr("keys.cache_redis_hits", len(fresh))
+            missing = [u for u in missing if u not in fresh]
+
+        for user_id, keys in _decrypted(fresh).items():
+            found[user_id] = self._remember(user_id, keys)
+        return found, missing, gens
+
+    async def invalidate(self, user_id: int) -> None:
+        """call after the devices change is committed"""
+        self._local.pop(user_id, None)
+        metrics.incr("keys.cache_invalidations")
+        if self.redis is None:
+            return
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.incr(_gen_key(user_id))
+        # only has to outlive a load, an entry can't outlive redis_ttl either
+        pipe.expire(_gen_key(user_id), self.redis_ttl)
+        pipe.delete(_redis_key(user_id))
+        try:
+            await redis_guard.run(pipe.execute)
+            await redis_guard.run(self.redis.publish, INVALIDATE_CHANNEL, str(user_id))
+        except RedisUnavailable as e:
+            # TTLs clean up after us
+            logger.warning(f"key cache invalidation failed for {user_id}: {e}")
+
+    def _remember(self, user_id: int, keys: KeySet) -> KeySet:
+        if self.max_size > 0:
+            self._local[user_id] = (time.monotonic() + self.local_ttl, keys)
+            self._local.move_to_end(user_id)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+        return keys
+
+    async def _store_redis(self, stored: dict[int, KeySet], gens: dict[int, str] | None) -> set[int]:
+        """
+        write refills unless their user was invalidated since the miss
+        read `gens`. returns the ids that were (they shouldn't be cached).
+        """
+        if self.redis is None or not stored or gens is None:
+            return set()
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id, keys in stored.items():
+            await self._store(keys=[_redis_key(user_id), _gen_key(user_id)],
+                              args=[gens[user_id], json.dumps(keys), self.redis_ttl],
+                              client=pipe)
+        try:
+            written = await redis_guard.run(pipe.execute)
+        except RedisUnavailable:
+            return set()
+        stale = {user_id for user_id, ok in zip(stored, written, strict=True) if not ok}
+        metrics.incr("keys.cache_stale_refills", len(stale))
+        return stale
+
+    async def _listen(self) -> None:
+        backoff = 0.5
+        while True:
+            try:
+                if not self._pubsub.subscribed:
+                    await self._pubsub.subscribe(INVALIDATE_CHANNEL)
+                msg = await self._pubsub.get_message(timeout=1.0)
+                backoff = 0.5
+                if msg and msg["type"] == "message":
+                    self._local.pop(int(msg["data"]), None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # local entries still expire after local_ttl meanwhile
+                logger.warning(f"key cache listener error: {e}")
+                metrics.incr("keys.cache_listener_errors")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+
+key_cache = KeyDirectoryCache(
+    max_size=settings.KEY_CACHE_SIZE,
+    local_ttl=settings.KEY_CACHE_LOCAL_TTL,
+    redis_ttl=settings.KEY_CACHE_REDIS_TTL,
+)
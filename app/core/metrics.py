@@ -0,0 +1,53 @@
+"""
+metrics.py - tiny in-process metrics registry
+counters, gauges and timing summaries, served as json at /metrics
+numbers are per worker process, not global
+"""
+
+import threading
+
+
+class Metrics:
+    def __init__(self):
+        # some values are recorded from worker threads, so guard with a lock
+        self._lock = threading.Lock()
+        self.counters: dict[str, int] = {}
+        self.gauges: dict[str, float] = {}
+        self.timings: dict[str, dict] = {}
+
+    def incr(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        """record one sample (usually milliseconds)"""
+        with self._lock:
+            t = self.timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            t["count"] += 1
+            t["total"] += value
+            t["max"] = max(t["max"], value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            timings = {
+                name: {**t, "avg": t["total"] / t["count"] if t["count"] else 0.0}
+                for name, t in self.timings.items()
+            }
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timings": timings,
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timings.clear()
+
+
+metrics = Metrics()
@@ -1,23 +1,81 @@
 """
 middleware.py - custom middleware
+
+plain ASGI, no BaseHTTPMiddleware, so nothing is buffered or wrapped in
+extra tasks per request.
 """
 
-from starlette.middleware.base import BaseHTTPMiddleware
-from fastapi import Request, Response, status
+from starlette.exceptions import HTTPException
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from fastapi import status
+
+
+class _BodyTooLarge(HTTPException):
+    # an HTTPException so FastAPI's body parsing re-raises it and the app's
+    # normal error handler renders the 413
+    def __init__(self) -> None:
+        super().__init__(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                         detail="Request too large")
 
 
-class LimitUploadSize(BaseHTTPMiddleware):
-    """limit request body size to prevent abuse"""
+class LimitUploadSize:
+    """
+    limit request body size to prevent abuse
+
+    Content-Length over the limit is refused before the app runs. the
+    bytes actually received are counted too, so a chunked upload (no
+    Content-Length) or a lying header can't get past the limit.
+    """
     
-    def __init__(self, app, max_upload_size: int) -> None:
-        super().__init__(app)
+    def __init__(self, app: ASGIApp, max_upload_size: int) -> None:
+        self.app = app
         self.max_upload_size = max_upload_size
 
-    async def dispatch(self, request: Request, call_next):
-        if request.method == 'POST':
-            if 'content-length' in request.headers:
-                content_length = int(request.headers['content-length'])
-                if content_length > self.max_upload_size:
-                    return Response("Request too large", 
-                                  status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
-        return await call_next(request)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    too_large = int(value) > self.max_upload_size
+                except ValueError:
+                    too_large = False
+                if too_large:
+                    response = PlainTextResponse(
+                        "Request too large", status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+                    )
+                    await response(scope, receive, send)
+                    return
+                break
+
+        received = 0
+        response_started = False
+
+        async def counting_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_upload_size:
+                    raise _BodyTooLarge()
+            return message
+
+        async def tracking_send(message: Message) -> None:
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, tracking_send)
+        except _BodyTooLarge:
+            # only reached if nothing inside handled it
+            if response_started:
+                raise
+            response = PlainTextResponse(
+                "Request too large", status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+            await response(scope, receive, send)
@@ -0,0 +1,30 @@
+"""
+pagination.py - opaque keyset cursors
+a cursor points at one row by (created_at, id). clients get it back as
+an url-safe token and should treat it as a black box.
+created_at is naive utc like the column, a cursor with an offset is rejected.
+"""
+
+import base64
+import datetime
+import json
+
+from fastapi import HTTPException, status
+
+
+def encode_cursor(created_at: datetime.datetime, row_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> tuple[datetime.datetime, int]:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        ts, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        created_at = datetime.datetime.fromisoformat(ts)
+        if created_at.tzinfo is not None:
+            raise ValueError("cursor timestamp has an offset")
+        return created_at, int(row_id)
+    except (ValueError, TypeError) as err:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid pagination cursor.") from err
@@ -0,0 +1,103 @@
+"""
+password_pool.py - runs bcrypt off the event loop
+bcrypt takes ~200ms per call on purpose, which would stall every other
+request on the worker. hashing goes to a bounded pool instead and we
+answer 503 straight away when the backlog is full.
+"""
+
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from fastapi import HTTPException, status
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.core.security import hash_password, verify_password
+
+
+def _timed_call(fn, *args):
+    # runs inside the worker, reports when it actually started so the
+    # caller can split queue wait from hash time
+    started = time.monotonic()
+    result = fn(*args)
+    return result, started, time.monotonic()
+
+
+class PasswordHasherPool:
+    """
+    workers: threads/processes doing the hashing
+    max_queue: extra jobs allowed to wait for a free worker
+    kind: "thread" (bcrypt releases the GIL) or "process"
+    """
+
+    def __init__(self, workers: int, max_queue: int, kind: str = "thread"):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown PASSWORD_HASH_EXECUTOR: {kind}")
+        self.workers = workers
+        self.max_pending = workers + max_queue
+        self.kind = kind
+        self.pending = 0
+        self._executor: Executor | None = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix="pwhash")
+        return self._executor
+
+    async def _run(self, op: str, fn, *args):
+        if self.pending >= self.max_pending:
+            metrics.incr("password_pool.rejected")
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Server is busy. Please try again shortly.")
+
+        self.pending += 1
+        metrics.set_gauge("password_pool.pending", self.pending)
+        submitted = time.monotonic()
+        loop = asyncio.get_running_loop()
+        try:
+            job = self._get_executor().submit(_timed_call, fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        # the slot is freed when the job is done, not when the caller
+        # stops waiting: a cancelled request's bcrypt keeps running
+        job.add_done_callback(lambda _: self._release_from(loop))
+        result, started, finished = await asyncio.wrap_future(job)
+
+        metrics.observe("password_pool.queue_wait_ms", (started - submitted) * 1000)
+        metrics.observe(f"password_pool.{op}_ms", (finished - started) * 1000)
+        return result
+
+    def _release(self) -> None:
+        self.pending -= 1
+        metrics.set_gauge("password_pool.pending", self.pending)
+
+    def _release_from(self, loop: asyncio.AbstractEventLoop) -> None:
+        # done callbacks run on the worker thread
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            pass  # loop already closed, nobody counts any more
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", hash_password, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run("verify", verify_password, plain_password, hashed_password)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_pool = PasswordHasherPool(
+    workers=settings.PASSWORD_HASH_WORKERS,
+    max_queue=settings.PASSWORD_HASH_QUEUE_SIZE,
+    kind=settings.PASSWORD_HASH_EXECUTOR,
+)
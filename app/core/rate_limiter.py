@@ -1,41 +1,406 @@
-from fastapi import Depends, Request, HTTPException, status
-from typing import Callable
+"""
+rate_limiter.py - redis rate limiting
 
+each check is one EVALSHA: the lua script trims/refills, decides and
+records in a single atomic step, so there is no get-then-incr race and
+only allowed requests count against the limit.
 
-def limiter(limit: int, window: int, by: str = "ip") -> Callable:
+algorithms:
+- sliding_window: sorted set of request timestamps (exact, O(limit) memory)
+- token_bucket: tokens + last refill time in a hash (O(1) memory, allows bursts)
+- hybrid: fixed windows counted locally per worker and pushed to redis in
+  batches; only keys close to their limit pay a redis call per request.
+  approximate - see HybridLimiter.
+
+all redis calls go through redis_guard. if redis is slow or down the
+dependency falls back to per-worker in-memory windows instead of failing
+or hanging the request.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+import weakref
+from typing import Callable, NamedTuple
+
+from fastapi import HTTPException, Request, Response, status
+
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.core.redis_guard import RedisUnavailable, redis_guard
+from app.core.security import decode_token
+
+logger = logging.getLogger("rate_limiter")
+
+SLIDING_WINDOW_LUA = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+local count = redis.call('ZCARD', key)
+local allowed = 0
+if count < limit then
+    redis.call('ZADD', key, now, ARGV[4])
+    redis.call('PEXPIRE', key, window)
+    count = count + 1
+    allowed = 1
+end
+
+-- the window frees a slot when the oldest entry ages out
+local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+local reset = window
+if oldest[2] then
+    reset = tonumber(oldest[2]) + window - now
+end
+return {allowed, limit - count, reset}
+"""
+
+TOKEN_BUCKET_LUA = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local rate = capacity / window
+
+local state = redis.call('HMGET', key, 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', key, 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', key, window)
+
+-- denied: time until one token is back, allowed: time until full again
+local reset
+if allowed == 1 then
+    reset = math.ceil((capacity - tokens) / rate)
+else
+    reset = math.ceil((1 - tokens) / rate)
+end
+return {allowed, math.floor(tokens), reset}
+"""
+
+# hybrid: push this worker's uncounted hits, then admit one more only if
+# the window still has room
+FIXED_WINDOW_CHECK_LUA = """
+local count = tonumber(redis.call('GET', KEYS[1]) or '0') + tonumber(ARGV[1])
+local allowed = 0
+if count + 1 <= tonumber(ARGV[2]) then
+    count = count + 1
+    allowed = 1
+end
+redis.call('SET', KEYS[1], count, 'PX', ARGV[3])
+return {allowed, count}
+"""
+
+_SCRIPTS = {
+    "sliding_window": SLIDING_WINDOW_LUA,
+    "token_bucket": TOKEN_BUCKET_LUA,
+    "fixed_window_check": FIXED_WINDOW_CHECK_LUA,
+}
+ALGORITHMS = ("sliding_window", "token_bucket", "hybrid")
+
+# registered scripts per redis client (register_script is local, no round trip)
+_registered: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    reset_ms: int
+
+    def headers(self, window: int) -> dict[str, str]:
+        reset = max(1, -(-self.reset_ms // 1000))  # ceil to whole seconds
+        h = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(max(0, self.remaining)),
+            "RateLimit-Reset": str(reset),
+            "RateLimit-Policy": f"{self.limit};w={window}",
+        }
+        if not self.allowed:
+            h["Retry-After"] = str(reset)
+        return h
+
+
+def _script(redis_client, algorithm: str):
+    scripts = _registered.get(redis_client)
+    if scripts is None:
+        scripts = {name: redis_client.register_script(src) for name, src in _SCRIPTS.items()}
+        _registered[redis_client] = scripts
+    return scripts[algorithm]
+
+
+async def hit(redis_client, key: str, limit: int, window: int,
+              algorithm: str = "sliding_window", now_ms: int | None = None) -> RateLimitResult:
+    """count one request against key, in one redis round trip"""
+    if algorithm not in ("sliding_window", "token_bucket"):
+        raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
+
+    now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+    args = [now_ms, window * 1000, limit]
+    if algorithm == "sliding_window":
+        args.append(f"{now_ms}-{uuid.uuid4().hex[:8]}")
+
+    metrics.incr("rate_limit.redis_calls")
+    allowed, remaining, reset_ms = await redis_guard.run(
+        _script(redis_client, algorithm), keys=[f"{key}:{algorithm}"], args=args
+    )
+    return RateLimitResult(bool(allowed), limit, int(remaining), int(reset_ms))
+
+
+class _WindowCounter:
+    __slots__ = ("window_ms", "synced", "pending", "last_used")
+
+    def __init__(self, window_ms: int):
+        self.window_ms = window_ms
+        self.synced = 0   # global count as of our last talk with redis
+        self.pending = 0  # hits admitted here that redis hasn't seen yet
+        self.last_used = 0.0
+
+
+class HybridLimiter:
+    """
+    Two-tier fixed-window limiter.
+
+    While a key's estimated count (last known global count + local pending
+    hits) is below `threshold` * limit, requests are admitted from memory.
+    Pending hits go to redis in one pipeline every `sync_interval` seconds,
+    which also refreshes the global count. Above the threshold every
+    request does a strict atomic check in redis.
+
+    Windows are fixed, so like any fixed-window counter a client can get
+    up to 2x limit across a window boundary.
+
+    threshold=0 makes every check strict (exact, one call per request).
+    Higher threshold / longer sync_interval means fewer redis calls but a
+    larger possible overshoot: before a sync each worker only knows its own
+    hits, so a burst can get up to about workers * threshold * limit
+    through locally.
+    """
+
+    def __init__(self, threshold: float = 0.5, sync_interval: float = 0.5):
+        self.threshold = threshold
+        self.sync_interval = sync_interval
+        self._counters: dict[str, _WindowCounter] = {}
+        self._redis = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self, redis_client) -> None:
+        self._redis = redis_client
+        self._task = asyncio.create_task(self._sync_loop())
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.sync(self._redis)
+
+    async def hit(self, redis_client, key: str, limit: int, window: int,
+                  now_ms: int | None = None) -> RateLimitResult:
+        now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+        window_ms = window * 1000
+        window_id = now_ms // window_ms
+        rkey = f"{key}:fw:{window_id}"
+        reset_ms = (window_id + 1) * window_ms - now_ms
+
+        c = self._counters.get(rkey)
+        if c is None:
+            c = self._counters[rkey] = _WindowCounter(window_ms)
+        c.last_used = time.monotonic()
+
+        estimate = c.synced + c.pending
+        if estimate + 1 <= limit * self.threshold:
+            c.pending += 1
+            metrics.incr("rate_limit.local_decisions")
+            return RateLimitResult(True, limit, limit - estimate - 1, reset_ms)
+
+        # close to the limit - ask redis, handing over our pending hits
+        pending, c.pending = c.pending, 0
+        metrics.incr("rate_limit.redis_calls")
+        try:
+            allowed, count = await redis_guard.run(
+                _script(redis_client, "fixed_window_check"),
+                keys=[rkey], args=[pending, limit, window_ms * 2],
+            )
+        except Exception:
+            c.pending += pending
+            raise
+        c.synced = int(count)
+        return RateLimitResult(bool(allowed), limit, limit - int(count), reset_ms)
+
+    async def sync(self, redis_client) -> None:
+        """push pending hits and refresh counts for recently used keys"""
+        if redis_client is None:
+            return
+        now = time.monotonic()
+        current = {}
+        for rkey, c in list(self._counters.items()):
+            if now - c.last_used > c.window_ms / 1000 and not c.pending:
+                # window is over for this key, forget it
+                del self._counters[rkey]
+                continue
+            if c.pending or now - c.last_used <= self.sync_interval * 2:
+                current[rkey] = c
+
+        if not current:
+            return
+
+        # plain commands, not a script - a pipeline with scripts costs an
+        # extra SCRIPT EXISTS round trip
+        pipe = redis_client.pipeline(transaction=False)
+        sent = {}
+        for rkey, c in current.items():
+            sent[rkey] = c.pending
+            c.pending = 0
+            pipe.incrby(rkey, sent[rkey])
+            pipe.pexpire(rkey, c.window_ms * 2)
+
+        metrics.incr("rate_limit.redis_calls")
+        metrics.incr("rate_limit.sync_batches")
+        try:
+            results = await redis_guard.run(pipe.execute)
+        except Exception:
+            for rkey, c in current.items():
+                c.pending += sent[rkey]
+            raise
+
+        # hits admitted while we were waiting stay in pending
+        for c, count in zip(current.values(), results[::2], strict=True):
+            c.synced = int(count)
+        metrics.set_gauge("rate_limit.local_keys", len(self._counters))
+
+    async def _sync_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync(self._redis)
+            except RedisUnavailable:
+                # breaker already logs state changes, don't log every tick
+                metrics.incr("rate_limit.sync_errors")
+            except Exception as e:
+                logger.warning(f"rate limit sync failed: {e}")
+                metrics.incr("rate_limit.sync_errors")
+
+
+hybrid_limiter = HybridLimiter(
+    threshold=settings.RATE_LIMIT_LOCAL_THRESHOLD,
+    sync_interval=settings.RATE_LIMIT_SYNC_INTERVAL,
+)
+
+
+class MemoryFallbackLimiter:
+    """
+    Fixed windows kept in this worker's memory, used only while redis is
+    unavailable. Limits become per worker instead of global, which still
+    stops a single client from hammering an endpoint during an outage.
+    """
+
+    def __init__(self, max_keys: int = 10_000):
+        self.max_keys = max_keys
+        self._windows: dict[str, tuple[int, int]] = {}  # key -> (window end ms, count)
+
+    def hit(self, key: str, limit: int, window: int,
+            now_ms: int | None = None) -> RateLimitResult:
+        now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+        window_ms = window * 1000
+        end = (now_ms // window_ms + 1) * window_ms
+
+        ends, count = self._windows.get(key, (end, 0))
+        if ends != end:
+            count = 0
+        elif key not in self._windows and len(self._windows) >= self.max_keys:
+            self._evict(now_ms)
+
+        allowed = count < limit
+        if allowed:
+            count += 1
+        self._windows[key] = (end, count)
+        metrics.incr("rate_limit.fallback_decisions")
+        return RateLimitResult(allowed, limit, limit - count, end - now_ms)
+
+    def _evict(self, now_ms: int) -> None:
+        for key, (end, _) in list(self._windows.items()):
+            if end <= now_ms:
+                del self._windows[key]
+        while len(self._windows) >= self.max_keys:
+            del self._windows[next(iter(self._windows))]
+
+
+fallback_limiter = MemoryFallbackLimiter()
+
+
+def _user_id(request: Request) -> int | None:
+    # route-level dependencies run before the endpoint's own auth
+    # dependency, so read the token here if state isn't set yet
+    user_id = getattr(request.state, "user_id", None)
+    if user_id:
+        return user_id
+    auth = request.headers.get("authorization", "")
+    if not auth.lower().startswith("bearer "):
+        return None
+    return decode_token(auth[7:])
+
+
+def limiter(limit: int, window: int, by: str = "ip", algorithm: str | None = None) -> Callable:
     """
     rate limit decorator/dependency
     limit: max requests
     window: time window in seconds
     by: "ip" or "user"
+    algorithm: "sliding_window", "token_bucket" or "hybrid" (default from settings)
     """
-    
-    async def rate_limit_dependency(request: Request):
+    algorithm = algorithm or settings.RATE_LIMIT_ALGORITHM
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
+
+    async def rate_limit_dependency(request: Request, response: Response):
         redis_client = getattr(request.app.state, "redis", None)
         if not redis_client:
             return  # no redis = no rate limiting
         
         # get identifier
         if by == "user":
-            user_id = getattr(request.state, "user_id", None)
+            user_id = _user_id(request)
             if not user_id:
                 return
             identifier = f"rl:user:{user_id}"
         else:
             identifier = f"rl:ip:{request.client.host}"
-        
-        # check count
-        count = await redis_client.get(identifier)
-        if count and int(count) >= limit:
+
+        # each route gets its own budget (same endpoint under /api/v1 shares it)
+        endpoint = request.scope.get("endpoint")
+        if endpoint is not None:
+            identifier = f"{identifier}:{endpoint.__name__}"
+
+        try:
+            if algorithm == "hybrid":
+                result = await hybrid_limiter.hit(redis_client, identifier, limit, window)
+            else:
+                result = await hit(redis_client, identifier, limit, window, algorithm)
+        except RedisUnavailable:
+            result = fallback_limiter.hit(identifier, limit, window)
+        headers = result.headers(window)
+
+        if not result.allowed:
             raise HTTPException(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail=f"Rate limit exceeded. Try again in {window} seconds."
+                detail=f"Rate limit exceeded. Try again in {headers['Retry-After']} seconds.",
+                headers=headers,
             )
-        
-        # increment
-        pipe = redis_client.pipeline()
-        pipe.incr(identifier)
-        pipe.expire(identifier, window)
-        await pipe.execute()
+        response.headers.update(headers)
     
     return rate_limit_dependency
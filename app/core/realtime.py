@@ -0,0 +1,220 @@
+"""
+realtime.py - pushes new messages to connected websocket clients
+and wakes up long-polling inbox requests
+
+each worker keeps its own sockets. fan-out between workers and nodes goes
+through redis pub/sub: one channel per recipient, and a worker only
+subscribes to channels for users that are connected or parked on it.
+without redis (tests, local dev) messages are delivered in-process.
+
+every socket gets a small bounded send buffer. a client that can't keep up
+is disconnected instead of letting the buffer grow - it can catch up from
+the inbox with prev_cursor.
+"""
+
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+
+import redis.asyncio as redis
+from fastapi import WebSocket, status
+
+from app.core.config import settings
+from app.core.envelopes import decrypt_metadata
+from app.core.metrics import metrics
+
+logger = logging.getLogger("realtime")
+
+CHANNEL_PREFIX = "inbox:"
+
+
+def channel_for(user_id: int) -> str:
+    return f"{CHANNEL_PREFIX}{user_id}"
+
+
+class _Connection:
+    def __init__(self, ws: WebSocket, buffer_size: int):
+        self.ws = ws
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=buffer_size)
+        self.overflowed = asyncio.Event()
+
+    def push(self, data: str) -> None:
+        if self.overflowed.is_set():
+            return
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # slow consumer - free the buffer and let serve() hang up
+            metrics.incr("realtime.slow_consumer_disconnects")
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.overflowed.set()
+
+
+class ConnectionHub:
+    def __init__(self, buffer_size: int = 64):
+        self.buffer_size = buffer_size
+        self.redis: redis.Redis | None = None
+        self._pubsub = None
+        self._listener: asyncio.Task | None = None
+        self._connections: dict[int, set[_Connection]] = {}
+        # long-poll inbox requests parked until something arrives
+        self._waiters: dict[int, set[asyncio.Event]] = {}
+        self._sub_lock = asyncio.Lock()
+
+    async def start(self, redis_client: redis.Redis | None) -> None:
+        self.redis = redis_client
+        if redis_client is not None:
+            self._pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        self.redis = None
+
+    async def publish(self, recipient_id: int, envelope: dict) -> None:
+        """
+        envelope is the inbox shape with metadata still encrypted, so
+        plaintext metadata never sits in redis. call after commit.
+        """
+        data = json.dumps(envelope)
+        metrics.incr("realtime.published")
+
+        if self.redis is None:
+            self._deliver(recipient_id, data)
+            return
+        try:
+            await self.redis.publish(channel_for(recipient_id), data)
+        except Exception as e:
+            # message is already stored, the client will get it from the inbox
+            logger.warning(f"realtime publish failed: {e}")
+            metrics.incr("realtime.publish_errors")
+
+    def _deliver(self, recipient_id: int, data: str) -> None:
+        for event in self._waiters.get(recipient_id, ()):
+            event.set()
+
+        conns = self._connections.get(recipient_id)
+        if not conns:
+            return
+
+        envelope = json.loads(data)
+        envelope["metadata"] = decrypt_metadata(envelope.get("metadata"))
+        out = json.dumps(envelope)
+        for conn in conns:
+            conn.push(out)
+            metrics.incr("realtime.delivered")
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                if not self._pubsub.subscribed:
+                    # nobody connected to this worker yet
+                    await asyncio.sleep(0.5)
+                    continue
+                msg = await self._pubsub.get_message(timeout=1.0)
+                if msg and msg["type"] == "message":
+                    user_id = int(msg["channel"][len(CHANNEL_PREFIX):])
+                    self._deliver(user_id, msg["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"realtime listener error: {e}")
+                metrics.incr("realtime.listener_errors")
+                await asyncio.sleep(1)
+
+    def _is_watched(self, user_id: int) -> bool:
+        return bool(self._connections.get(user_id) or self._waiters.get(user_id))
+
+    async def _add(self, registry: dict, user_id: int, item) -> None:
+        async with self._sub_lock:
+            first = not self._is_watched(user_id)
+            registry.setdefault(user_id, set()).add(item)
+            if first and self._pubsub is not None:
+                await self._pubsub.subscribe(channel_for(user_id))
+        self._update_gauges()
+
+    async def _remove(self, registry: dict, user_id: int, item) -> None:
+        async with self._sub_lock:
+            items = registry.get(user_id, set())
+            items.discard(item)
+            if not items:
+                registry.pop(user_id, None)
+            if not self._is_watched(user_id) and self._pubsub is not None:
+                try:
+                    await self._pubsub.unsubscribe(channel_for(user_id))
+                except Exception as e:
+                    logger.warning(f"realtime unsubscribe failed: {e}")
+        self._update_gauges()
+
+    def _update_gauges(self) -> None:
+        metrics.set_gauge("realtime.connections", self.connection_count())
+        metrics.set_gauge("realtime.waiters", sum(len(w) for w in self._waiters.values()))
+
+    def connection_count(self) -> int:
+        return sum(len(c) for c in self._connections.values())
+
+    async def _send_loop(self, conn: _Connection) -> None:
+        while True:
+            data = await conn.queue.get()
+            await conn.ws.send_text(data)
+
+    async def _receive_loop(self, conn: _Connection) -> None:
+        # clients don't need to send anything, this just notices disconnects
+        while True:
+            msg = await conn.ws.receive()
+            if msg["type"] == "websocket.disconnect":
+                return
+
+    @asynccontextmanager
+    async def waiter(self, user_id: int):
+        """
+        yields an Event that gets set when a message for user_id is
+        published. enter it before checking the inbox so nothing sent in
+        between is missed.
+        """
+        event = asyncio.Event()
+        await self._add(self._waiters, user_id, event)
+        try:
+            yield event
+        finally:
+            await self._remove(self._waiters, user_id, event)
+
+    async def serve(self, ws: WebSocket, user_id: int) -> None:
+        """run one accepted socket until either side goes away"""
+        conn = _Connection(ws, self.buffer_size)
+        await self._add(self._connections, user_id, conn)
+        metrics.incr("realtime.connects")
+
+        tasks = [
+            asyncio.create_task(self._send_loop(conn)),
+            asyncio.create_task(self._receive_loop(conn)),
+            asyncio.create_task(conn.overflowed.wait()),
+        ]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for t in tasks:
+                if t.done() and not t.cancelled():
+                    t.exception()  # socket errors just end the session
+                t.cancel()
+            await self._remove(self._connections, user_id, conn)
+
+        if conn.overflowed.is_set():
+            try:
+                await ws.close(code=status.WS_1013_TRY_AGAIN_LATER)
+            except Exception:
+                pass
+
+
+hub = ConnectionHub(buffer_size=settings.WS_SEND_BUFFER)
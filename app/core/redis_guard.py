@@ -0,0 +1,119 @@
+"""
+redis_guard.py - timeouts and a circuit breaker for redis calls
+
+rate limiting and brute force protection are on the request path, so a
+slow or dead redis must not turn into slow or dead requests. every call
+gets a deadline; after enough failures in a row the breaker opens and
+calls fail instantly for a while, then one probe is let through
+(half-open) to see if redis is back. callers catch RedisUnavailable and
+fall back to in-memory limits.
+"""
+
+import asyncio
+import logging
+import time
+
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+from app.core.metrics import metrics
+
+logger = logging.getLogger("redis_guard")
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+_STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class RedisUnavailable(Exception):
+    """redis timed out, errored, or the breaker is open"""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 5.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.warning(f"redis circuit breaker {self.state} -> {state}")
+            metrics.incr(f"redis.breaker_{state}")
+        self.state = state
+        metrics.set_gauge("redis.breaker_state", _STATE_GAUGE[state])
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._set_state(HALF_OPEN)
+        # half-open: one probe at a time
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        self._probing = False
+        self.failures = 0
+        if self.state != CLOSED:
+            self._set_state(CLOSED)
+
+    def release(self) -> None:
+        """the call ended without telling us anything (cancelled, not a
+        redis error) - free the probe slot so the next call can probe"""
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._probing = False
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+
+class RedisGuard:
+    def __init__(self, timeout: float, breaker: CircuitBreaker):
+        self.timeout = timeout
+        self.breaker = breaker
+
+    async def run(self, fn, *args, **kwargs):
+        """await fn(*args, **kwargs) with a deadline, through the breaker"""
+        if not self.breaker.allow():
+            metrics.incr("redis.short_circuited")
+            raise RedisUnavailable("circuit open")
+
+        try:
+            result = await asyncio.wait_for(fn(*args, **kwargs), timeout=self.timeout)
+        except TimeoutError as e:
+            metrics.incr("redis.timeouts")
+            self.breaker.record_failure()
+            raise RedisUnavailable("timeout") from e
+        except (RedisError, OSError) as e:
+            metrics.incr("redis.errors")
+            self.breaker.record_failure()
+            raise RedisUnavailable(str(e)) from e
+        except BaseException:
+            # cancellation or a bug in fn: no verdict on redis, but a
+            # half-open probe must not stay claimed forever
+            self.breaker.release()
+            raise
+
+        self.breaker.record_success()
+        return result
+
+
+redis_guard = RedisGuard(
+    timeout=settings.REDIS_CALL_TIMEOUT,
+    breaker=CircuitBreaker(
+        failure_threshold=settings.REDIS_BREAKER_FAILURES,
+        reset_timeout=settings.REDIS_BREAKER_RESET_TIMEOUT,
+    ),
+)
@@ -0,0 +1,52 @@
+"""
+responses.py - faster JSON responses
+
+the app's default response class renders with orjson when it's installed
+(JSON_RESPONSE=orjson, the default), stdlib json otherwise.
+
+FastAPI still runs jsonable_encoder over whatever a route returns before
+rendering. hot routes that already build plain JSON types return
+fast_json(...) instead, which skips that pass.
+"""
+
+from typing import Any
+
+from fastapi import Response
+from fastapi.responses import JSONResponse
+
+from app.core.config import settings
+
+try:
+    import orjson
+except ImportError:  # optional, stdlib json is the fallback
+    orjson = None
+
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson, int dict keys allowed like json.dumps"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _response_class() -> type[JSONResponse]:
+    if settings.JSON_RESPONSE not in ("orjson", "json"):
+        raise ValueError(f"Unknown JSON_RESPONSE: {settings.JSON_RESPONSE}")
+    if settings.JSON_RESPONSE == "orjson" and orjson is not None:
+        return ORJSONResponse
+    return JSONResponse
+
+
+DefaultJSONResponse = _response_class()
+
+
+def fast_json(content: Any, response: Response | None = None, status_code: int = 200) -> JSONResponse:
+    """
+    render content (already plain JSON types) without jsonable_encoder.
+    pass the route's injected Response so headers set on it by
+    dependencies (rate limits, ETag) aren't lost.
+    """
+    out = DefaultJSONResponse(content, status_code=status_code)
+    if response is not None:
+        out.headers.raw.extend(response.headers.raw)
+    return out
@@ -1,10 +1,14 @@
+import hashlib
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from passlib.context import CryptContext
 from jose import JWTError, jwt
-from fastapi import Depends, HTTPException, status, Request
+from fastapi import Depends, HTTPException, status, Request, WebSocket
 from fastapi.security import OAuth2PasswordBearer
 
 from app.core.config import settings
+from app.core.metrics import metrics
 
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -29,16 +33,91 @@ def create_access_token(user_id: int) -> str:
     return jwt.encode(data, settings.SECRET_KEY, algorithm="HS256")
 
 
+class VerifiedTokenCache:
+    """
+    LRU of tokens that already passed signature and claim checks, so a
+    client polling with the same token only pays for HMAC + JSON once per
+    worker. Keyed by a sha256 of the token (raw tokens aren't kept in
+    memory), entries are dropped once the token's exp has passed.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries: OrderedDict[bytes, tuple[int, float]] = OrderedDict()
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> int | None:
+        key = self._key(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            metrics.incr("auth.token_cache_misses")
+            return None
+        user_id, exp = entry
+        if exp <= time.time():
+            del self._entries[key]
+            metrics.incr("auth.token_cache_misses")
+            return None
+        self._entries.move_to_end(key)
+        metrics.incr("auth.token_cache_hits")
+        return user_id
+
+    def put(self, token: str, user_id: int, exp: float) -> None:
+        if self.max_size <= 0:
+            return
+        key = self._key(token)
+        self._entries[key] = (user_id, exp)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        metrics.set_gauge("auth.token_cache_size", len(self._entries))
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+token_cache = VerifiedTokenCache(max_size=settings.JWT_CACHE_SIZE)
+
+
 def decode_token(token: str) -> int:
+    # only the crypto/parsing is cached - per-request checks such as
+    # revocation belong after this lookup, not inside the cache
+    user_id = token_cache.get(token)
+    if user_id is not None:
+        return user_id
+
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-        return int(payload.get("sub"))
+        user_id = int(payload.get("sub"))
     except JWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, 
             detail="Invalid or expired token"
         )
 
+    if payload.get("exp") is not None:
+        token_cache.put(token, user_id, float(payload["exp"]))
+    return user_id
+
+
+def websocket_user(websocket: WebSocket) -> int | None:
+    """
+    Same JWT as the REST routes. Browsers can't set headers on websockets,
+    so ?token=<jwt> works too. Returns None if missing or invalid.
+    """
+    token = websocket.query_params.get("token")
+    auth = websocket.headers.get("authorization", "")
+    if auth.lower().startswith("bearer "):
+        token = auth[7:]
+    if not token:
+        return None
+    try:
+        return decode_token(token)
+    except HTTPException:
+        return None
+
 
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> int:
     return decode_token(token)
@@ -1,37 +1,57 @@
-from starlette.middleware.base import BaseHTTPMiddleware
-from fastapi import Request
+"""
+security_headers.py - adds security headers to every http response
 
+plain ASGI instead of BaseHTTPMiddleware: the header list is built once
+and appended to http.response.start, no extra task or body stream per
+request.
+"""
 
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# csp - allow swagger ui to work
+CSP = (
+    "default-src 'self'; "
+    "script-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net; "
+    "style-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net; "
+    "img-src 'self' data: https://fastapi.tiangolo.com; "
+    "font-src 'self' https://cdn.jsdelivr.net; "
+    "frame-ancestors 'none'"
+)
+
+SECURITY_HEADERS = {
+    # prevent mime sniffing
+    "X-Content-Type-Options": "nosniff",
+    # prevent clickjacking
+    "X-Frame-Options": "DENY",
+    # xss protection
+    "X-XSS-Protection": "1; mode=block",
+    # force https (hsts) - 2 years
+    "Strict-Transport-Security": "max-age=63072000; includeSubDomains; preload",
+    "Content-Security-Policy": CSP,
+    # referrer policy
+    "Referrer-Policy": "strict-origin-when-cross-origin",
+}
+
+
+class SecurityHeadersMiddleware:
     """adds security headers to all responses"""
-    
-    async def dispatch(self, request: Request, call_next):
-        response = await call_next(request)
-        
-        # prevent mime sniffing
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        
-        # prevent clickjacking
-        response.headers["X-Frame-Options"] = "DENY"
-        
-        # xss protection
-        response.headers["X-XSS-Protection"] = "1; mode=block"
-        
-        # force https (hsts) - 2 years
-        response.headers["Strict-Transport-Security"] = "max-age=63072000; includeSubDomains; preload"
-        
-        # csp - allow swagger ui to work
-        csp = (
-            "default-src 'self'; "
-            "script-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net; "
-            "style-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net; "
-            "img-src 'self' data: https://fastapi.tiangolo.com; "
-            "font-src 'self' https://cdn.jsdelivr.net; "
-            "frame-ancestors 'none'"
-        )
-        response.headers["Content-Security-Policy"] = csp
-        
-        # referrer policy
-        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-        
-        return response
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.raw_headers = [(k.lower().encode("latin-1"), v.encode("latin-1"))
+                            for k, v in SECURITY_HEADERS.items()]
+        self.names = {name for name, _ in self.raw_headers}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                # ours win over anything the route set, like before
+                headers = [h for h in message.get("headers", ()) if h[0].lower() not in self.names]
+                message["headers"] = headers + self.raw_headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
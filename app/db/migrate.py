@@ -0,0 +1,141 @@
+"""
+migrate.py - versioned schema migrations
+
+    python -m app.db.migrate upgrade   # apply pending migrations
+    python -m app.db.migrate status    # show applied / pending
+
+Scripts live in app/db/migrations/vNNNN_<name>.py and define upgrade(conn),
+which gets a sync Connection. Scripts that need to run outside a
+transaction (CREATE INDEX CONCURRENTLY) set TRANSACTIONAL = False.
+Applied versions are recorded in the schema_migrations table.
+"""
+
+import argparse
+import asyncio
+import datetime
+import importlib
+import pkgutil
+import re
+from dataclasses import dataclass
+from types import ModuleType
+
+import sqlalchemy as sa
+from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from app.db import migrations as migrations_pkg
+
+# keeps two deploys from migrating the same postgres database at once
+ADVISORY_LOCK_ID = 47110001
+
+_version_meta = sa.MetaData()
+
+schema_migrations = sa.Table(
+    "schema_migrations",
+    _version_meta,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime, default=datetime.datetime.utcnow),
+)
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    module: ModuleType
+
+    @property
+    def transactional(self) -> bool:
+        return getattr(self.module, "TRANSACTIONAL", True)
+
+
+def discover() -> list[Migration]:
+    found = []
+    for info in pkgutil.iter_modules(migrations_pkg.__path__):
+        m = re.match(r"^v(\d+)_(\w+)$", info.name)
+        if not m:
+            continue
+        module = importlib.import_module(f"{migrations_pkg.__name__}.{info.name}")
+        found.append(Migration(int(m.group(1)), m.group(2), module))
+
+    found.sort(key=lambda mig: mig.version)
+    versions = [mig.version for mig in found]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"Duplicate migration versions: {versions}")
+    return found
+
+
+async def _applied(conn: AsyncConnection) -> set[int]:
+    await conn.run_sync(lambda c: schema_migrations.create(c, checkfirst=True))
+    r = await conn.execute(sa.select(schema_migrations.c.version))
+    return {row[0] for row in r.fetchall()}
+
+
+async def pending(engine: AsyncEngine) -> list[Migration]:
+    async with engine.connect() as conn:
+        done = await _applied(conn)
+        await conn.commit()
+    return [m for m in discover() if m.version not in done]
+
+
+async def upgrade(engine: AsyncEngine) -> list[Migration]:
+    """apply everything not yet recorded, returns what was applied"""
+    applied = []
+
+    async with engine.connect() as raw:
+        conn = await raw.execution_options(isolation_level="AUTOCOMMIT")
+        is_pg = conn.dialect.name == "postgresql"
+
+        if is_pg:
+            await conn.execute(sa.text("SELECT pg_advisory_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+        try:
+            done = await _applied(conn)
+
+            for mig in discover():
+                if mig.version in done:
+                    continue
+
+                record = schema_migrations.insert().values(version=mig.version, name=mig.name)
+                if mig.transactional:
+                    async with engine.begin() as tx:
+                        await tx.run_sync(mig.module.upgrade)
+                        await tx.execute(record)
+                else:
+                    # each statement commits on its own, so these scripts
+                    # must be safe to re-run if they fail halfway
+                    await conn.run_sync(mig.module.upgrade)
+                    await conn.execute(record)
+
+                applied.append(mig)
+                print(f"applied {mig.version:04d}_{mig.name}")
+        finally:
+            if is_pg:
+                await conn.execute(sa.text("SELECT pg_advisory_unlock(:id)"),
+                                   {"id": ADVISORY_LOCK_ID})
+
+    return applied
+
+
+async def _main(command: str) -> None:
+    from app.db.session import engine
+
+    try:
+        if command == "upgrade":
+            applied = await upgrade(engine)
+            if not applied:
+                print("database is up to date")
+        else:
+            todo = {m.version for m in await pending(engine)}
+            for mig in discover():
+                state = "pending" if mig.version in todo else "applied"
+                print(f"{mig.version:04d}_{mig.name}: {state}")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Kavro schema migrations")
+    parser.add_argument("command", choices=["upgrade", "status"])
+    args = parser.parse_args()
+    asyncio.run(_main(args.command))
@@ -0,0 +1,70 @@
+"""
+ops.py - helpers shared by migration scripts
+everything here is safe to re-run, and index/constraint builds use the
+online variants on postgres so they don't block writes.
+"""
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Connection
+
+
+def _q(conn: Connection, name: str) -> str:
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def create_index(conn: Connection, name: str, table: str, columns: list[str],
+                 unique: bool = False) -> None:
+    """
+    CREATE INDEX CONCURRENTLY on postgres, plain CREATE INDEX elsewhere.
+    Needs a migration with TRANSACTIONAL = False on postgres.
+    """
+    cols = ", ".join(_q(conn, c) for c in columns)
+    create = "CREATE UNIQUE INDEX" if unique else "CREATE INDEX"
+
+    if conn.dialect.name == "postgresql":
+        # a failed concurrent build leaves an INVALID index behind that
+        # IF NOT EXISTS would happily skip, so clear it out first
+        invalid = conn.execute(sa.text(
+            "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ), {"name": name}).first()
+        if invalid:
+            conn.execute(sa.text(f"DROP INDEX CONCURRENTLY IF EXISTS {_q(conn, name)}"))
+
+        conn.execute(sa.text(
+            f"{create} CONCURRENTLY IF NOT EXISTS {_q(conn, name)} "
+            f"ON {_q(conn, table)} ({cols})"
+        ))
+    else:
+        conn.execute(sa.text(
+            f"{create} IF NOT EXISTS {_q(conn, name)} ON {_q(conn, table)} ({cols})"
+        ))
+
+
+def add_foreign_key(conn: Connection, name: str, table: str, column: str,
+                    ref_table: str, ref_column: str = "id",
+                    ondelete: str | None = None) -> None:
+    """
+    Add a FK without a long table lock: NOT VALID first, then VALIDATE.
+    Postgres only - sqlite can't add constraints to existing tables. fresh
+    databases get them from v0001, a sqlite database migrated before that
+    has none.
+    """
+    if conn.dialect.name != "postgresql":
+        return
+
+    exists = conn.execute(sa.text(
+        "SELECT 1 FROM pg_constraint WHERE conname = :name"
+    ), {"name": name}).first()
+    if exists:
+        return
+
+    on_delete = f" ON DELETE {ondelete}" if ondelete else ""
+    conn.execute(sa.text(
+        f"ALTER TABLE {_q(conn, table)} ADD CONSTRAINT {_q(conn, name)} "
+        f"FOREIGN KEY ({_q(conn, column)}) "
+        f"REFERENCES {_q(conn, ref_table)} ({_q(conn, ref_column)}){on_delete} NOT VALID"
+    ))
+    conn.execute(sa.text(
+        f"ALTER TABLE {_q(conn, table)} VALIDATE CONSTRAINT {_q(conn, name)}"
+    ))
@@ -0,0 +1,72 @@
+"""
+initial schema - the four tables as create_all used to build them
+kept as a frozen copy so later changes to models.py don't rewrite history.
+checkfirst makes it a no-op on databases that were created by create_all.
+
+the foreign keys of v0003 are declared here too (same names), because
+sqlite can't add them to an existing table: a fresh database gets them
+on every dialect, v0003 adds them to older postgres databases.
+"""
+
+import datetime
+
+import sqlalchemy as sa
+from sqlalchemy import JSON, Boolean, Column, DateTime, ForeignKey, Integer, LargeBinary, String
+
+TRANSACTIONAL = True
+
+baseline = sa.MetaData()
+
+sa.Table(
+    "users",
+    baseline,
+    Column("id", Integer, primary_key=True),
+    Column("username", String, unique=True, nullable=False),
+    Column("password_hash", String, nullable=False),
+    Column("created_at", DateTime, default=datetime.datetime.utcnow),
+)
+
+sa.Table(
+    "devices",
+    baseline,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer,
+           ForeignKey("users.id", name="fk_devices_user_id", ondelete="CASCADE"),
+           nullable=False),
+    Column("identity_pubkey", String, nullable=False),
+    Column("device_name", String, nullable=True),
+    Column("created_at", DateTime, default=datetime.datetime.utcnow),
+)
+
+sa.Table(
+    "messages",
+    baseline,
+    Column("id", Integer, primary_key=True),
+    Column("sender_id", Integer,
+           ForeignKey("users.id", name="fk_messages_sender_id", ondelete="CASCADE"),
+           nullable=False),
+    Column("recipient_id", Integer,
+           ForeignKey("users.id", name="fk_messages_recipient_id", ondelete="CASCADE"),
+           nullable=False),
+    Column("ciphertext", LargeBinary, nullable=False),
+    Column("ephemeral_pubkey", String, nullable=False),
+    Column("metadata", JSON, nullable=True),
+    Column("created_at", DateTime, default=datetime.datetime.utcnow),
+    Column("delivered", Boolean, default=False),
+)
+
+sa.Table(
+    "audit_logs",
+    baseline,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer,
+           ForeignKey("users.id", name="fk_audit_logs_user_id", ondelete="SET NULL"),
+           nullable=True),
+    Column("action", String, nullable=False),
+    Column("details", JSON),
+    Column("timestamp", DateTime, default=datetime.datetime.utcnow),
+)
+
+
+def upgrade(conn):
+    baseline.create_all(conn, checkfirst=True)
@@ -0,0 +1,21 @@
+"""
+hot query indexes
+- inbox pages: recipient + (created_at, id) keyset
+- sent messages lookups by sender
+- key directory: devices by user
+- audit trail per user, newest first
+"""
+
+from app.db.migrations.ops import create_index
+
+# CREATE INDEX CONCURRENTLY can't run inside a transaction
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    create_index(conn, "ix_messages_recipient_created_id", "messages",
+                 ["recipient_id", "created_at", "id"])
+    create_index(conn, "ix_messages_sender_id", "messages", ["sender_id"])
+    create_index(conn, "ix_devices_user_id", "devices", ["user_id"])
+    create_index(conn, "ix_audit_logs_user_id_timestamp", "audit_logs",
+                 ["user_id", "timestamp"])
@@ -0,0 +1,20 @@
+"""
+foreign keys from devices, messages and audit_logs to users
+added NOT VALID then validated, so existing rows are checked without
+holding a write lock for the whole scan.
+"""
+
+from app.db.migrations.ops import add_foreign_key
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    add_foreign_key(conn, "fk_devices_user_id", "devices", "user_id", "users",
+                    ondelete="CASCADE")
+    add_foreign_key(conn, "fk_messages_sender_id", "messages", "sender_id", "users",
+                    ondelete="CASCADE")
+    add_foreign_key(conn, "fk_messages_recipient_id", "messages", "recipient_id", "users",
+                    ondelete="CASCADE")
+    add_foreign_key(conn, "fk_audit_logs_user_id", "audit_logs", "user_id", "users",
+                    ondelete="SET NULL")
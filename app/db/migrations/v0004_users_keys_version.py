@@ -0,0 +1,18 @@
+"""
+users.keys_version - bumped by publish_key, used as the ETag for the key
+directory. a constant default makes this a metadata-only change on
+postgres 11+, no table rewrite.
+"""
+
+import sqlalchemy as sa
+
+TRANSACTIONAL = True
+
+
+def upgrade(conn):
+    columns = {c["name"] for c in sa.inspect(conn).get_columns("users")}
+    if "keys_version" in columns:
+        return  # created by a newer create_all
+    conn.execute(sa.text(
+        "ALTER TABLE users ADD COLUMN keys_version INTEGER NOT NULL DEFAULT 0"
+    ))
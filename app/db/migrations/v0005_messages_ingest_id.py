@@ -0,0 +1,20 @@
+"""
+messages.ingest_id - id a send gets when it goes through the ingest
+stream. unique so the worker can insert with ON CONFLICT DO NOTHING and
+replayed entries don't store a message twice. nullable, so adding it is
+metadata-only; rows written directly keep NULL.
+"""
+
+import sqlalchemy as sa
+
+from app.db.migrations.ops import create_index
+
+# CREATE INDEX CONCURRENTLY can't run inside a transaction
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    columns = {c["name"] for c in sa.inspect(conn).get_columns("messages")}
+    if "ingest_id" not in columns:  # else created by a newer create_all
+        conn.execute(sa.text("ALTER TABLE messages ADD COLUMN ingest_id VARCHAR"))
+    create_index(conn, "ux_messages_ingest_id", "messages", ["ingest_id"], unique=True)
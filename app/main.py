@@ -9,9 +9,19 @@ load_dotenv()
 
 from app.api import auth, keys, messages
 from app.api.router import api_v1_router
+from app.db import migrate
 from app.db.session import engine
-from app.db.base import metadata
+from app.core.audit_writer import audit_writer
 from app.core.config import settings
+from app.core.envelopes import metadata_decryptor
+from app.core.inbox_cache import inbox_cache
+from app.core.ingest import message_ingest
+from app.core.key_cache import key_cache
+from app.core.metrics import metrics
+from app.core.password_pool import password_pool
+from app.core.responses import DefaultJSONResponse
+from app.core.rate_limiter import hybrid_limiter
+from app.core.realtime import hub
 from app.core.security_headers import SecurityHeadersMiddleware
 from app.core.middleware import LimitUploadSize
 from app.core.exceptions import (
@@ -24,7 +34,8 @@ from app.core.exceptions import (
 app = FastAPI(
     title="E2EE Messaging API",
     description="End-to-end encrypted messaging backend",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=DefaultJSONResponse,
 )
 
 # middleware
@@ -36,6 +47,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # so browser clients can read binary inbox cursors and key ETags
+    expose_headers=["X-Next-Cursor", "X-Prev-Cursor", "ETag"],
 )
 
 # routes - versioned API (HENNGE best practice)
@@ -55,8 +68,9 @@ app.add_exception_handler(Exception, general_exception_handler)
 
 @app.on_event("startup")
 async def startup():
-    async with engine.begin() as conn:
-        await conn.run_sync(metadata.create_all)
+    # no DDL here by default - migrations run once per deploy, not per worker
+    if settings.RUN_MIGRATIONS_ON_STARTUP:
+        await migrate.upgrade(engine)
     
     app.state.redis = redis.from_url(
         settings.REDIS_URL,
@@ -64,14 +78,29 @@ async def startup():
         decode_responses=True,
         max_connections=10
     )
+    await hub.start(app.state.redis)
+    await key_cache.start(app.state.redis)
+    await inbox_cache.start(app.state.redis)
+    await message_ingest.start(app.state.redis)
+    await audit_writer.start()
+    if settings.RATE_LIMIT_ALGORITHM == "hybrid":
+        await hybrid_limiter.start(app.state.redis)
     print("Redis connected!")
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    await hub.close()
+    await key_cache.close()
+    await inbox_cache.close()
+    await message_ingest.close()
+    await hybrid_limiter.close()
     r = getattr(app.state, "redis", None)
     if r:
         await r.aclose()
+    password_pool.shutdown()
+    metadata_decryptor.shutdown()
+    await audit_writer.close()
 
 
 @app.get("/health")
@@ -88,3 +117,11 @@ async def health():
         "service": "kavro",
         "version": "1.0.0"
     }
+
+
+@app.get("/metrics")
+@app.get("/api/v1/metrics")
+async def get_metrics():
+    """In-process counters, gauges and timings for this worker."""
+    await message_ingest.update_gauges()
+    return metrics.snapshot()
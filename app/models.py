@@ -2,7 +2,7 @@
 
 import datetime
 import sqlalchemy as sa
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, LargeBinary, JSON
+from sqlalchemy import Column, ForeignKey, Integer, String, Boolean, DateTime, LargeBinary, JSON
 
 from app.db.base import metadata
 
@@ -14,37 +14,58 @@ users = sa.Table(
     Column("username", String, unique=True, nullable=False),
     Column("password_hash", String, nullable=False),
     Column("created_at", DateTime, default=datetime.datetime.utcnow),
+    # bumped by publish_key, used as the key directory ETag
+    Column("keys_version", Integer, nullable=False, default=0, server_default="0"),
 )
 
+# indexes and foreign keys below are created on existing databases by
+# app/db/migrations - keep the names in sync when changing them
+
 devices = sa.Table(
     "devices",
     metadata,
     Column("id", Integer, primary_key=True),
-    Column("user_id", Integer, nullable=False),
+    Column("user_id", Integer,
+           ForeignKey("users.id", name="fk_devices_user_id", ondelete="CASCADE"),
+           nullable=False),
     Column("identity_pubkey", String, nullable=False),
     Column("device_name", String, nullable=True),
     Column("created_at", DateTime, default=datetime.datetime.utcnow),
+    sa.Index("ix_devices_user_id", "user_id"),
 )
 
 messages = sa.Table(
     "messages",
     metadata,
     Column("id", Integer, primary_key=True),
-    Column("sender_id", Integer, nullable=False),
-    Column("recipient_id", Integer, nullable=False),
+    Column("sender_id", Integer,
+           ForeignKey("users.id", name="fk_messages_sender_id", ondelete="CASCADE"),
+           nullable=False),
+    Column("recipient_id", Integer,
+           ForeignKey("users.id", name="fk_messages_recipient_id", ondelete="CASCADE"),
+           nullable=False),
     Column("ciphertext", LargeBinary, nullable=False),
     Column("ephemeral_pubkey", String, nullable=False),
     Column("metadata", JSON, nullable=True),
     Column("created_at", DateTime, default=datetime.datetime.utcnow),
     Column("delivered", Boolean, default=False),
+    # set by the write-behind ingest worker, makes replayed stream entries no-ops
+    Column("ingest_id", String, nullable=True),
+    # inbox pages are keyset scans over (created_at, id) for one recipient
+    sa.Index("ix_messages_recipient_created_id", "recipient_id", "created_at", "id"),
+    sa.Index("ix_messages_sender_id", "sender_id"),
+    sa.Index("ux_messages_ingest_id", "ingest_id", unique=True),
 )
 
 audit_logs = sa.Table(
     "audit_logs",
     metadata,
     Column("id", Integer, primary_key=True),
-    Column("user_id", Integer, nullable=True),
+    Column("user_id", Integer,
+           ForeignKey("users.id", name="fk_audit_logs_user_id", ondelete="SET NULL"),
+           nullable=True),
     Column("action", String, nullable=False),
     Column("details", JSON),
     Column("timestamp", DateTime, default=datetime.datetime.utcnow),
+    sa.Index("ix_audit_logs_user_id_timestamp", "user_id", "timestamp"),
 )
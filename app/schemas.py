@@ -42,13 +42,29 @@ class PublishKey(BaseModel):
     device_name: Optional[str] = None
 
 
-class MessageIn(BaseModel):
+class KeyLookup(BaseModel):
+    user_ids: list[int] = Field(..., min_length=1, max_length=500)
+
+
+class EnvelopeHeader(BaseModel):
+    """everything but the ciphertext - the header of a binary frame"""
     recipient_id: int
-    ciphertext: str
     ephemeral_pubkey: str
     metadata: Optional[Any] = None
 
 
+class MessageIn(EnvelopeHeader):
+    ciphertext: str
+
+
+class MessageBatchIn(BaseModel):
+    envelopes: list[MessageIn] = Field(..., min_length=1, max_length=100)
+
+
+class MessageAck(BaseModel):
+    message_ids: list[int] = Field(..., min_length=1, max_length=200)
+
+
 class MessageOut(BaseModel):
     id: int
     sender_id: int
@@ -9,6 +9,7 @@ Fixtures help us:
 """
 
 import os
+import fakeredis
 import pytest
 from typing import AsyncGenerator
 from httpx import AsyncClient, ASGITransport
@@ -19,6 +20,7 @@ os.environ.setdefault("SECRET_KEY", "test-secret-key-for-testing-only")
 os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
 
 from app.main import app
+from app.core.key_cache import key_cache
 from app.db.base import metadata
 from app.db.session import engine
 
@@ -39,6 +41,9 @@ async def setup_database():
     # Drop all tables after test
     async with engine.begin() as conn:
         await conn.run_sync(metadata.drop_all)
+    
+    # ids get reused by the next test, so cached key lists would be stale
+    key_cache.clear()
 
 
 @pytest.fixture
@@ -56,6 +61,21 @@ async def client(setup_database) -> AsyncGenerator[AsyncClient, None]:
         yield ac
 
 
+@pytest.fixture
+async def fake_redis():
+    """
+    In-memory redis (with lua) attached to the app for the test.
+    
+    Without this app.state.redis is unset, so rate limiting and other
+    redis features are skipped like in local dev.
+    """
+    r = fakeredis.FakeAsyncRedis(decode_responses=True)
+    app.state.redis = r
+    yield r
+    del app.state.redis
+    await r.aclose()
+
+
 @pytest.fixture
 def test_user_data() -> dict:
     """Sample user data for testing."""
@@ -0,0 +1,141 @@
+"""
+test_audit.py - Tests for the background audit_logs writer
+
+Tests cover:
+1. Rows are written directly when the writer isn't running
+2. Queued rows are bulk-inserted and flushed on close
+3. The drop policy sheds rows when the queue is full
+4. Security event log file rotation and json output
+5. Interval fsync while idle, fsync on flush
+"""
+
+import json
+import logging
+import queue
+import time
+
+import pytest
+import sqlalchemy as sa
+
+from app.core import audit
+from app.core.audit import BatchedFsyncRotatingFileHandler, JsonFormatter
+from app.core.audit_writer import AuditWriter
+from app.core.metrics import metrics
+from app.db.session import AsyncSessionLocal
+from app.models import audit_logs
+
+
+async def audit_actions() -> list[str]:
+    async with AsyncSessionLocal() as session:
+        r = await session.execute(sa.select(audit_logs.c.action).order_by(audit_logs.c.id))
+        return [row[0] for row in r.fetchall()]
+
+
+class TestAuditWriter:
+    """Tests for AuditWriter."""
+    
+    @pytest.mark.asyncio
+    async def test_writes_directly_when_not_started(self, setup_database):
+        """Test record() falls back to a direct insert."""
+        writer = AuditWriter()
+        
+        await writer.record(None, "direct", {"a": 1})
+        
+        assert await audit_actions() == ["direct"]
+    
+    @pytest.mark.asyncio
+    async def test_flushes_queue_on_close(self, setup_database):
+        """Test queued rows all land in the database after close()."""
+        writer = AuditWriter(batch_size=2, flush_interval=60)
+        await writer.start()
+        
+        for i in range(5):
+            await writer.record(None, f"event{i}")
+        await writer.close()
+        
+        assert await audit_actions() == [f"event{i}" for i in range(5)]
+    
+    @pytest.mark.asyncio
+    async def test_drop_policy(self, setup_database):
+        """Test rows are dropped and counted when the queue is full."""
+        metrics.reset()
+        writer = AuditWriter(max_queue=1, batch_size=100, flush_interval=60, policy="drop")
+        await writer.start()
+        
+        for i in range(3):
+            await writer.record(None, f"event{i}")
+        await writer.close()
+        
+        assert await audit_actions() == ["event0"]
+        assert metrics.snapshot()["counters"]["audit.dropped"] == 2
+
+
+class TestSecurityLogFile:
+    """Tests for the rotating security event log file."""
+    
+    def test_rotates_and_writes_json(self, tmp_path):
+        """Test events are written as json lines and the file rotates by size."""
+        path = tmp_path / "security.log"
+        handler = BatchedFsyncRotatingFileHandler(
+            str(path), max_bytes=300, backup_count=2, fsync_every=5
+        )
+        handler.setFormatter(JsonFormatter())
+        logger = logging.getLogger("test_security_log_file")
+        logger.propagate = False
+        logger.addHandler(handler)
+        
+        try:
+            for i in range(20):
+                logger.warning({"event_type": "login", "n": i})
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        
+        assert (tmp_path / "security.log.1").exists()
+        assert not (tmp_path / "security.log.3").exists()
+        last = path.read_text().strip().splitlines()[-1]
+        assert json.loads(last) == {"event_type": "login", "n": 19}
+    
+    def test_idle_listener_syncs_on_interval(self, tmp_path, monkeypatch):
+        """Test the last records of a burst are fsynced without another event."""
+        synced = []
+        real_fsync = audit.os.fsync
+        monkeypatch.setattr(audit.os, "fsync", lambda fd: synced.append(fd) or real_fsync(fd))
+        handler = BatchedFsyncRotatingFileHandler(
+            str(tmp_path / "security.log"), max_bytes=10_000, backup_count=1,
+            fsync_every=100, fsync_interval=0.05
+        )
+        handler.setFormatter(JsonFormatter())
+        log_queue = queue.Queue()
+        listener = audit._SyncingQueueListener(log_queue, handler, tick=0.02)
+        listener.start()
+        
+        try:
+            log_queue.put(logging.makeLogRecord({"msg": {"event_type": "login"}}))
+            for _ in range(50):
+                if synced:
+                    break
+                time.sleep(0.02)
+            assert synced
+        finally:
+            listener.stop()
+            handler.close()
+    
+    def test_flush_syncs(self, tmp_path, monkeypatch):
+        """Test an explicit flush() fsyncs, the flush after each record doesn't."""
+        synced = []
+        real_fsync = audit.os.fsync
+        monkeypatch.setattr(audit.os, "fsync", lambda fd: synced.append(fd) or real_fsync(fd))
+        handler = BatchedFsyncRotatingFileHandler(
+            str(tmp_path / "security.log"), max_bytes=10_000, backup_count=1,
+            fsync_every=100, fsync_interval=60
+        )
+        handler.setFormatter(JsonFormatter())
+        
+        try:
+            handler.handle(logging.makeLogRecord({"msg": {"event_type": "login"}}))
+            assert synced == []
+            handler.flush()
+            assert len(synced) == 1
+        finally:
+            handler.close()
@@ -6,11 +6,23 @@ Tests cover:
 2. User login
 3. Get current user (/auth/me)
 4. Error cases (invalid credentials, duplicate users)
+5. Password hashing pool (off-loop bcrypt, 503 on full queue)
+6. Brute force lockout (atomic attempts, exponential backoff, per-ip limit, refunds)
+7. Verified token cache
 """
 
+import asyncio
+import time
+
 import pytest
+from fastapi import HTTPException
 from httpx import AsyncClient
 
+from app.core.brute_force import BruteForceProtector
+from app.core.metrics import metrics
+from app.core.password_pool import PasswordHasherPool
+from app.core.security import VerifiedTokenCache, create_access_token, decode_token, token_cache
+
 
 class TestRegister:
     """Tests for POST /auth/register endpoint."""
@@ -146,3 +158,201 @@ class TestMe:
         )
         
         assert response.status_code == 401
+
+
+class TestPasswordPool:
+    """Tests for the bcrypt worker pool."""
+    
+    @pytest.mark.asyncio
+    async def test_hash_and_verify(self):
+        """Test hashing round-trips and records queue/hash timings."""
+        pool = PasswordHasherPool(workers=1, max_queue=1)
+        try:
+            hashed = await pool.hash("ValidPass123")
+            assert await pool.verify("ValidPass123", hashed)
+            assert not await pool.verify("WrongPass123", hashed)
+        finally:
+            pool.shutdown()
+        
+        timings = metrics.snapshot()["timings"]
+        assert "password_pool.queue_wait_ms" in timings
+        assert "password_pool.hash_ms" in timings
+        assert "password_pool.verify_ms" in timings
+    
+    @pytest.mark.asyncio
+    async def test_rejects_when_queue_full(self):
+        """Test extra work is rejected with 503 instead of queueing."""
+        pool = PasswordHasherPool(workers=1, max_queue=0)
+        try:
+            results = await asyncio.gather(
+                pool.hash("ValidPass123"),
+                pool.hash("ValidPass456"),
+                return_exceptions=True
+            )
+        finally:
+            pool.shutdown()
+        
+        rejected = [r for r in results if isinstance(r, HTTPException)]
+        assert len(rejected) == 1
+        assert rejected[0].status_code == 503
+        assert pool.pending == 0
+    
+    @pytest.mark.asyncio
+    async def test_cancelled_caller_keeps_slot_until_done(self):
+        """Test a disconnected request's job still counts until it finishes."""
+        pool = PasswordHasherPool(workers=1, max_queue=0)
+        try:
+            task = asyncio.create_task(pool._run("hash", time.sleep, 0.3))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            
+            assert pool.pending == 1
+            with pytest.raises(HTTPException):
+                await pool.hash("ValidPass123")
+            
+            for _ in range(50):
+                if pool.pending == 0:
+                    break
+                await asyncio.sleep(0.02)
+            assert pool.pending == 0
+        finally:
+            pool.shutdown()
+    
+    def test_unknown_executor_rejected(self):
+        """Test a typo in PASSWORD_HASH_EXECUTOR fails instead of using threads."""
+        with pytest.raises(ValueError):
+            PasswordHasherPool(workers=1, max_queue=0, kind="threads")
+
+
+class TestBruteForce:
+    """Tests for the login brute force protector."""
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_attempts_capped(self, fake_redis):
+        """Test concurrent guesses can't get past max_attempts."""
+        bf = BruteForceProtector(fake_redis)
+        results = await asyncio.gather(
+            *[bf.attempt("victim") for _ in range(20)], return_exceptions=True
+        )
+        
+        allowed = [r for r in results if r is None]
+        assert len(allowed) == bf.max_attempts
+        assert all(r.status_code == 429 for r in results if r is not None)
+    
+    @pytest.mark.asyncio
+    async def test_lockout_doubles(self, fake_redis):
+        """Test each new lockout for the same key lasts twice as long."""
+        bf = BruteForceProtector(fake_redis)
+        bf.max_attempts, bf.lockout = 1, 10
+        
+        await bf.attempt("victim")
+        with pytest.raises(HTTPException) as first:
+            await bf.attempt("victim")
+        assert first.value.headers["Retry-After"] == "10"
+        
+        # lock runs out, the next round of failures locks for longer
+        await fake_redis.delete("bf_login:victim:lock")
+        await bf.attempt("victim")
+        with pytest.raises(HTTPException) as second:
+            await bf.attempt("victim")
+        assert second.value.headers["Retry-After"] == "20"
+    
+    @pytest.mark.asyncio
+    async def test_reset_and_composite_keys(self, fake_redis):
+        """Test success clears the count and ip_username keys are per ip."""
+        bf = BruteForceProtector(fake_redis)
+        bf.max_attempts, bf.key_by = 1, "ip_username"
+        
+        await bf.attempt("victim", "10.0.0.1")
+        await bf.reset("victim", "10.0.0.1")
+        await bf.attempt("victim", "10.0.0.1")
+        
+        # another address has its own budget
+        await bf.attempt("victim", "10.0.0.2")
+        with pytest.raises(HTTPException):
+            await bf.attempt("victim", "10.0.0.1")
+    
+    @pytest.mark.asyncio
+    async def test_ip_limit_across_usernames(self, fake_redis):
+        """Test one address can't spray guesses over many usernames."""
+        bf = BruteForceProtector(fake_redis)
+        bf.ip_max_attempts = 3
+        
+        for name in ("alice", "bob", "carol"):
+            await bf.attempt(name, "10.0.0.1")
+        with pytest.raises(HTTPException) as exc:
+            await bf.attempt("dave", "10.0.0.1")
+        assert exc.value.status_code == 429
+        
+        # the refused attempt wasn't charged to dave, other addresses are fine
+        assert await fake_redis.get("bf_login:dave") == "0"
+        await bf.attempt("dave", "10.0.0.2")
+    
+    @pytest.mark.asyncio
+    async def test_success_refunds_ip_counter(self, fake_redis):
+        """Test successful logins don't use up the address budget."""
+        bf = BruteForceProtector(fake_redis)
+        bf.ip_max_attempts = 2
+        
+        for name in ("alice", "bob", "carol", "dave"):
+            await bf.attempt(name, "10.0.0.1")
+            await bf.reset(name, "10.0.0.1")
+        assert await fake_redis.get("bf_login_ip:10.0.0.1") == "0"
+    
+    @pytest.mark.asyncio
+    async def test_refund_after_shed_login(self, client: AsyncClient, fake_redis, monkeypatch):
+        """Test a login shed with 503 doesn't count as an attempt."""
+        from app.core import password_pool as pool_module
+        
+        user = {"username": "shed", "password": "ValidPass123"}
+        await client.post("/auth/register", json=user)
+        
+        async def busy(*args):
+            raise HTTPException(status_code=503, detail="Server is busy. Please try again shortly.")
+        monkeypatch.setattr(pool_module.password_pool, "verify", busy)
+        
+        response = await client.post("/auth/login", json=user)
+        assert response.status_code == 503
+        assert await fake_redis.get("bf_login:shed") == "0"
+        assert await fake_redis.get("bf_login_ip:127.0.0.1") == "0"
+
+
+class TestTokenCache:
+    """Tests for the verified JWT cache."""
+    
+    def test_second_decode_is_a_hit(self):
+        """Test a token is only verified once."""
+        token_cache.clear()
+        metrics.reset()
+        token = create_access_token(42)
+        
+        assert decode_token(token) == 42
+        assert decode_token(token) == 42
+        
+        counters = metrics.snapshot()["counters"]
+        assert counters["auth.token_cache_misses"] == 1
+        assert counters["auth.token_cache_hits"] == 1
+    
+    def test_invalid_token_not_cached(self):
+        """Test bad tokens are rejected every time."""
+        token = create_access_token(42)[:-2] + "xx"
+        for _ in range(2):
+            with pytest.raises(HTTPException):
+                decode_token(token)
+    
+    def test_expiry_and_size_bound(self):
+        """Test expired entries miss and the LRU stays bounded."""
+        cache = VerifiedTokenCache(max_size=2)
+        cache.put("old", 1, time.time() - 1)
+        assert cache.get("old") is None
+        
+        cache.put("a", 1, time.time() + 60)
+        cache.put("b", 2, time.time() + 60)
+        cache.get("a")
+        cache.put("c", 3, time.time() + 60)
+        
+        assert cache.get("b") is None  # least recently used
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
@@ -0,0 +1,77 @@
+"""
+test_encryption.py - Tests for field encryption
+
+Tests cover:
+1. AES-GCM round trip and size
+2. Old fernet values stay readable
+3. Key rotation by key id
+4. Tampered values aren't decrypted
+5. Bad key configuration fails up front
+"""
+
+import base64
+import os
+
+import pytest
+
+from app.core.encryption import AesGcmBackend, FieldEncryptor
+
+
+class TestFieldEncryptor:
+    """Tests for FieldEncryptor backends."""
+    
+    def test_aesgcm_round_trip_is_smaller(self):
+        """Test the AEAD format round-trips and is smaller than fernet."""
+        aead, fernet = FieldEncryptor("aesgcm"), FieldEncryptor("fernet")
+        value = '{"type": "text", "sent_from": "phone"}'
+        
+        token = aead.encrypt(value)
+        
+        assert token.startswith("k0.")
+        assert aead.decrypt(token) == value
+        assert len(token) < len(fernet.encrypt(value))
+    
+    def test_fernet_values_still_decrypt(self):
+        """Test data written before the switch is still readable."""
+        old = FieldEncryptor("fernet").encrypt("My Phone")
+        
+        assert FieldEncryptor("aesgcm").decrypt(old) == "My Phone"
+    
+    def test_rotated_keys(self):
+        """Test values written with an older key id keep decrypting."""
+        k1, k2 = os.urandom(32), os.urandom(32)
+        before = AesGcmBackend({"k1": k1}, "k1")
+        after = AesGcmBackend({"k1": k1, "k2": k2}, "k2")
+        
+        token = before.encrypt(b"secret")
+        
+        assert after.decrypt(token) == b"secret"
+        assert after.encrypt(b"secret").startswith("k2.")
+    
+    def test_tampered_value_returned_as_is(self):
+        """Test a modified ciphertext fails authentication."""
+        enc = FieldEncryptor("aesgcm")
+        kid, _, body = enc.encrypt("My Phone").partition(".")
+        raw = bytearray(base64.urlsafe_b64decode(body))
+        raw[-1] ^= 1
+        tampered = f"{kid}.{base64.urlsafe_b64encode(bytes(raw)).decode()}"
+        
+        assert enc.decrypt(tampered) == tampered
+        assert enc.decrypt("unknown.AAAA") == "unknown.AAAA"
+    
+    def test_default_writes_fernet(self):
+        """Test new values stay readable by instances without AES-GCM."""
+        token = FieldEncryptor().encrypt("My Phone")
+        
+        assert not AesGcmBackend.owns(token)
+        assert FieldEncryptor("fernet").decrypt(token) == "My Phone"
+    
+    def test_bad_keys_rejected(self):
+        """Test key ids with a dot, short keys and unknown active ids fail at construction."""
+        key = os.urandom(32)
+        with pytest.raises(ValueError):
+            AesGcmBackend({"k.1": key}, "k.1")
+        with pytest.raises(ValueError):
+            AesGcmBackend({"k1": os.urandom(16)}, "k1")
+        with pytest.raises(ValueError):
+            AesGcmBackend({"k1": key}, "k2")
@@ -0,0 +1,213 @@
+"""
+test_ingest.py - Tests for write-behind message ingestion
+
+Tests cover:
+1. Sends are queued (202) and stored by the worker
+2. Replayed stream entries don't store a message twice
+3. Entries left pending by a dead worker are reclaimed
+4. Sends are refused once the backlog is full
+5. Rows whose sender is gone are dropped, rows that keep failing are dead-lettered
+6. Queued sends don't hold a database connection while enqueueing
+"""
+
+import base64
+
+import pytest
+import sqlalchemy as sa
+from httpx import AsyncClient
+
+from app.core.ingest import IngestWorker, message_ingest
+from app.core.metrics import metrics
+from app.db.session import AsyncSessionLocal, engine
+from app.models import users
+
+
+@pytest.fixture
+async def stream_ingest(fake_redis, monkeypatch):
+    """MESSAGE_INGEST=stream on top of the fake redis."""
+    monkeypatch.setattr(message_ingest, "mode", "stream")
+    await message_ingest.start(fake_redis)
+    yield fake_redis
+    await message_ingest.close()
+
+
+def _worker(fake_redis, name: str = "w1", claim_idle_ms: int = 60000,
+            max_deliveries: int = 5) -> IngestWorker:
+    return IngestWorker(fake_redis, name, stream=message_ingest.stream,
+                        group=message_ingest.group, block_ms=10, claim_idle_ms=claim_idle_ms,
+                        max_deliveries=max_deliveries)
+
+
+class TestIngest:
+    """Tests for MessageIngest and IngestWorker."""
+    
+    async def _two_users(self, client: AsyncClient) -> tuple[dict, dict, int]:
+        sender = await client.post("/auth/register",
+                                   json={"username": "ingestsender", "password": "ValidPass123"})
+        recipient = await client.post("/auth/register",
+                                      json={"username": "ingestrecipient", "password": "ValidPass123"})
+        sender_headers = {"Authorization": f"Bearer {sender.json()['access_token']}"}
+        recipient_headers = {"Authorization": f"Bearer {recipient.json()['access_token']}"}
+        me = await client.get("/auth/me", headers=recipient_headers)
+        return sender_headers, recipient_headers, me.json()["user_id"]
+    
+    async def _send(self, client: AsyncClient, headers: dict, recipient_id: int, text: bytes):
+        return await client.post("/messages/", headers=headers, json={
+            "recipient_id": recipient_id, "ephemeral_pubkey": "k",
+            "ciphertext": base64.b64encode(text).decode(), "metadata": {"t": "x"},
+        })
+    
+    async def _inbox(self, client: AsyncClient, headers: dict) -> list[dict]:
+        return (await client.get("/messages/inbox", headers=headers)).json()["messages"]
+    
+    @pytest.mark.asyncio
+    async def test_send_is_queued_then_stored(self, client: AsyncClient, stream_ingest):
+        """Test a send answers 202 and shows up once the worker ran."""
+        sender_headers, recipient_headers, recipient_id = await self._two_users(client)
+        worker = _worker(stream_ingest)
+        await worker.ensure_group()
+        
+        response = await self._send(client, sender_headers, recipient_id, b"later")
+        
+        assert response.status_code == 202
+        assert response.json()["status"] == "queued"
+        assert await self._inbox(client, recipient_headers) == []
+        metrics_resp = await client.get("/metrics")
+        assert metrics_resp.json()["gauges"]["ingest.backlog"] == 1
+        
+        assert await worker.run_once() == 1
+        
+        inbox = await self._inbox(client, recipient_headers)
+        assert base64.b64decode(inbox[0]["ciphertext"]) == b"later"
+        assert inbox[0]["metadata"] == {"t": "x"}
+        assert await stream_ingest.xlen(message_ingest.stream) == 0
+    
+    @pytest.mark.asyncio
+    async def test_enqueue_holds_no_connection(self, client: AsyncClient, stream_ingest,
+                                               monkeypatch):
+        """Test the redis round trip of a queued send runs with no pooled connection checked out."""
+        sender_headers, _, recipient_id = await self._two_users(client)
+        enqueue, open_connections, checked_out = message_ingest.enqueue, [0], []
+        
+        def on_checkout(*args):
+            open_connections[0] += 1
+        
+        def on_checkin(*args):
+            open_connections[0] -= 1
+        
+        async def watched(row):
+            checked_out.append(open_connections[0])
+            return await enqueue(row)
+        monkeypatch.setattr(message_ingest, "enqueue", watched)
+        
+        sa.event.listen(engine.sync_engine, "checkout", on_checkout)
+        sa.event.listen(engine.sync_engine, "checkin", on_checkin)
+        try:
+            response = await self._send(client, sender_headers, recipient_id, b"x")
+        finally:
+            sa.event.remove(engine.sync_engine, "checkout", on_checkout)
+            sa.event.remove(engine.sync_engine, "checkin", on_checkin)
+        
+        assert response.status_code == 202
+        assert checked_out == [0]
+    
+    @pytest.mark.asyncio
+    async def test_replay_is_idempotent(self, client: AsyncClient, stream_ingest):
+        """Test the same entry flushed twice is stored once."""
+        sender_headers, recipient_headers, recipient_id = await self._two_users(client)
+        worker = _worker(stream_ingest)
+        await worker.ensure_group()
+        await self._send(client, sender_headers, recipient_id, b"once")
+        
+        [(_, [(entry_id, fields)])] = await stream_ingest.xreadgroup(
+            message_ingest.group, "w1", {message_ingest.stream: ">"})
+        await worker.flush([(entry_id, fields)])
+        await worker.flush([(entry_id, fields)])
+        
+        assert len(await self._inbox(client, recipient_headers)) == 1
+    
+    @pytest.mark.asyncio
+    async def test_dead_worker_entries_reclaimed(self, client: AsyncClient, stream_ingest):
+        """Test entries read but never acked are picked up by another worker."""
+        sender_headers, recipient_headers, recipient_id = await self._two_users(client)
+        await _worker(stream_ingest).ensure_group()
+        for text in (b"one", b"two"):
+            await self._send(client, sender_headers, recipient_id, text)
+        
+        # read by a worker that dies before storing anything
+        await stream_ingest.xreadgroup(message_ingest.group, "dead", {message_ingest.stream: ">"})
+        metrics.reset()
+        
+        assert await _worker(stream_ingest, "w2", claim_idle_ms=0).run_once() == 2
+        assert metrics.snapshot()["counters"]["ingest.reclaimed"] == 2
+        assert len(await self._inbox(client, recipient_headers)) == 2
+        pending = await stream_ingest.xpending(message_ingest.stream, message_ingest.group)
+        assert pending["pending"] == 0
+    
+    @pytest.mark.asyncio
+    async def test_full_backlog_refused(self, client: AsyncClient, stream_ingest, monkeypatch):
+        """Test sends answer 503 instead of growing the stream without bound."""
+        sender_headers, _, recipient_id = await self._two_users(client)
+        monkeypatch.setattr(message_ingest, "max_backlog", 1)
+        
+        assert (await self._send(client, sender_headers, recipient_id, b"a")).status_code == 202
+        assert (await self._send(client, sender_headers, recipient_id, b"b")).status_code == 503
+    
+    @pytest.mark.asyncio
+    async def test_deleted_sender_dropped(self, client: AsyncClient, stream_ingest):
+        """Test a batch with a sender deleted since the send still stores the rest."""
+        sender_headers, recipient_headers, recipient_id = await self._two_users(client)
+        other = await client.post("/auth/register",
+                                  json={"username": "ingestgone", "password": "ValidPass123"})
+        other_headers = {"Authorization": f"Bearer {other.json()['access_token']}"}
+        other_id = (await client.get("/auth/me", headers=other_headers)).json()["user_id"]
+        worker = _worker(stream_ingest)
+        await worker.ensure_group()
+        await self._send(client, sender_headers, recipient_id, b"kept")
+        await self._send(client, other_headers, recipient_id, b"orphan")
+        
+        async with AsyncSessionLocal() as session:
+            await session.execute(sa.delete(users).where(users.c.id == other_id))
+            await session.commit()
+        metrics.reset()
+        
+        assert await worker.run_once() == 1
+        assert metrics.snapshot()["counters"]["ingest.dropped"] == 1
+        inbox = await self._inbox(client, recipient_headers)
+        assert [base64.b64decode(m["ciphertext"]) for m in inbox] == [b"kept"]
+    
+    @pytest.mark.asyncio
+    async def test_failing_row_isolated_then_dead_lettered(self, client: AsyncClient, stream_ingest,
+                                                           monkeypatch):
+        """Test one row failing the insert doesn't hold back the batch, and is dead-lettered."""
+        sender_headers, recipient_headers, recipient_id = await self._two_users(client)
+        await _worker(stream_ingest).ensure_group()
+        await self._send(client, sender_headers, recipient_id, b"good")
+        bad = (await self._send(client, sender_headers, recipient_id, b"bad")).json()["id"]
+        
+        store = IngestWorker._store
+        
+        async def failing_store(self, rows):
+            if any(r["ingest_id"] == bad for r in rows):
+                raise sa.exc.IntegrityError("INSERT INTO messages", {}, Exception("constraint"))
+            return await store(self, rows)
+        monkeypatch.setattr(IngestWorker, "_store", failing_store)
+        metrics.reset()
+        
+        # first delivery: the good row is stored, the bad one stays pending
+        worker = _worker(stream_ingest, claim_idle_ms=0, max_deliveries=2)
+        assert await worker.run_once() == 1
+        assert len(await self._inbox(client, recipient_headers)) == 1
+        pending = await stream_ingest.xpending(message_ingest.stream, message_ingest.group)
+        assert pending["pending"] == 1
+        
+        # reclaimed a second time: moved to the dead letter stream and acked
+        assert await worker.run_once() == 0
+        [(_, fields)] = await stream_ingest.xrange(f"{message_ingest.stream}:dead")
+        assert fields["ingest_id"] == bad
+        assert "constraint" in fields["error"]
+        pending = await stream_ingest.xpending(message_ingest.stream, message_ingest.group)
+        assert pending["pending"] == 0
+        counters = metrics.snapshot()["counters"]
+        assert counters["ingest.batch_retries"] == 1
+        assert counters["ingest.dead_lettered"] == 1
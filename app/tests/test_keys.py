@@ -5,11 +5,32 @@ Tests cover:
 1. Publishing public keys
 2. Retrieving public keys
 3. Authentication requirements
+4. Key directory cache (read-through, invalidation on publish, no stale refills)
+5. Bulk lookup
+6. ETag / If-None-Match
 """
 
+import asyncio
+import json
+
+import fakeredis
 import pytest
 from httpx import AsyncClient
 
+from app.core.key_cache import KeyDirectoryCache, KeySet, key_cache
+from app.core.metrics import metrics
+
+
+async def _user_with_key(client: AsyncClient, username: str, device: str) -> tuple[int, dict]:
+    reg = await client.post("/auth/register",
+                            json={"username": username, "password": "ValidPass123"})
+    headers = {"Authorization": f"Bearer {reg.json()['access_token']}"}
+    user_id = (await client.get("/auth/me", headers=headers)).json()["user_id"]
+    await client.post("/keys/publish",
+                      json={"identity_pubkey": f"pk_{device}", "device_name": device},
+                      headers=headers)
+    return user_id, headers
+
 
 class TestPublishKey:
     """Tests for POST /keys/publish endpoint."""
@@ -115,3 +136,236 @@ class TestGetKeys:
         
         assert response.status_code == 200
         assert response.json()["devices"] == []
+
+
+class TestKeyCache:
+    """Tests for the public key directory cache."""
+    
+    @pytest.mark.asyncio
+    async def test_repeat_lookup_served_from_memory(self, client: AsyncClient):
+        """Test the second lookup doesn't reach the database."""
+        user_id, _ = await _user_with_key(client, "cacheuser1", "Phone")
+        metrics.reset()
+        
+        first = await client.get(f"/keys/{user_id}")
+        second = await client.get(f"/keys/{user_id}")
+        
+        assert first.json() == second.json()
+        assert second.json()["devices"][0]["device_name"] == "Phone"
+        counters = metrics.snapshot()["counters"]
+        assert counters["keys.cache_misses"] == 1
+        assert counters["keys.cache_local_hits"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_publish_invalidates(self, client: AsyncClient):
+        """Test a newly published device shows up right away."""
+        user_id, headers = await _user_with_key(client, "cacheuser2", "Phone")
+        await client.get(f"/keys/{user_id}")
+        
+        await client.post("/keys/publish",
+                          json={"identity_pubkey": "pk_laptop", "device_name": "Laptop"},
+                          headers=headers)
+        response = await client.get(f"/keys/{user_id}")
+        
+        names = [d["device_name"] for d in response.json()["devices"]]
+        assert names == ["Phone", "Laptop"]
+    
+    @pytest.mark.asyncio
+    async def test_redis_layer_keeps_names_encrypted(self, client: AsyncClient, fake_redis):
+        """Test redis holds the shared copy without plaintext device names."""
+        await key_cache.start(fake_redis)
+        try:
+            user_id, _ = await _user_with_key(client, "cacheuser3", "Secret Phone")
+            await client.get(f"/keys/{user_id}")
+            
+            version, stored = json.loads(await fake_redis.get(f"keys:dir:{user_id}"))
+            assert version == 1
+            assert stored[0]["identity_pubkey"] == "pk_Secret Phone"
+            assert stored[0]["device_name"] != "Secret Phone"
+            
+            # a cold worker is filled from redis, not the database
+            key_cache.clear()
+            metrics.reset()
+            response = await client.get(f"/keys/{user_id}")
+            assert response.json()["devices"][0]["device_name"] == "Secret Phone"
+            assert metrics.snapshot()["counters"]["keys.cache_redis_hits"] == 1
+        finally:
+            await key_cache.close()
+    
+    @pytest.mark.asyncio
+    async def test_invalidation_reaches_other_workers(self, fake_redis):
+        """Test invalidate() on one worker drops the entry on another."""
+        here, there = KeyDirectoryCache(), KeyDirectoryCache()
+        await here.start(fake_redis)
+        await there.start(fake_redis)
+        
+        async def load(user_ids):
+            return {u: KeySet(0, []) for u in user_ids}
+        
+        try:
+            await there.get(7, load)
+            assert 7 in there._local
+            
+            await here.invalidate(7)
+            for _ in range(50):
+                if 7 not in there._local:
+                    break
+                await asyncio.sleep(0.02)
+            assert 7 not in there._local
+        finally:
+            await here.close()
+            await there.close()
+    
+    @pytest.mark.asyncio
+    async def test_starts_with_redis_down(self):
+        """Test a worker boots without redis and subscribes once it's back."""
+        server = fakeredis.FakeServer()
+        server.connected = False
+        client = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+        cache = KeyDirectoryCache()
+        
+        async def load(user_ids):
+            return {u: KeySet(0, []) for u in user_ids}
+        
+        await cache.start(client)
+        try:
+            await cache.get(7, load)  # served from the db, cached locally only
+            assert 7 in cache._local
+            
+            server.connected = True
+            for _ in range(100):
+                if cache._pubsub.subscribed:
+                    break
+                await asyncio.sleep(0.05)
+            await client.publish("keys:invalidate", "7")
+            for _ in range(50):
+                if 7 not in cache._local:
+                    break
+                await asyncio.sleep(0.02)
+            assert 7 not in cache._local
+        finally:
+            await cache.close()
+            await client.aclose()
+    
+    @pytest.mark.asyncio
+    async def test_invalidate_during_load_blocks_refill(self, fake_redis):
+        """Test a load that started before a publish can't cache the old devices."""
+        cache = KeyDirectoryCache()
+        await cache.start(fake_redis)
+        metrics.reset()
+        
+        async def load_then_publish(user_ids):
+            old = {u: KeySet(1, []) for u in user_ids}
+            await cache.invalidate(7)  # publish commits while the old rows are in flight
+            return old
+        
+        async def load_new(user_ids):
+            return {u: KeySet(2, []) for u in user_ids}
+        
+        try:
+            assert (await cache.get(7, load_then_publish)).version == 1
+            assert await fake_redis.get("keys:dir:7") is None
+            assert 7 not in cache._local
+            assert metrics.snapshot()["counters"]["keys.cache_stale_refills"] == 1
+            
+            # the next miss refills with the new version
+            assert (await cache.get(7, load_new)).version == 2
+            assert json.loads(await fake_redis.get("keys:dir:7"))[0] == 2
+        finally:
+            await cache.close()
+
+
+class TestKeyLookup:
+    """Tests for POST /keys/lookup endpoint."""
+    
+    @pytest.mark.asyncio
+    async def test_lookup_many_users(self, client: AsyncClient):
+        """Test one call returns devices for every requested user."""
+        alice, _ = await _user_with_key(client, "lookupalice", "Alice Phone")
+        bob, _ = await _user_with_key(client, "lookupbob", "Bob Laptop")
+        
+        response = await client.post("/keys/lookup", json={"user_ids": [alice, bob, 99999]})
+        
+        assert response.status_code == 200
+        found = response.json()["users"]
+        assert found[str(alice)][0]["device_name"] == "Alice Phone"
+        assert found[str(bob)][0]["device_name"] == "Bob Laptop"
+        assert found["99999"] == []
+    
+    @pytest.mark.asyncio
+    async def test_lookup_keeps_dependency_headers(self, client: AsyncClient, fake_redis):
+        """Test headers set by dependencies survive the fast_json response."""
+        response = await client.post("/keys/lookup", json={"user_ids": [99999]})
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/json"
+        assert response.headers["RateLimit-Limit"] == "10"
+    
+    @pytest.mark.asyncio
+    async def test_lookup_shares_cache(self, client: AsyncClient):
+        """Test users fetched in bulk are then cached for the single route."""
+        alice, _ = await _user_with_key(client, "lookupcarol", "Phone")
+        await client.post("/keys/lookup", json={"user_ids": [alice]})
+        metrics.reset()
+        
+        await client.get(f"/keys/{alice}")
+        
+        assert metrics.snapshot()["counters"]["keys.cache_local_hits"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_lookup_too_many_ids(self, client: AsyncClient):
+        """Test the request size is capped."""
+        response = await client.post("/keys/lookup", json={"user_ids": list(range(501))})
+        
+        assert response.status_code == 422
+
+
+class TestKeysETag:
+    """Tests for conditional GET on the key directory."""
+    
+    @pytest.mark.asyncio
+    async def test_not_modified_until_publish(self, client: AsyncClient):
+        """Test a matching If-None-Match gets 304 until a new key is published."""
+        user_id, headers = await _user_with_key(client, "etaguser1", "Phone")
+        
+        first = await client.get(f"/keys/{user_id}")
+        etag = first.headers["ETag"]
+        assert first.headers["Cache-Control"].startswith("public, max-age=")
+        
+        cached = await client.get(f"/keys/{user_id}", headers={"If-None-Match": etag})
+        assert cached.status_code == 304
+        assert cached.headers["ETag"] == etag
+        
+        await client.post("/keys/publish",
+                          json={"identity_pubkey": "pk_laptop", "device_name": "Laptop"},
+                          headers=headers)
+        changed = await client.get(f"/keys/{user_id}", headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.headers["ETag"] != etag
+        assert len(changed.json()["devices"]) == 2
+    
+    @pytest.mark.asyncio
+    async def test_not_modified_keeps_rate_limit_headers(self, client: AsyncClient, fake_redis):
+        """Test a 304 still carries the RateLimit headers the limiter set."""
+        user_id, _ = await _user_with_key(client, "etaguser3", "Phone")
+        etag = (await client.get(f"/keys/{user_id}")).headers["ETag"]
+        
+        response = await client.get(f"/keys/{user_id}", headers={"If-None-Match": etag})
+        
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert response.headers["RateLimit-Limit"] == "30"
+        assert response.headers["RateLimit-Remaining"] == "28"
+    
+    @pytest.mark.asyncio
+    async def test_cold_cache_skips_devices(self, client: AsyncClient):
+        """Test a 304 on a cold cache only reads the version."""
+        user_id, _ = await _user_with_key(client, "etaguser2", "Phone")
+        etag = (await client.get(f"/keys/{user_id}")).headers["ETag"]
+        key_cache.clear()
+        metrics.reset()
+        
+        response = await client.get(f"/keys/{user_id}", headers={"If-None-Match": f"W/{etag}"})
+        
+        assert response.status_code == 304
+        assert "keys.cache_misses" not in metrics.snapshot()["counters"]
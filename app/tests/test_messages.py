@@ -6,12 +6,31 @@ Tests cover:
 2. Fetching inbox
 3. Acknowledging messages
 4. Authorization checks
+5. Redis inbox cache
 """
 
+import asyncio
+import datetime
+import json
 import pytest
 import base64
 from httpx import AsyncClient
 
+from app.core.encryption import encryptor
+from app.core.envelopes import MetadataDecryptor, decrypt_metadata_many
+from app.core.framing import FRAMES_MEDIA_TYPE, decode_frames, encode_frame
+from app.core.inbox_cache import _member, _score, inbox_cache
+from app.core.metrics import metrics
+
+
+@pytest.fixture
+async def cached_inbox(fake_redis, monkeypatch):
+    """Inbox cache on top of the fake redis, with a small cap."""
+    monkeypatch.setattr(inbox_cache, "max_entries", 8)
+    await inbox_cache.start(fake_redis)
+    yield fake_redis
+    await inbox_cache.close()
+
 
 class TestSendMessage:
     """Tests for POST /messages/ endpoint."""
@@ -114,6 +133,55 @@ class TestSendMessage:
         )
         
         assert response.status_code == 404
+    
+    @pytest.mark.asyncio
+    async def test_send_message_batch(self, client: AsyncClient):
+        """Test batch send stores valid envelopes and reports bad ones."""
+        sender_resp = await client.post(
+            "/auth/register",
+            json={"username": "batchsender", "password": "ValidPass123"}
+        )
+        sender_headers = {"Authorization": f"Bearer {sender_resp.json()['access_token']}"}
+        
+        recipient_resp = await client.post(
+            "/auth/register",
+            json={"username": "batchrecipient", "password": "ValidPass123"}
+        )
+        recipient_headers = {"Authorization": f"Bearer {recipient_resp.json()['access_token']}"}
+        me_resp = await client.get("/auth/me", headers=recipient_headers)
+        recipient_id = me_resp.json()["user_id"]
+        
+        ciphertext = base64.b64encode(b"group message").decode()
+        response = await client.post(
+            "/messages/batch",
+            json={"envelopes": [
+                {"recipient_id": recipient_id, "ciphertext": ciphertext,
+                 "ephemeral_pubkey": "k1", "metadata": {"device": 1}},
+                {"recipient_id": 99999, "ciphertext": ciphertext, "ephemeral_pubkey": "k2"},
+                {"recipient_id": recipient_id, "ciphertext": "not valid base64!!!",
+                 "ephemeral_pubkey": "k3"},
+                {"recipient_id": recipient_id, "ciphertext": ciphertext, "ephemeral_pubkey": "k4"},
+            ]},
+            headers=sender_headers
+        )
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert data["stored"] == 2
+        assert [r["status"] for r in data["results"]] == [
+            "stored", "recipient_not_found", "invalid_ciphertext", "stored"
+        ]
+        
+        inbox_resp = await client.get("/messages/inbox", headers=recipient_headers)
+        inbox = inbox_resp.json()["messages"]
+        assert sorted(m["id"] for m in inbox) == sorted(
+            r["id"] for r in data["results"] if r["status"] == "stored"
+        )
+        assert {"device": 1} in [m["metadata"] for m in inbox]
+        
+        slim_resp = await client.get("/messages/inbox?include_metadata=false",
+                                     headers=recipient_headers)
+        assert [m["metadata"] for m in slim_resp.json()["messages"]] == [None, None]
 
 
 class TestInbox:
@@ -187,6 +255,248 @@ class TestInbox:
         response = await client.get("/messages/inbox")
         
         assert response.status_code == 401
+    
+    @pytest.mark.asyncio
+    async def test_fetch_inbox_cursor_pagination(self, client: AsyncClient):
+        """Test paging through the inbox with before/after cursors."""
+        sender_resp = await client.post(
+            "/auth/register",
+            json={"username": "pagesender", "password": "ValidPass123"}
+        )
+        sender_token = sender_resp.json()["access_token"]
+        
+        recipient_resp = await client.post(
+            "/auth/register",
+            json={"username": "pagerecipient", "password": "ValidPass123"}
+        )
+        recipient_headers = {"Authorization": f"Bearer {recipient_resp.json()['access_token']}"}
+        
+        me_resp = await client.get("/auth/me", headers=recipient_headers)
+        recipient_id = me_resp.json()["user_id"]
+        
+        for i in range(3):
+            await client.post(
+                "/messages/",
+                json={
+                    "recipient_id": recipient_id,
+                    "ciphertext": base64.b64encode(f"msg {i}".encode()).decode(),
+                    "ephemeral_pubkey": "ephkey"
+                },
+                headers={"Authorization": f"Bearer {sender_token}"}
+            )
+        
+        # first page: two newest messages
+        first = await client.get("/messages/inbox?limit=2", headers=recipient_headers)
+        assert first.status_code == 200
+        first_page = first.json()
+        assert len(first_page["messages"]) == 2
+        assert first_page["next_cursor"]
+        
+        # second page: the oldest message, nothing after it
+        second = await client.get(
+            "/messages/inbox",
+            params={"limit": 2, "before": first_page["next_cursor"]},
+            headers=recipient_headers
+        )
+        second_page = second.json()
+        assert len(second_page["messages"]) == 1
+        assert second_page["next_cursor"] is None
+        
+        all_ids = [m["id"] for m in first_page["messages"] + second_page["messages"]]
+        assert all_ids == sorted(all_ids, reverse=True)
+        
+        # walking back up with 'after' returns the newer messages again
+        newer = await client.get(
+            "/messages/inbox",
+            params={"limit": 5, "after": second_page["prev_cursor"]},
+            headers=recipient_headers
+        )
+        assert [m["id"] for m in newer.json()["messages"]] == all_ids[:2]
+    
+    @pytest.mark.asyncio
+    async def test_fetch_inbox_long_poll(self, client: AsyncClient):
+        """Test a parked inbox request returns as soon as a message is sent."""
+        sender_resp = await client.post(
+            "/auth/register",
+            json={"username": "pollsender", "password": "ValidPass123"}
+        )
+        sender_token = sender_resp.json()["access_token"]
+        
+        recipient_resp = await client.post(
+            "/auth/register",
+            json={"username": "pollrecipient", "password": "ValidPass123"}
+        )
+        recipient_headers = {"Authorization": f"Bearer {recipient_resp.json()['access_token']}"}
+        me_resp = await client.get("/auth/me", headers=recipient_headers)
+        recipient_id = me_resp.json()["user_id"]
+        
+        poll = asyncio.create_task(
+            client.get("/messages/inbox?wait=10", headers=recipient_headers)
+        )
+        await asyncio.sleep(0.2)
+        assert not poll.done()
+        
+        await client.post(
+            "/messages/",
+            json={
+                "recipient_id": recipient_id,
+                "ciphertext": base64.b64encode(b"wake up").decode(),
+                "ephemeral_pubkey": "ephkey"
+            },
+            headers={"Authorization": f"Bearer {sender_token}"}
+        )
+        
+        response = await asyncio.wait_for(poll, timeout=5)
+        assert response.status_code == 200
+        assert len(response.json()["messages"]) == 1
+    
+    @pytest.mark.asyncio
+    async def test_fetch_inbox_long_poll_timeout(self, client: AsyncClient):
+        """Test a long poll with nothing to deliver returns empty after the wait."""
+        reg_resp = await client.post(
+            "/auth/register",
+            json={"username": "polltimeout", "password": "ValidPass123"}
+        )
+        token = reg_resp.json()["access_token"]
+        
+        response = await client.get(
+            "/messages/inbox?wait=0.2",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        
+        assert response.status_code == 200
+        assert response.json()["messages"] == []
+    
+    @pytest.mark.asyncio
+    async def test_fetch_inbox_invalid_cursor(self, client: AsyncClient):
+        """Test a malformed cursor is rejected."""
+        reg_resp = await client.post(
+            "/auth/register",
+            json={"username": "badcursor", "password": "ValidPass123"}
+        )
+        token = reg_resp.json()["access_token"]
+        
+        response = await client.get(
+            "/messages/inbox?before=not-a-cursor",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        
+        assert response.status_code == 400
+    
+    @pytest.mark.asyncio
+    async def test_export_streams_ndjson(self, client: AsyncClient, monkeypatch):
+        """Test the export streams every message oldest first and can resume."""
+        from app.api import messages as messages_api
+        monkeypatch.setattr(messages_api, "EXPORT_BATCH_SIZE", 2)
+        
+        reg = await client.post("/auth/register",
+                                json={"username": "exporter", "password": "ValidPass123"})
+        headers = {"Authorization": f"Bearer {reg.json()['access_token']}"}
+        me = (await client.get("/auth/me", headers=headers)).json()["user_id"]
+        ciphertext = base64.b64encode(b"hi").decode()
+        envelopes = [{"recipient_id": me, "ciphertext": ciphertext, "ephemeral_pubkey": f"k{i}",
+                      "metadata": {"n": i}} for i in range(5)]
+        await client.post("/messages/batch", json={"envelopes": envelopes}, headers=headers)
+        
+        response = await client.get("/messages/export", headers=headers)
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [m["metadata"]["n"] for m in lines] == [0, 1, 2, 3, 4]
+        
+        rest = await client.get(f"/messages/export?after={lines[2]['cursor']}", headers=headers)
+        assert [json.loads(line)["id"] for line in rest.text.splitlines()] == [
+            lines[3]["id"], lines[4]["id"]
+        ]
+        
+        bad = await client.get("/messages/export?after=nope", headers=headers)
+        assert bad.status_code == 400
+    
+    @pytest.mark.asyncio
+    async def test_offloaded_decrypt_matches_inline(self):
+        """Test pages decrypted in the pool come back complete and in order."""
+        page = [encryptor.encrypt(f'{{"n": {i}}}') if i % 3 else None for i in range(50)]
+        page.append("not-encrypted")
+        pool = MetadataDecryptor(workers=3, offload_bytes=0)
+        try:
+            result = await pool.decrypt_many(page)
+        finally:
+            pool.shutdown()
+        
+        assert result == decrypt_metadata_many(page)
+        assert result[1] == {"n": 1} and result[0] is None
+        assert result[-1] == {"error": "invalid_json"}
+
+
+class TestBinaryFrames:
+    """Tests for the binary frame transport on send and inbox."""
+    
+    async def _two_users(self, client: AsyncClient) -> tuple[dict, dict, int]:
+        sender = await client.post("/auth/register",
+                                   json={"username": "framesender", "password": "ValidPass123"})
+        recipient = await client.post("/auth/register",
+                                      json={"username": "framerecipient", "password": "ValidPass123"})
+        sender_headers = {"Authorization": f"Bearer {sender.json()['access_token']}"}
+        recipient_headers = {"Authorization": f"Bearer {recipient.json()['access_token']}"}
+        me = await client.get("/auth/me", headers=recipient_headers)
+        return sender_headers, recipient_headers, me.json()["user_id"]
+    
+    @pytest.mark.asyncio
+    async def test_send_and_fetch_frames(self, client: AsyncClient):
+        """Test raw ciphertext goes in and comes out without base64."""
+        sender_headers, recipient_headers, recipient_id = await self._two_users(client)
+        raw = bytes(range(256))
+        
+        single = await client.post(
+            "/messages/",
+            content=encode_frame({"recipient_id": recipient_id, "ephemeral_pubkey": "k1",
+                                  "metadata": {"n": 1}}, raw),
+            headers={**sender_headers, "Content-Type": FRAMES_MEDIA_TYPE}
+        )
+        assert single.status_code == 201
+        
+        batch = await client.post(
+            "/messages/batch",
+            content=b"".join(
+                encode_frame({"recipient_id": rid, "ephemeral_pubkey": "k2"}, b"\x00" * 3)
+                for rid in (recipient_id, 99999)
+            ),
+            headers={**sender_headers, "Content-Type": FRAMES_MEDIA_TYPE}
+        )
+        assert [r["status"] for r in batch.json()["results"]] == ["stored", "recipient_not_found"]
+        
+        response = await client.get(
+            "/messages/inbox",
+            headers={**recipient_headers, "Accept": FRAMES_MEDIA_TYPE}
+        )
+        assert response.headers["content-type"] == FRAMES_MEDIA_TYPE
+        assert "X-Prev-Cursor" in response.headers
+        frames = decode_frames(response.content, max_frames=10)
+        assert [ct for _, ct in frames] == [b"\x00" * 3, raw]
+        assert frames[1][0]["metadata"] == {"n": 1}
+        
+        # JSON is still the default
+        json_inbox = await client.get("/messages/inbox", headers=recipient_headers)
+        assert base64.b64decode(json_inbox.json()["messages"][1]["ciphertext"]) == raw
+    
+    @pytest.mark.asyncio
+    async def test_bad_frames_rejected(self, client: AsyncClient):
+        """Test truncated frames and extra frames on the single route are 400s."""
+        sender_headers, _, recipient_id = await self._two_users(client)
+        headers = {**sender_headers, "Content-Type": FRAMES_MEDIA_TYPE}
+        frame = encode_frame({"recipient_id": recipient_id, "ephemeral_pubkey": "k"}, b"abc")
+        
+        truncated = await client.post("/messages/", content=frame[:-1], headers=headers)
+        two = await client.post("/messages/", content=frame * 2, headers=headers)
+        no_key = await client.post(
+            "/messages/", content=encode_frame({"recipient_id": recipient_id}, b"abc"),
+            headers=headers
+        )
+        
+        assert truncated.status_code == 400
+        assert two.status_code == 400
+        assert no_key.status_code == 422
 
 
 class TestAckMessage:
@@ -298,3 +608,194 @@ class TestAckMessage:
         )
         
         assert response.status_code == 403
+    
+    @pytest.mark.asyncio
+    async def test_batch_ack(self, client: AsyncClient):
+        """Test acking several messages at once, skipping ones we don't own."""
+        sender_resp = await client.post(
+            "/auth/register",
+            json={"username": "batchacksender", "password": "ValidPass123"}
+        )
+        sender_headers = {"Authorization": f"Bearer {sender_resp.json()['access_token']}"}
+        
+        recipient_resp = await client.post(
+            "/auth/register",
+            json={"username": "batchackrecipient", "password": "ValidPass123"}
+        )
+        recipient_headers = {"Authorization": f"Bearer {recipient_resp.json()['access_token']}"}
+        
+        me_resp = await client.get("/auth/me", headers=recipient_headers)
+        recipient_id = me_resp.json()["user_id"]
+        me_resp = await client.get("/auth/me", headers=sender_headers)
+        sender_id = me_resp.json()["user_id"]
+        
+        # two messages for the recipient, one for the sender
+        for to in (recipient_id, recipient_id, sender_id):
+            await client.post(
+                "/messages/",
+                json={
+                    "recipient_id": to,
+                    "ciphertext": base64.b64encode(b"batch ack").decode(),
+                    "ephemeral_pubkey": "ephkey"
+                },
+                headers=sender_headers
+            )
+        
+        inbox_resp = await client.get("/messages/inbox", headers=recipient_headers)
+        own_ids = [m["id"] for m in inbox_resp.json()["messages"]]
+        inbox_resp = await client.get("/messages/inbox", headers=sender_headers)
+        other_id = inbox_resp.json()["messages"][0]["id"]
+        
+        response = await client.post(
+            "/messages/ack",
+            json={"message_ids": own_ids + [other_id, 99999]},
+            headers=recipient_headers
+        )
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert sorted(data["acknowledged"]) == sorted(own_ids)
+        assert data["rejected"] == [other_id, 99999]
+    
+    @pytest.mark.asyncio
+    async def test_batch_ack_empty_list(self, client: AsyncClient):
+        """Test batch ack requires at least one id."""
+        reg_resp = await client.post(
+            "/auth/register",
+            json={"username": "emptyack", "password": "ValidPass123"}
+        )
+        token = reg_resp.json()["access_token"]
+        
+        response = await client.post(
+            "/messages/ack",
+            json={"message_ids": []},
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        
+        assert response.status_code == 422
+
+
+class TestInboxCache:
+    """Tests for the redis inbox cache behind fetch_inbox."""
+    
+    async def _two_users(self, client: AsyncClient) -> tuple[dict, dict, int]:
+        sender = await client.post("/auth/register",
+                                   json={"username": "cachesender", "password": "ValidPass123"})
+        recipient = await client.post("/auth/register",
+                                      json={"username": "cacherecipient", "password": "ValidPass123"})
+        sender_headers = {"Authorization": f"Bearer {sender.json()['access_token']}"}
+        recipient_headers = {"Authorization": f"Bearer {recipient.json()['access_token']}"}
+        me = await client.get("/auth/me", headers=recipient_headers)
+        return sender_headers, recipient_headers, me.json()["user_id"]
+    
+    async def _send(self, client: AsyncClient, headers: dict, recipient_id: int, n: int) -> None:
+        await client.post("/messages/batch", headers=headers, json={"envelopes": [
+            {"recipient_id": recipient_id, "ephemeral_pubkey": "k",
+             "ciphertext": base64.b64encode(f"msg {i}".encode()).decode(), "metadata": {"i": i}}
+            for i in range(n)
+        ]})
+    
+    @pytest.mark.asyncio
+    async def test_pages_and_polls_served_from_cache(self, client: AsyncClient, cached_inbox):
+        """Test a refilled cache answers first pages and polls like the db."""
+        sender_headers, recipient_headers, recipient_id = await self._two_users(client)
+        await self._send(client, sender_headers, recipient_id, 3)
+        
+        params = {"limit": 5}
+        from_db = (await client.get("/messages/inbox", headers=recipient_headers,
+                                    params=params)).json()
+        metrics.reset()
+        cached = (await client.get("/messages/inbox", headers=recipient_headers,
+                                   params=params)).json()
+        
+        assert cached == from_db
+        assert [m["metadata"] for m in cached["messages"]] == [{"i": 2}, {"i": 1}, {"i": 0}]
+        assert metrics.snapshot()["counters"]["inbox.cache_hits"] == 1
+        
+        # written through on send, so a poll for newer messages is a hit too
+        await self._send(client, sender_headers, recipient_id, 1)
+        poll = await client.get("/messages/inbox", headers=recipient_headers,
+                                params={**params, "after": cached["prev_cursor"]})
+        
+        assert [m["metadata"] for m in poll.json()["messages"]] == [{"i": 0}]
+        assert metrics.snapshot()["counters"]["inbox.cache_hits"] == 2
+    
+    @pytest.mark.asyncio
+    async def test_cap_and_ack_trim(self, client: AsyncClient, cached_inbox):
+        """Test the set stays capped, and acked history only comes back from the db."""
+        sender_headers, recipient_headers, recipient_id = await self._two_users(client)
+        await client.get("/messages/inbox", headers=recipient_headers, params={"limit": 5})
+        await self._send(client, sender_headers, recipient_id, 12)
+        
+        assert await cached_inbox.zcard(f"inbox:cache:{recipient_id}") == 8
+        page = (await client.get("/messages/inbox", headers=recipient_headers,
+                                 params={"limit": 5})).json()["messages"]
+        assert [m["metadata"]["i"] for m in page] == [11, 10, 9, 8, 7]
+        
+        await client.post("/messages/ack", headers=recipient_headers,
+                          json={"message_ids": [page[0]["id"]]})
+        assert await cached_inbox.zcard(f"inbox:cache:{recipient_id}") == 1
+        
+        metrics.reset()
+        page = (await client.get("/messages/inbox", headers=recipient_headers,
+                                 params={"limit": 5})).json()["messages"]
+        assert [m["metadata"]["i"] for m in page] == [11, 10, 9, 8, 7]
+        assert metrics.snapshot()["counters"]["inbox.cache_misses"] == 1
+    
+    @pytest.mark.asyncio
+    async def test_stale_refill_keeps_floor(self, client: AsyncClient, cached_inbox):
+        """Test a refill read before an ack doesn't vouch for what the ack dropped."""
+        sender_headers, recipient_headers, recipient_id = await self._two_users(client)
+        await self._send(client, sender_headers, recipient_id, 2)
+        newest = (await client.get("/messages/inbox", headers=recipient_headers,
+                                   params={"limit": 5})).json()["messages"][0]
+        meta_key = f"inbox:cache:{recipient_id}:meta"
+        
+        # a reader takes gen and goes to the db, then an ack lands before its refill
+        _, gen = await inbox_cache.page(recipient_id, 3)
+        await client.post("/messages/ack", headers=recipient_headers,
+                          json={"message_ids": [newest["id"]]})
+        floor = await cached_inbox.hget(meta_key, "floor")
+        await inbox_cache.fill(recipient_id, [], gen, complete=True)
+        
+        assert await cached_inbox.hget(meta_key, "floor") == floor != "0"
+    
+    @pytest.mark.asyncio
+    async def test_one_member_per_message(self, cached_inbox):
+        """Test a refill replaces the written-through member and pages stay full."""
+        start = datetime.datetime(2024, 1, 1)
+        rows = [{"id": i, "sender_id": 1, "recipient_id": 99, "ciphertext": b"c",
+                 "ephemeral_pubkey": "k", "metadata": None,
+                 "created_at": start + datetime.timedelta(seconds=i)} for i in range(1, 5)]
+        await inbox_cache.push(rows)
+        _, gen = await inbox_cache.page(99, 3)
+        
+        # same messages read back from the db, serialized differently
+        refilled = [{**row, "metadata": "refilled"} for row in reversed(rows)]
+        await inbox_cache.fill(99, refilled, gen, complete=True)
+        assert await cached_inbox.zcard("inbox:cache:99") == 4
+        
+        page, _ = await inbox_cache.page(99, 3)
+        assert [row["id"] for row in page] == [4, 3, 2]
+        
+        # a duplicate under another score: polls dedupe, first pages miss
+        dupe = {**rows[2], "created_at": rows[2]["created_at"] + datetime.timedelta(microseconds=1)}
+        await cached_inbox.zadd("inbox:cache:99", {_member(dupe): _score(dupe["created_at"])})
+        await cached_inbox.hincrby("inbox:cache:99:meta", "size", 1)
+        
+        assert (await inbox_cache.page(99, 3))[0] is None
+        page, _ = await inbox_cache.page(99, 3, after=(start, 0))
+        assert [row["id"] for row in page] == [1, 2, 3]
+    
+    @pytest.mark.asyncio
+    async def test_aware_cursor_rejected(self, client: AsyncClient, cached_inbox):
+        """Test a cursor with a utc offset is a 400, not a crash in the cache."""
+        _, recipient_headers, _ = await self._two_users(client)
+        raw = json.dumps(["2024-01-01T00:00:00+00:00", 1]).encode()
+        cursor = base64.urlsafe_b64encode(raw).decode().rstrip("=")
+        
+        for param in ("after", "before"):
+            response = await client.get("/messages/inbox", headers=recipient_headers,
+                                        params={param: cursor})
+            assert response.status_code == 400
+            assert response.json()["error"] == "Invalid pagination cursor."
@@ -0,0 +1,60 @@
+"""
+test_middleware.py - Tests for the ASGI middleware
+
+Tests cover:
+1. Security headers on every response
+2. Upload limit by Content-Length
+3. Upload limit on streamed (chunked) bodies
+"""
+
+import pytest
+from httpx import AsyncClient
+
+
+class TestSecurityHeaders:
+    """Tests for SecurityHeadersMiddleware."""
+    
+    @pytest.mark.asyncio
+    async def test_headers_present(self, client: AsyncClient):
+        """Test responses carry the security headers, errors included."""
+        for response in (await client.get("/health"), await client.get("/auth/me")):
+            assert response.headers["X-Frame-Options"] == "DENY"
+            assert response.headers["X-Content-Type-Options"] == "nosniff"
+            assert "frame-ancestors 'none'" in response.headers["Content-Security-Policy"]
+
+
+class TestLimitUploadSize:
+    """Tests for LimitUploadSize."""
+    
+    @pytest.mark.asyncio
+    async def test_content_length_over_limit(self, client: AsyncClient):
+        """Test a declared oversized body is refused up front."""
+        response = await client.post("/auth/login", content=b"x" * 1_100_000,
+                                     headers={"Content-Type": "application/json"})
+        
+        assert response.status_code == 413
+    
+    @pytest.mark.asyncio
+    async def test_chunked_body_over_limit(self, client: AsyncClient):
+        """Test a body without Content-Length is cut off once it passes the limit."""
+        async def chunks():
+            for _ in range(20):
+                yield b" " * 64_000
+        
+        response = await client.post("/auth/login", content=chunks(),
+                                     headers={"Content-Type": "application/json"})
+        
+        assert response.status_code == 413
+        assert "content-length" not in response.request.headers
+    
+    @pytest.mark.asyncio
+    async def test_small_chunked_body_passes(self, client: AsyncClient):
+        """Test streamed bodies under the limit still work."""
+        async def chunks():
+            yield b'{"username": "nobodyhere", '
+            yield b'"password": "ValidPass123"}'
+        
+        response = await client.post("/auth/login", content=chunks(),
+                                     headers={"Content-Type": "application/json"})
+        
+        assert response.status_code == 401
@@ -0,0 +1,229 @@
+"""
+test_rate_limiter.py - Tests for redis rate limiting
+
+Tests cover:
+1. Sliding window log script
+2. Token bucket script
+3. RateLimit-* / Retry-After headers on real routes
+4. Circuit breaker and in-memory fallback when redis is down
+"""
+
+import asyncio
+
+import fakeredis
+import pytest
+from httpx import AsyncClient
+
+from app.core import redis_guard as guard_module
+from app.core.rate_limiter import HybridLimiter, MemoryFallbackLimiter, hit
+from app.core.redis_guard import CircuitBreaker, RedisGuard, RedisUnavailable
+from app.main import app
+
+
+@pytest.fixture
+def fresh_breaker(monkeypatch):
+    """Give the shared guard a clean breaker so failures don't leak between tests."""
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    monkeypatch.setattr(guard_module.redis_guard, "breaker", breaker)
+    return breaker
+
+
+@pytest.fixture
+def down_redis(fresh_breaker):
+    """A redis client whose server is unreachable, attached to the app."""
+    server = fakeredis.FakeServer()
+    server.connected = False
+    r = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    app.state.redis = r
+    yield r
+    del app.state.redis
+
+
+class TestSlidingWindow:
+    """Tests for the sliding_window algorithm."""
+    
+    @pytest.mark.asyncio
+    async def test_limit_and_recover(self, fake_redis):
+        """Test requests over the limit are denied until the window slides."""
+        results = [
+            await hit(fake_redis, "t:sw", limit=3, window=10, now_ms=1_000 + i)
+            for i in range(4)
+        ]
+        
+        assert [r.allowed for r in results] == [True, True, True, False]
+        assert [r.remaining for r in results] == [2, 1, 0, 0]
+        # oldest hit was at 1000, so a slot frees at 11000
+        assert results[-1].reset_ms == 11_000 - 1_003
+        
+        later = await hit(fake_redis, "t:sw", limit=3, window=10, now_ms=11_001)
+        assert later.allowed
+    
+    @pytest.mark.asyncio
+    async def test_denied_requests_do_not_count(self, fake_redis):
+        """Test a client hammering a full window isn't locked out forever."""
+        for i in range(3):
+            await hit(fake_redis, "t:sw2", limit=3, window=10, now_ms=i)
+        for i in range(50):
+            await hit(fake_redis, "t:sw2", limit=3, window=10, now_ms=5_000 + i)
+        
+        result = await hit(fake_redis, "t:sw2", limit=3, window=10, now_ms=10_003)
+        assert result.allowed
+
+
+class TestTokenBucket:
+    """Tests for the token_bucket algorithm."""
+    
+    @pytest.mark.asyncio
+    async def test_burst_then_refill(self, fake_redis):
+        """Test a full bucket allows a burst and refills over time."""
+        burst = [
+            await hit(fake_redis, "t:tb", limit=5, window=10,
+                      algorithm="token_bucket", now_ms=0)
+            for _ in range(6)
+        ]
+        
+        assert [r.allowed for r in burst] == [True] * 5 + [False]
+        assert burst[-1].reset_ms == 2_000  # one token every 2s
+        
+        refilled = await hit(fake_redis, "t:tb", limit=5, window=10,
+                             algorithm="token_bucket", now_ms=2_000)
+        assert refilled.allowed
+        assert refilled.remaining == 0
+
+
+class TestHybrid:
+    """Tests for the two-tier hybrid limiter."""
+    
+    @pytest.mark.asyncio
+    async def test_local_until_threshold_then_strict(self, fake_redis):
+        """Test hits below the threshold never reach redis."""
+        limiter = HybridLimiter(threshold=0.5)
+        
+        results = [
+            await limiter.hit(fake_redis, "t:hy", limit=10, window=60, now_ms=0)
+            for _ in range(11)
+        ]
+        
+        assert [r.allowed for r in results] == [True] * 10 + [False]
+        # first 5 were local, the 6th pushed them to redis with its check
+        assert await fake_redis.get("t:hy:fw:0") == "10"
+    
+    @pytest.mark.asyncio
+    async def test_workers_share_budget_after_sync(self, fake_redis):
+        """Test two workers together stay within the limit once synced."""
+        a = HybridLimiter(threshold=0.5)
+        b = HybridLimiter(threshold=0.5)
+        
+        admitted = 0
+        for _ in range(5):
+            admitted += (await a.hit(fake_redis, "t:hy2", 10, 60, now_ms=0)).allowed
+        await a.sync(fake_redis)
+        
+        admitted += (await b.hit(fake_redis, "t:hy2", 10, 60, now_ms=0)).allowed
+        await b.sync(fake_redis)
+        for _ in range(10):
+            admitted += (await b.hit(fake_redis, "t:hy2", 10, 60, now_ms=0)).allowed
+        
+        assert admitted == 10
+        assert await fake_redis.get("t:hy2:fw:0") == "10"
+
+
+class TestRateLimitHeaders:
+    """Tests for headers added by the limiter dependency."""
+    
+    @pytest.mark.asyncio
+    async def test_headers_on_allowed_request(self, client: AsyncClient, fake_redis):
+        """Test allowed responses carry RateLimit-* headers."""
+        response = await client.get("/keys/1")
+        
+        assert response.status_code == 200
+        assert response.headers["RateLimit-Limit"] == "30"
+        assert response.headers["RateLimit-Remaining"] == "29"
+        assert "RateLimit-Reset" in response.headers
+    
+    @pytest.mark.asyncio
+    async def test_retry_after_when_limited(self, client: AsyncClient, fake_redis):
+        """Test the request over the limit gets 429 with Retry-After."""
+        payload = {"username": "nobodyhere", "password": "ValidPass123"}
+        for _ in range(5):
+            await client.post("/auth/login", json=payload)
+        
+        response = await client.post("/auth/login", json=payload)
+        
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) > 0
+        assert response.headers["RateLimit-Remaining"] == "0"
+
+
+class TestRedisGuard:
+    """Tests for timeouts, the circuit breaker and the fallback limiter."""
+    
+    @pytest.mark.asyncio
+    async def test_timeout_opens_breaker(self):
+        """Test slow calls time out and the breaker then fails fast."""
+        guard = RedisGuard(timeout=0.01, breaker=CircuitBreaker(failure_threshold=2))
+        calls = 0
+        
+        async def slow():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(1)
+        
+        for _ in range(3):
+            with pytest.raises(RedisUnavailable):
+                await guard.run(slow)
+        
+        assert guard.breaker.state == "open"
+        assert calls == 2  # third call never reached redis
+    
+    @pytest.mark.asyncio
+    async def test_half_open_probe(self):
+        """Test one probe is let through after the reset timeout."""
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        assert breaker.state == "open"
+        
+        assert breaker.allow()
+        assert breaker.state == "half_open"
+        assert not breaker.allow()  # only one probe at a time
+        
+        breaker.record_success()
+        assert breaker.state == "closed"
+        assert breaker.allow()
+    
+    @pytest.mark.asyncio
+    async def test_cancelled_probe_frees_half_open(self):
+        """Test a probe cancelled mid-call doesn't block every later call."""
+        guard = RedisGuard(timeout=1, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0))
+        guard.breaker.record_failure()
+        
+        probe = asyncio.create_task(guard.run(asyncio.sleep, 10))
+        await asyncio.sleep(0)
+        assert guard.breaker.state == "half_open"
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        
+        assert await guard.run(asyncio.sleep, 0) is None
+        assert guard.breaker.state == "closed"
+    
+    def test_fallback_limiter_windows(self):
+        """Test the in-memory fallback enforces the limit per window."""
+        fallback = MemoryFallbackLimiter()
+        
+        results = [fallback.hit("k", limit=2, window=10, now_ms=i) for i in range(3)]
+        assert [r.allowed for r in results] == [True, True, False]
+        assert fallback.hit("k", limit=2, window=10, now_ms=10_000).allowed
+    
+    @pytest.mark.asyncio
+    async def test_limiter_falls_back_when_redis_down(self, client: AsyncClient,
+                                                     down_redis, fresh_breaker):
+        """Test requests still get limited (not 500s) with redis unreachable."""
+        payload = {"username": "nobodyhere", "password": "ValidPass123"}
+        statuses = [
+            (await client.post("/auth/login", json=payload)).status_code
+            for _ in range(6)
+        ]
+        
+        assert statuses == [401] * 5 + [429]
+        assert fresh_breaker.state == "open"
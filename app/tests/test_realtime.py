@@ -0,0 +1,105 @@
+"""
+test_realtime.py - Tests for websocket message push
+
+Tests cover:
+1. Rejecting sockets without a valid token
+2. In-process delivery to connected sockets
+3. Disconnecting clients whose send buffer is full
+"""
+
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+from app.core.encryption import encryptor
+from app.core.realtime import ConnectionHub
+from app.main import app
+
+
+class FakeWebSocket:
+    """Just enough of starlette's WebSocket for the hub."""
+    
+    def __init__(self, block_sends: bool = False):
+        self.sent: list[str] = []
+        self.closed_with: int | None = None
+        self.block_sends = block_sends
+        self._incoming: asyncio.Queue = asyncio.Queue()
+    
+    async def send_text(self, data: str):
+        if self.block_sends:
+            await asyncio.Event().wait()
+        self.sent.append(data)
+    
+    async def receive(self):
+        return await self._incoming.get()
+    
+    async def close(self, code: int = 1000):
+        self.closed_with = code
+    
+    def disconnect(self):
+        self._incoming.put_nowait({"type": "websocket.disconnect"})
+
+
+def envelope(recipient_id: int, metadata=None) -> dict:
+    return {
+        "id": 1,
+        "sender_id": 2,
+        "recipient_id": recipient_id,
+        "ciphertext": "aGk=",
+        "ephemeral_pubkey": "eph",
+        "metadata": encryptor.encrypt('{"n": 1}') if metadata else None,
+    }
+
+
+class TestRealtime:
+    """Tests for the websocket hub."""
+    
+    def test_socket_requires_token(self):
+        """Test sockets without a valid token are closed with 1008."""
+        client = TestClient(app)
+        
+        with pytest.raises(WebSocketDisconnect) as exc:
+            with client.websocket_connect("/messages/ws?token=bad") as ws:
+                ws.receive_text()
+        
+        assert exc.value.code == 1008
+    
+    @pytest.mark.asyncio
+    async def test_local_delivery(self):
+        """Test envelopes reach the recipient's sockets with metadata decrypted."""
+        hub = ConnectionHub(buffer_size=8)
+        ws = FakeWebSocket()
+        other = FakeWebSocket()
+        session = asyncio.create_task(hub.serve(ws, 5))
+        other_session = asyncio.create_task(hub.serve(other, 6))
+        await asyncio.sleep(0)
+        
+        await hub.publish(5, envelope(5, metadata=True))
+        await asyncio.sleep(0.01)
+        
+        assert len(ws.sent) == 1
+        assert '"metadata": {"n": 1}' in ws.sent[0]
+        assert other.sent == []
+        
+        ws.disconnect()
+        other.disconnect()
+        await asyncio.gather(session, other_session)
+        assert hub.connection_count() == 0
+    
+    @pytest.mark.asyncio
+    async def test_slow_consumer_is_dropped(self):
+        """Test a full send buffer closes the socket with 1013."""
+        hub = ConnectionHub(buffer_size=2)
+        ws = FakeWebSocket(block_sends=True)
+        session = asyncio.create_task(hub.serve(ws, 7))
+        
+        await hub.publish(7, envelope(7))
+        await asyncio.sleep(0.01)  # sender is now stuck on the first envelope
+        for _ in range(3):
+            await hub.publish(7, envelope(7))
+        await asyncio.wait_for(session, timeout=1)
+        
+        assert ws.closed_with == 1013
+        assert hub.connection_count() == 0
@@ -0,0 +1,59 @@
+"""
+bench_encryption.py - per-field cost and stored size, fernet vs aes-gcm
+
+Encrypts and decrypts the kind of values we store (device names and
+message metadata json of a few sizes) with both FieldEncryptor backends.
+
+    python benchmarks/bench_encryption.py
+    python benchmarks/bench_encryption.py --rounds 50000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./bench.db")
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
+
+from app.core.encryption import FieldEncryptor  # noqa: E402
+
+VALUES = {
+    "device_name": "Alice's Pixel 8",
+    "metadata_small": json.dumps({"type": "text"}),
+    "metadata_1k": json.dumps({"type": "file", "name": "x" * 1000}),
+    "metadata_8k": json.dumps({"type": "file", "thumb": "x" * 8000}),
+}
+
+
+def timed(fn, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - started) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rounds", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{args.rounds} rounds per value")
+    print(f"{'value':<15} {'backend':<8} {'plain B':>8} {'stored B':>9} "
+          f"{'enc us':>8} {'dec us':>8}")
+    for label, value in VALUES.items():
+        for backend in ("fernet", "aesgcm"):
+            enc = FieldEncryptor(backend)
+            token = enc.encrypt(value)
+            assert enc.decrypt(token) == value
+            enc_us = timed(lambda enc=enc, value=value: enc.encrypt(value), args.rounds)
+            dec_us = timed(lambda enc=enc, token=token: enc.decrypt(token), args.rounds)
+            print(f"{label:<15} {backend:<8} {len(value):>8} {len(token):>9} "
+                  f"{enc_us:>8.2f} {dec_us:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+bench_middleware.py - per-request cost of the security headers + upload
+limit middleware, BaseHTTPMiddleware (the old versions, copied below) vs
+the plain ASGI ones in app/core
+
+Calls the ASGI app directly with an in-memory request so only the
+middleware and routing cost is measured, no network or http parsing.
+
+    python benchmarks/bench_middleware.py
+    python benchmarks/bench_middleware.py --requests 50000
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./bench.db")
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
+
+from starlette.applications import Starlette  # noqa: E402
+from starlette.middleware import Middleware  # noqa: E402
+from starlette.middleware.base import BaseHTTPMiddleware  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+from starlette.responses import JSONResponse, Response  # noqa: E402
+from starlette.routing import Route  # noqa: E402
+
+from app.core.middleware import LimitUploadSize  # noqa: E402
+from app.core.security_headers import CSP, SecurityHeadersMiddleware  # noqa: E402
+
+
+class OldSecurityHeaders(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        response = await call_next(request)
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        response.headers["X-Frame-Options"] = "DENY"
+        response.headers["X-XSS-Protection"] = "1; mode=block"
+        response.headers["Strict-Transport-Security"] = "max-age=63072000; includeSubDomains; preload"
+        response.headers["Content-Security-Policy"] = CSP
+        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
+        return response
+
+
+class OldLimitUploadSize(BaseHTTPMiddleware):
+    def __init__(self, app, max_upload_size: int) -> None:
+        super().__init__(app)
+        self.max_upload_size = max_upload_size
+
+    async def dispatch(self, request, call_next):
+        if request.method == "POST" and "content-length" in request.headers:
+            if int(request.headers["content-length"]) > self.max_upload_size:
+                return Response("Request too large", status_code=413)
+        return await call_next(request)
+
+
+async def ok(request: Request):
+    return JSONResponse({"status": "ok"})
+
+
+async def echo(request: Request):
+    return JSONResponse({"size": len(await request.body())})
+
+
+def build(headers_cls, limit_cls) -> Starlette:
+    return Starlette(
+        routes=[Route("/", ok), Route("/echo", echo, methods=["POST"])],
+        middleware=[Middleware(headers_cls), Middleware(limit_cls, max_upload_size=1_048_576)],
+    )
+
+
+async def call(app, method: str, path: str, body: bytes) -> int:
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "path": path, "raw_path": path.encode(), "root_path": "",
+        "scheme": "http", "query_string": b"", "server": ("test", 80), "client": ("1.2.3.4", 1),
+        "headers": [(b"content-length", str(len(body)).encode())],
+    }
+    sent = False
+    status = 0
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            await asyncio.sleep(3600)  # disconnect never comes
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def run(app, method: str, path: str, body: bytes, requests: int) -> float:
+    for _ in range(200):  # warm up
+        await call(app, method, path, body)
+    started = time.perf_counter()
+    for _ in range(requests):
+        await call(app, method, path, body)
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    bare = Starlette(routes=[Route("/", ok), Route("/echo", echo, methods=["POST"])])
+    apps = {
+        "none": bare,
+        "BaseHTTP": build(OldSecurityHeaders, OldLimitUploadSize),
+        "ASGI": build(SecurityHeadersMiddleware, LimitUploadSize),
+    }
+    cases = {"GET /": ("GET", "/", b""), "POST /echo 4KB": ("POST", "/echo", b"x" * 4096)}
+
+    print(f"{args.requests} requests per case, us per request")
+    print(f"{'case':<16} " + " ".join(f"{name:>10}" for name in apps))
+    for label, (method, path, body) in cases.items():
+        times = [await run(app, method, path, body, args.requests) for app in apps.values()]
+        print(f"{label:<16} " + " ".join(f"{t:>10.1f}" for t in times))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+"""
+bench_rate_limiter.py - redis round trips per request, strict vs hybrid
+
+Simulates several uvicorn workers (one HybridLimiter each) sharing one
+redis, with many clients mostly well under their limit plus a few that
+hammer it. Time is simulated so runs are repeatable.
+
+    python benchmarks/bench_rate_limiter.py
+    python benchmarks/bench_rate_limiter.py --redis-url redis://localhost:6379
+
+Without --redis-url it uses fakeredis (pip install -r requirements-test.txt).
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./bench.db")
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
+
+from app.core.metrics import metrics  # noqa: E402
+from app.core.rate_limiter import HybridLimiter, hit  # noqa: E402
+
+LIMIT = 30
+WINDOW = 30
+
+
+def traffic(requests: int, clients: int, hot: int, seed: int = 1):
+    """(client, now_ms) pairs: hot clients (if any) send half of all requests"""
+    rnd = random.Random(seed)
+    duration_ms = WINDOW * 1000
+    for i in range(requests):
+        if hot and rnd.random() < 0.5:
+            client = f"hot{rnd.randrange(hot)}"
+        else:
+            client = f"c{rnd.randrange(clients)}"
+        yield client, i * duration_ms // requests
+
+
+async def run(redis_client, mode: str, args) -> dict:
+    await redis_client.flushdb()
+    metrics.reset()
+    workers = [HybridLimiter(threshold=args.threshold) for _ in range(args.workers)]
+    sync_every_ms = int(args.sync_interval * 1000)
+    next_sync = sync_every_ms
+    admitted: dict[str, int] = {}
+    rnd = random.Random(2)
+
+    started = time.perf_counter()
+    for client, now_ms in traffic(args.requests, args.clients, args.hot):
+        if mode == "hybrid" and now_ms >= next_sync:
+            for w in workers:
+                await w.sync(redis_client)
+            next_sync += sync_every_ms
+
+        key = f"rl:ip:{client}:bench"
+        if mode == "strict":
+            result = await hit(redis_client, key, LIMIT, WINDOW, now_ms=now_ms)
+        else:
+            worker = workers[rnd.randrange(args.workers)]
+            result = await worker.hit(redis_client, key, LIMIT, WINDOW, now_ms=now_ms)
+        if result.allowed:
+            admitted[client] = admitted.get(client, 0) + 1
+    elapsed = time.perf_counter() - started
+
+    calls = metrics.snapshot()["counters"].get("rate_limit.redis_calls", 0)
+    return {
+        "mode": mode,
+        "calls_per_req": calls / args.requests,
+        "us_per_req": elapsed / args.requests * 1e6,
+        "max_admitted": max(admitted.values()),
+        "over_limit": sum(max(0, n - LIMIT) for n in admitted.values()),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--redis-url")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--hot", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--sync-interval", type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.redis_url:
+        import redis.asyncio as redis
+        redis_client = redis.from_url(args.redis_url, decode_responses=True)
+    else:
+        import fakeredis
+        redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+    print(f"{args.requests} requests, {args.clients} normal + {args.hot} hot clients, "
+          f"limit {LIMIT}/{WINDOW}s, {args.workers} workers, threshold {args.threshold}, "
+          f"sync every {args.sync_interval}s")
+    print(f"{'mode':<8} {'redis calls/req':>16} {'us/req':>8} {'max admitted':>13} {'over limit':>11}")
+    for mode in ("strict", "hybrid"):
+        r = await run(redis_client, mode, args)
+        print(f"{r['mode']:<8} {r['calls_per_req']:>16.3f} {r['us_per_req']:>8.1f} "
+              f"{r['max_admitted']:>13} {r['over_limit']:>11}")
+
+    await redis_client.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
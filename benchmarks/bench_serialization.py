@@ -0,0 +1,72 @@
+"""
+bench_serialization.py - cost of turning an inbox page into a response,
+the old path (jsonable_encoder + starlette JSONResponse) vs fast_json
+
+Builds pages of fake envelopes shaped like messages_out() output and
+renders each page both ways, no http involved.
+
+    python benchmarks/bench_serialization.py
+    python benchmarks/bench_serialization.py --rounds 500
+"""
+
+import argparse
+import base64
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./bench.db")
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+from app.core.responses import DefaultJSONResponse, fast_json  # noqa: E402
+
+
+def page(size: int) -> dict:
+    messages = [
+        {
+            "id": i,
+            "sender_id": 7,
+            "recipient_id": 42,
+            "ciphertext": base64.b64encode(os.urandom(512)).decode(),
+            "ephemeral_pubkey": base64.b64encode(os.urandom(32)).decode(),
+            "metadata": {"type": "text", "sent_at": "2024-05-01T12:00:00Z", "n": i},
+        }
+        for i in range(size)
+    ]
+    return {"messages": messages, "next_cursor": "abc", "prev_cursor": None}
+
+
+def run(render, content: dict, rounds: int) -> float:
+    for _ in range(10):  # warm up
+        render(content)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        render(content)
+    return (time.perf_counter() - started) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    paths = {
+        "encoder+json": lambda c: JSONResponse(jsonable_encoder(c)),
+        "fast_json": fast_json,
+    }
+
+    print(f"fast_json renders with {DefaultJSONResponse.__name__}, {args.rounds} rounds, us per page")
+    print(f"{'messages':<10} " + " ".join(f"{name:>14}" for name in paths) + f" {'speedup':>8}")
+    for size in (50, 200, 1000):
+        content = page(size)
+        times = [run(render, content, args.rounds) for render in paths.values()]
+        print(f"{size:<10} " + " ".join(f"{t:>14.1f}" for t in times) + f" {times[0] / times[1]:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()